@@ -1,7 +1,7 @@
-import json
 import sys
 from NirvanaJsonAdapter import NirvanaJsonAdapter
-from jsonConstants import cnvConsequencePriorityList, variantTypeKBCategoryMap
+from nirvanaRecords import Variant, Transcript, Sample, collapseList
+from jsonConstants import cnvConsequenceRank, variantTypeKBCategoryMap
 
 class CnvAdapter(NirvanaJsonAdapter):
     """
@@ -12,7 +12,6 @@ class CnvAdapter(NirvanaJsonAdapter):
     # private class members
     iterator= 0
     printedGenes = set()  # Set to keep track of printed genes to avoid duplicates
-    currentTranscript = None
     
     def __init__(self, output_handle ):
         """
@@ -21,8 +20,9 @@ class CnvAdapter(NirvanaJsonAdapter):
         :param cnv_file: Path to the input JSON file with CNV information.
         """
         super().__init__()
-        self.context['positions'] = [{}]
+        self.resetPosition()
         self.setOutputHandle(output_handle)
+        self.setConsequenceRanks(cnvConsequenceRank)
 
         
         # Add mappings
@@ -30,7 +30,7 @@ class CnvAdapter(NirvanaJsonAdapter):
         self.addSimpleMapping(('positions.item.position', 'number'), 'start')
         self.addSimpleMapping(('positions.item.svEnd', 'number'), 'end')
         self.addSimpleMapping(('positions.item.cytogeneticBand', 'string'), 'cytogeneticBand')
-        self.addSimpleMapping(('positions.item.variants.item.variantType', 'string'), 'kbCategory')
+        self.addSimpleMapping(('positions.item.variants.item.variantType', 'string'), 'variantType')
         self.addSimpleMapping(('positions.item.variants.item.transcripts.item.transcript', 'string'), 'transcript')
         self.addSimpleMapping(('positions.item.variants.item.transcripts.item.source', 'string'), 'source')
         self.addSimpleMapping(('positions.item.variants.item.transcripts.item.hgnc', 'string'), 'gene')
@@ -40,12 +40,12 @@ class CnvAdapter(NirvanaJsonAdapter):
         self.addSimpleMapping(('positions.item.samples.item.genotype', 'string'), 'genotype')
         self.addSimpleMapping(('positions.item.variants.item.transcripts.item.isCanonical', 'boolean'), 'isCanonical')
         self.addSimpleMapping(('positions.item.variants.item.transcripts.item.completeOverlap', 'boolean'), 'completeOverlap')
-        self.addSimpleMapping(('positions.item.variants.item.transcripts.item.consequence.item', 'string'), 'consequence')
         self.addSimpleMapping(('positions.item.filters.item', 'string'), 'filters')
         
         self.addComplexMapping(('positions.item', 'end_map'), self.handle_end_map_positions_item)
         self.addComplexMapping(('positions.item.variants.item', 'start_map'), self.handle_start_map_variants_item)
-        self.addComplexMapping(('positions.item.variants.item.transcripts.item.consequence.item', 'start_array'), self.handleTranscriptConsequence)
+        self.addComplexMapping(('positions.item.samples.item', 'start_map'), self.handle_start_map_samples_item)
+        self.addComplexMapping(('positions.item.variants.item.transcripts.item.consequence.item', 'string'), self.handleTranscriptConsequence)
         self.addComplexMapping(('positions.item.variants.item.transcripts.item', 'start_map'), self.handleNewTranscript)
     
     # When a position ends, it's time to figure out if we need to print the position.
@@ -54,73 +54,55 @@ class CnvAdapter(NirvanaJsonAdapter):
     def handle_end_map_positions_item(self, value):
         position = self.context['positions'][0]
         
-        if position.get('filters') and self.passFilter in position['filters']:
+        if self.passesFilters( position ):
+            self.countMetric( 'positionsPassed' )
             printPosition = self.massagePosition( position )
             
             # Check if the position has a gene as PORI will expect one.
-            if 'gene' not in printPosition or printPosition['gene'] is None:
-                self.context['positions'] = [{}]  # Reset positions to avoid printing empty objects
+            if printPosition.get('gene') is None:
+                self.resetPosition()  # Reset positions to avoid printing empty objects
                 return
             
-            self.printComma() # Function handles printing a comma if needed for array or map purposes
-            print(json.dumps(printPosition, indent=4), file=self.output_handle)
+            self.emitRecord( printPosition )
         
-        self.context['positions'] = [{}]
+        self.resetPosition()
         
     # This function handles the start of a new transcript item
     # If this is the first new transcript, it initializes the list and the context
     def handleNewTranscript(self, value):
-        self.addArrayToContext(['positions','variants','transcripts'])
+        self.addRecordToContext(['positions','variants','transcripts'], Transcript)
 
     def handle_start_map_variants_item(self, value):
-        self.addArrayToContext( ['positions', 'variants'] )
+        self.addRecordToContext( ['positions', 'variants'], Variant )
+
+    def handle_start_map_samples_item(self, value):
+        self.addRecordToContext( ['positions', 'samples'], Sample )
         
     def setOutputHandle(self, handle):
         return super().setOutputHandle(handle)
 
     def printHeader( self ):
-        print( "\t\"copyVariants\":", file=self.output_handle )
+        self.getWriter().beginArray( 'copyVariants' )
 
         
-    # def readCnvFile(self, cnvJsonFile ):
-    #     self.iterator= 0
-    #     self.context['positions'] = [{}]
-        
-    #     originalOutputHandle = self.getOutputHandle()
-    #     # Read the JSON file
-    #     with open( cnvJsonFile, 'r') as f:
-    #         parser = ijson.parse( f )
-    #         #position = None
-    #         self.printCNVHeader()
-            
-    #         with NamedTemporaryFile( mode='w+', delete=True) as tempfile:
-    #             self.setOutputHandle( tempfile )
-    #             print( "[", file=tempfile )
-    #             for prefix, event, value in parser:
-    #                 self.processEvents( prefix, event, value )
-    #             print( "]", file=tempfile )
-                
-    #             # Go back to the start of the temporary file and read it for the 2nd pass.
-    #             tempfile.seek(0)
-    #             self.setOutputHandle( originalOutputHandle ) # Not sure if this is needed
-    #             perform2ndPass( tempfile, originalOutputHandle )
-                
     def massagePosition(self, position):
         """
         Massage the position data to prepare it for output.
         This includes converting chromosome band, handling variants, and removing unnecessary fields.
         """
-        printPosition = position.copy()
+        printPosition = {}
+        for key, value in (('chromosome', position.chromosome), ('position', position.start), ('svEnd', position.end),
+                           ('filters', collapseList(position.filters))):
+            if value is not None:
+                printPosition[key] = value
         
         # Convert chromosome band to a more readable format
-        printPosition['chromosomeBand'] = self.convertCytogeneticBand(printPosition.get('chromosome'), printPosition.pop('cytogeneticBand', None))
+        printPosition['chromosomeBand'] = self.convertCytogeneticBand(position.chromosome, position.cytogeneticBand)
         
-        if 'transcripts' in printPosition['variants'][0]:
-            self.processVariant( printPosition )
-        if 'variants' in printPosition: # Situation where variants are still around because there were no transcripts
-            printPosition.pop('variants', None)
-        if 'samples' in printPosition:
-            self.processSample( printPosition )
+        if position.variants and position.variants[0].transcripts:
+            self.processVariant( printPosition, position.variants[0] )
+        if position.samples:
+            self.processSample( printPosition, position.samples )
         
         return printPosition
     
@@ -132,21 +114,21 @@ class CnvAdapter(NirvanaJsonAdapter):
             return chromosome.replace('chr', '')
         return chromosome
 
-    def processSample(self, position):
-        if len(position.get('samples')) > 1:
+    def processSample(self, position, samples):
+        if len(samples) > 1:
             print("More than one sample found, only processing the first one.", file=sys.stderr)
         
         
-        sample = position.get('samples')[0]
+        sample = samples[0]
         
-        copyNumber = sample.get('copyNumber', None)
-        minorHaplotype = sample.get('minorHaplotypeCopyNumber', None)
-        genotype = sample.get('genotype', None)
+        copyNumber = sample.copyNumber
+        minorHaplotype = sample.minorHaplotype
+        genotype = sample.genotype
         
         #cna = copyNumber / minorHaplotype 
         copyChange = (copyNumber - 2)
         #log2Cna = math.log2(cna)
-        lohState = sample.get('lossOfHeterozygosity', None)
+        lohState = sample.lossOfHeterozygosity
         if lohState is not None:
             position['lohState'] = "LOH"
         #else:
@@ -155,62 +137,13 @@ class CnvAdapter(NirvanaJsonAdapter):
         #position['cna'] = cna
         position['copyChange'] = copyChange
         #position['log2Cna'] = log2Cna
-        
 
-        position.pop('samples', None)  # Remove samples as we are only interested in the first one for now
-
-
-    def processVariant(self, position):
-        #for variant in position.get('variants'):
-        variant = position.get('variants')[0] #TODO, handle multiple variants
-        transcript = self.getBestTranscript( variant.get('transcripts') )
-        position['transcript'] = transcript['transcript']
-        position['kbCategory'] = variant['variantType']
-        position['kbCategory'] = variantTypeKBCategoryMap.get(position.get('kbCategory'), 'unknown')
-        position['gene'] = transcript['hgnc']
-        position['source'] = transcript['source']
-        
-        position.pop('variants', None)  # Remove variants as we are only interested in the first one for now
 
-    def getBestTranscript(self, transcripts):
-        """
-        Get the best transcript from the list of transcripts.
-        The best transcript is the one that is canonical and has the lowest consequence rank
-        TODO: Check if the best transcript should also be a completeOverlap transcript.
-        """
-        if not transcripts:
-            return {}
-        
-        consequenceRank = []
-        for transcript in transcripts:
-            consequenceRank.append( (self.getBestConsequence( transcript.get('consequence'), cnvConsequencePriorityList), transcript.get('source') ) )
-        bestRank = len(cnvConsequencePriorityList)
-        bestIndex = -1
-        i = 0
-        for (rank, source) in consequenceRank:
-            
-            canonical = transcripts[i].get('isCanonical', False)
-            bestCanonical = transcripts[bestIndex].get('isCanonical', False) if bestIndex >= 0 else False
-            # Check for the canonical transcript first.  This should be one of the best transcripts to use.
-            # If the i indexed transcript is canonical and the best one is not, then we should use this one.
-            if canonical and not bestCanonical: 
-                bestRank = rank
-                bestIndex = i
-            elif rank < bestRank: # standard checking for best ranking
-                bestRank = rank
-                bestIndex = i
-            elif rank == bestRank and source == 'RefSeq': # This can be an elif. Check if the source is our preferred source
-                bestRank = rank
-                bestIndex = i
-            i += 1
-        
-        return transcripts[bestIndex]
-    
-    def handleTranscriptConsequence(self, value):
-        if not self.currentTranscript:
-            self.currentTranscript = { 'consequence': [value]}
-        else:
-            self.currentTranscript['consequence'].append(value)
-        
-        # Note, VS code has this underlined as an error, but it is not an error.
-        self.currentTranscript['consequenceRank'] = cnvConsequencePriorityList.index(value) if value in cnvConsequencePriorityList else len(cnvConsequencePriorityList)
+    def processVariant(self, position, variant):
+        #for variant in position.variants:
+        #TODO, handle multiple variants
+        transcript = self.getBestTranscript( variant.transcripts )
+        position['transcript'] = transcript.transcript
+        position['kbCategory'] = variantTypeKBCategoryMap.get(variant.variantType, 'unknown')
+        position['gene'] = transcript.gene
+        position['source'] = transcript.source
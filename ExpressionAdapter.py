@@ -0,0 +1,244 @@
+import math
+import os
+import re
+import sys
+import jsonConstants
+import referenceCache
+
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for expression analysis, see ExpressionAdapter
+    np = None
+
+# Reference rows scored at a time, bounds the memory of the intermediate arrays and of any rows that have to be copied.
+scoreBlockRows = 4096
+
+# Values written for a missing z-score, turned into nan before the numbers are parsed.
+missingValuePattern = re.compile(r'(?<![^\t])(?:NA|NaN|N/A|null|)(?![^\t])')
+
+def readZscoreTable(path):
+    """
+    Read a tab separated z-score table with a header line, one gene per row and one column per sample.
+
+    :return: (genes, sample names, float32 array with a row per gene).
+    :raises ValueError: If a value isn't a number or a row doesn't have a value for every sample.
+    """
+    genes, rows = [], []
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+        for line in f:
+            gene, _, values = line.rstrip('\r\n').partition('\t')
+            if gene:
+                genes.append(gene)
+                rows.append(values)
+    samples = header[1:]
+    if not rows:
+        return genes, samples, np.empty((0, len(samples)), dtype=np.float32)
+    # All the values are parsed by numpy in one call, a float() per value would take minutes on a full reference cohort
+    try:
+        values = np.loadtxt(rows, dtype=np.float32, delimiter='\t', ndmin=2)
+    except ValueError:
+        # Missing values, written as NA or left empty, are read as nan
+        rows = [missingValuePattern.sub('nan', row) for row in rows]
+        try:
+            values = np.loadtxt(rows, dtype=np.float32, delimiter='\t', ndmin=2)
+        except ValueError as error:
+            raise ValueError(f"{path}: {error}") from error
+    if values.shape[1] != len(samples):
+        raise ValueError(f"{path} should have a value for each of its {len(samples)} samples on every row")
+    return genes, samples, values
+
+def joinGenes(referenceGenes, genes):
+    """
+    Find the row of each gene in the reference through a dictionary of the reference genes.
+
+    :return: Array with the reference row of each gene, -1 for genes not in the reference.
+    """
+    index = {gene: row for row, gene in enumerate(referenceGenes)}
+    return np.fromiter((index.get(gene, -1) for gene in genes), dtype=np.intp, count=len(genes))
+
+def scoreList(scores):
+    """
+    Convert an array of scores to a list of rounded floats, with None for scores that can't be written as JSON,
+    eg the kIQR of a gene without spread in the cohort.
+    """
+    return [value if math.isfinite(value) else None for value in np.round(scores.astype(np.float64), 3).tolist()]
+
+class ExpressionAdapter:
+    """
+    Adapter for the expressionVariants section.
+    The disease z-scores are a reference cohort of samples with the patient's disease, one column per sample.
+    The biopsy z-scores are the patient's own, the first value column is used.
+    Every gene of the patient is placed in the cohort and genes far out in either tail are reported as outliers.
+    """
+
+    def __init__(self, diseaseZscores, biopsyZscores):
+        """
+        :param diseaseZscores: Path to the TSV with the disease cohort z-scores.
+        :param biopsyZscores: Path to the TSV with the patient's z-scores.
+        """
+        if np is None:
+            raise ImportError("numpy is required for expression analysis, install it with: pip install numpy")
+        self.diseaseZscores = diseaseZscores
+        self.biopsyZscores = biopsyZscores
+        self.zscoreThreshold = jsonConstants.expressionZscoreThreshold
+        self.percentileThreshold = jsonConstants.expressionPercentileThreshold
+        self.referenceCache = None
+
+    def setOutlierThresholds(self, zscore, percentile):
+        """
+        :param zscore: Smallest distance from the cohort mean, in standard deviations, of an outlier.
+        :param percentile: Smallest percentile of an increased expression outlier, 100 - percentile is the
+        largest percentile of a reduced expression outlier.
+        """
+        self.zscoreThreshold = zscore
+        self.percentileThreshold = percentile
+
+    def setReferenceCache(self, directory):
+        """
+        Keep compiled disease references in this directory, see referenceCache.
+        """
+        self.referenceCache = directory
+
+    def loadReference(self):
+        """
+        :return: (genes, cohort z-scores with a row per gene)
+        """
+        resident = referenceCache.residentReferences
+        if resident is not None:
+            key = referenceCache.entryKey(self.diseaseZscores)
+            kept = resident.get(os.path.realpath(self.diseaseZscores))
+            if kept is not None and kept[0] == key:
+                return kept[1], kept[2]
+        loaded = None
+        if self.referenceCache is not None:
+            loaded = referenceCache.loadCachedReference(self.diseaseZscores, self.referenceCache)
+        if loaded is None:
+            genes, samples, reference = readZscoreTable(self.diseaseZscores)
+            if self.referenceCache is not None:
+                referenceCache.storeReference(self.diseaseZscores, self.referenceCache, genes, samples, reference)
+            loaded = genes, reference
+        if resident is not None:
+            resident[os.path.realpath(self.diseaseZscores)] = (key,) + tuple(loaded)
+        return loaded
+
+    def loadBiopsy(self):
+        """
+        :return: (genes, the patient's z-score of each gene)
+        """
+        genes, samples, values = readZscoreTable(self.biopsyZscores)
+        return genes, values[:, 0]
+
+    def scoreGenes(self, reference, values):
+        """
+        Place each value in its row of the reference, for all genes at once.
+
+        :param reference: Cohort z-scores, one row per gene.
+        :param values: The patient's z-score of each gene, aligned with the reference rows.
+        :return: Dictionary of arrays diseasePercentile, diseaseZScore and diseaseKIQR.
+        """
+        present = ~np.isnan(reference)
+        cohortSize = present.sum(axis=1)
+        if present.all():
+            mean = reference.mean(axis=1, dtype=np.float64)
+            std = reference.std(axis=1, dtype=np.float64)
+            q1, median, q3 = np.percentile(reference, [25, 50, 75], axis=1)
+        else:
+            mean = np.nanmean(reference, axis=1, dtype=np.float64)
+            std = np.nanstd(reference, axis=1, dtype=np.float64)
+            q1, median, q3 = np.nanpercentile(reference, [25, 50, 75], axis=1)
+
+        column = values[:, None]
+        below = (reference < column).sum(axis=1)
+        ties = (reference == column).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Percentile rank with ties counted half, as scipy.stats.percentileofscore(kind='mean')
+            percentile = 100.0 * (below + 0.5 * ties) / cohortSize
+            zscore = (values - mean) / std
+            kiqr = (values - median) / (q3 - q1)
+        return {'diseasePercentile': percentile, 'diseaseZScore': zscore, 'diseaseKIQR': kiqr}
+
+    def scoreMatchedGenes(self, reference, rows, values):
+        """
+        Score each value against its row of the reference, see scoreGenes, scoreBlockRows reference rows at a time.
+        The genes are taken in reference order, so where consecutive reference rows are scored, as for a biopsy
+        with most of the reference genes in any order, the block is a slice of a memory mapped reference and is read
+        in place.  Only blocks with gaps are copied.
+
+        :param rows: Reference row of each value.
+        :return: Dictionary of arrays like scoreGenes, aligned with values.
+        """
+        order = np.argsort(rows, kind='stable')
+        sortedRows = rows[order]
+        scores = {}
+        for start in range(0, len(rows), scoreBlockRows):
+            block = order[start:start + scoreBlockRows]
+            blockRows = sortedRows[start:start + scoreBlockRows]
+            first, last = blockRows[0], blockRows[-1]
+            if last - first + 1 == len(blockRows):
+                blockReference = reference[first:last + 1]
+            else:
+                blockReference = reference[blockRows]
+            for name, score in self.scoreGenes(blockReference, values[block]).items():
+                if name not in scores:
+                    scores[name] = np.empty(len(rows), dtype=score.dtype)
+                scores[name][block] = score
+        if not scores:
+            scores = self.scoreGenes(reference[:0], values)
+        return scores
+
+    def callOutliers(self, scores):
+        """
+        :return: Boolean arrays (increased, reduced) marking the outlier genes.
+        """
+        percentile, zscore = scores['diseasePercentile'], scores['diseaseZScore']
+        with np.errstate(invalid='ignore'):
+            increased = (zscore >= self.zscoreThreshold) & (percentile >= self.percentileThreshold)
+            reduced = (zscore <= -self.zscoreThreshold) & (percentile <= 100.0 - self.percentileThreshold)
+        return increased, reduced
+
+    def expressionVariants(self):
+        """
+        Yield an expressionVariants record for each outlier gene, in the order of the biopsy z-scores file.
+        """
+        referenceGenes, reference = self.loadReference()
+        genes, values = self.loadBiopsy()
+        rows = joinGenes(referenceGenes, genes)
+        matched = np.flatnonzero(rows >= 0)
+        if len(matched) < len(genes):
+            print(f"{len(genes) - len(matched)} of {len(genes)} genes in {self.biopsyZscores} are not in "
+                  f"{self.diseaseZscores} and are left out of the expression analysis", file=sys.stderr)
+
+        values = values[matched]
+        scores = self.scoreMatchedGenes(reference, rows[matched], values)
+        increased, reduced = self.callOutliers(scores)
+        outliers = np.flatnonzero(increased | reduced)
+
+        # Only the outliers are turned into Python objects
+        columns = {name: scoreList(score[outliers]) for name, score in scores.items()}
+        columns['biopsySiteZScore'] = scoreList(values[outliers])
+        isIncreased = increased[outliers].tolist()
+        for index, row in enumerate(matched[outliers].tolist()):
+            record = {
+                'gene': genes[row],
+                'kbCategory': 'increased expression' if isIncreased[index] else 'reduced expression',
+                'expressionState': 'outlier_high' if isIncreased[index] else 'outlier_low',
+            }
+            for name, column in columns.items():
+                record[name] = column[index]
+            yield record
+
+    def readZscoreFiles(self, writer, columnarWriter=None):
+        """
+        Write the expressionVariants section.
+
+        :param writer: JsonWriter of the output document, see jsonWriter.
+        :param columnarWriter: Optional columnarOutput.ColumnarWriter the records are also written to.
+        """
+        records = self.expressionVariants()
+        if columnarWriter is not None:
+            records = columnarWriter.tee(records)
+        writer.beginArray('expressionVariants')
+        for record in records:
+            writer.writeValue(record)
+        writer.endArray()
@@ -1,10 +1,24 @@
+import os
 import sys
-from tempfile import NamedTemporaryFile
+from contextlib import nullcontext
+from functools import partial
 import jsonConstants
+from jsonConstants import unrankedConsequence
 import jsonStructure
-import ijson
+from jsonInput import selectIjsonBackend, openJsonInput, ChunkStream
+from jsonPruning import PrunedJsonStream, mappedKeys
+from jsonRegions import isIndexable
+from jsonWriter import JsonWriter
+from nirvanaMetrics import CountingReader
+from nirvanaRecords import Position, Transcript
 from decimal import Decimal
 
+class StopParsing(Exception):
+    """
+    Raised by a handler once nothing further in the input is mapped.
+    """
+    pass
+
 class NirvanaJsonAdapter:
     """
     Adapter class for Nirvana Pori import.
@@ -21,8 +35,24 @@ class NirvanaJsonAdapter:
         self.context = {}
         self.simpleMapping = {}
         self.complex_handlers = {}
-        self.passFilter = jsonConstants.passFilter
-        
+        self.eventDispatch = {} # prefix -> { event: handler }, compiled from the two mappings above
+        self.passFilters = {jsonConstants.passFilter} # A position is converted if any of its filters is one of these
+        self.rejectionCounts = {'positions': 0, 'bytes': 0, 'outsideRegions': 0} # Positions skipped early for failing the filters or the regions
+        self.parser = None
+        self.ijsonBackend = None # Chosen lazily so the selection is only reported when a file is read
+        self.decompressionThreads = None
+        self.memoryBudget = jsonConstants.defaultMemoryBudget
+        self.selector = None
+        self.consequenceRanks = {} # consequence -> rank, set by the section adapters
+        self.pruneSubtrees = True
+        self.writer = None
+        self.prettyOutput = False
+        self.metrics = None # SectionMetrics when metrics are collected, see nirvanaMetrics
+        self.incremental = None # IncrementalState of an incremental conversion, see jsonIncremental
+        self.regionQuery = None # jsonRegions.RegionQuery restricting the positions that are read
+        self.geneFilter = None # Genes a record must be for to be output, None for every gene
+        self.columnarWriter = None # columnarOutput.ColumnarWriter the selected records are also written to
+
     def printOutputHeader(self, patientID, diseaseName, projectName, template="genomic"):
         """
         Print the header for the output JSON.
@@ -32,17 +62,40 @@ class NirvanaJsonAdapter:
         :param projectName: Project name.
         :param template: Template for the Pori import. See https://bcgsc.github.io/pori/ipr/templates/".
         """
-        print("{", file=self.output_handle)
-        print(f'\t"patientId": "{patientID}",', file=self.output_handle)
-        print(f'\t"kbDiseaseMatch": "{diseaseName}",', file=self.output_handle)
-        print(f'\t"project": "{projectName}",', file=self.output_handle)
-        print(f'\t"template": "{template}",', file=self.output_handle)
+        writer = self.getWriter()
+        writer.beginObject()
+        writer.writeValue(patientID, 'patientId')
+        writer.writeValue(diseaseName, 'kbDiseaseMatch')
+        writer.writeValue(projectName, 'project')
+        writer.writeValue(template, 'template')
 
     def printOutputFooter(self):
         """
         Print the footer for the output JSON.
         """
-        print("}", file=self.output_handle)
+        self.writer.endObject()
+        self.writer.flush()
+
+    def setWriter(self, writer):
+        """
+        Set the JSON writer the output goes through, eg to share one writer between the header and the sections.
+        """
+        self.writer = writer
+
+    def setPrettyOutput(self, pretty):
+        """
+        Set whether a writer created by this adapter indents its output, see jsonWriter.
+        """
+        self.prettyOutput = pretty
+
+    def getWriter(self):
+        """
+        Get the JSON writer, creating one on the output handle if none was set.
+        An adapter on its own writes its section as a member of an object opened by someone else.
+        """
+        if self.writer is None:
+            self.writer = JsonWriter( self.getOutputHandle(), self.prettyOutput, depth=1 )
+        return self.writer
         
     def setOutputHandle( self, handle ):
         """
@@ -55,29 +108,235 @@ class NirvanaJsonAdapter:
         else:
             self.output_handle = sys.stdout
             
-    # Function to process events
-    def processEvents(self, prefix, event, value, ):
-        key = (prefix, event)
-        path = [x for x in prefix.split('.') if x != 'item'] # Remove all 'item' from the path to make parsing easier
+    def setIjsonBackend(self, name=None):
+        """
+        Set the ijson backend used to parse input files.
+
+        :param name: Backend name, eg 'yajl2_c'.  If None the fastest available backend is used.
+        """
+        self.ijsonBackend = selectIjsonBackend(name)
+
+    def setDecompressionThreads(self, threads):
+        """
+        Set the number of threads used to inflate bgzip compressed input.  None uses one per CPU.
+        """
+        self.decompressionThreads = threads
+
+    def setMemoryBudget(self, memoryBudget):
+        """
+        Set how many bytes of selected records may be held in memory before they spill to disk.  None means no limit.
+        """
+        self.memoryBudget = memoryBudget
+
+    def setPassFilters(self, passFilters):
+        """
+        Set the filter values that let a position through, eg ['PASS'].  Positions with none of them are skipped.
+        """
+        self.passFilters = set(passFilters)
+
+    def setConsequenceRanks(self, consequenceRanks):
+        """
+        Set the consequence rank map used to pick the best transcript, see jsonConstants.buildRankMap.
+        """
+        self.consequenceRanks = consequenceRanks
+
+    def setPruneSubtrees(self, pruneSubtrees):
+        """
+        Set whether unmapped objects and arrays are skipped before they reach the parser, see jsonPruning.
+        """
+        self.pruneSubtrees = pruneSubtrees
+
+    def setRegionQuery(self, query):
+        """
+        Only convert the positions matching a jsonRegions.RegionQuery, and with genes in the query only output
+        records for those genes.
+        Indexable input is read through the query, so only the blocks of matching positions are read.  Other input
+        is streamed in full and positions outside the regions are skipped as soon as their extent is known, before
+        their samples, variants and transcripts are built.
+        """
+        self.regionQuery = query
+        self.geneFilter = query.genes
+        if query.regions is not None:
+            self.mapPositionExtent()
+
+    def mapPositionExtent(self):
+        """
+        Work out the extent of every position as soon as it is parsed, see handlePositionExtent.
+        """
+        # The extent comes from position and svEnd, which come before refAllele in every Nirvana position
+        if ('positions.item.position', 'number') not in self.simpleMapping:
+            self.addSimpleMapping(('positions.item.position', 'number'), 'start')
+        if ('positions.item.svEnd', 'number') not in self.simpleMapping:
+            self.addSimpleMapping(('positions.item.svEnd', 'number'), 'end')
+        self.addComplexMapping(('positions.item.refAllele', 'string'), self.handlePositionExtent)
+
+    def handlePositionExtent(self, refAllele):
+        """
+        Once a position's extent is known, keep it for the incremental state and skip the rest of a position
+        outside the regions.
+        The extent runs to svEnd for structural variants, so a CNV spanning a region is kept even without a
+        breakpoint in it, and to the end of the reference allele for other variants.
+        """
+        position = self.context['positions'][0]
+        if position.chromosome is None or position.start is None:
+            return
+        end = position.end if position.end is not None else position.start + len(refAllele) - 1
+        position.extentEnd = max(end, position.start)
+        if not self.outsideRegions(position.chromosome, position.start, position.extentEnd):
+            return
+        position.fingerprint = None # Not converted, so not part of an incremental state
+        self.skipPosition()
+        self.rejectionCounts['outsideRegions'] += 1
+
+    def outsideRegions(self, chromosome, start, end):
+        """
+        Check if an extent is outside the regions of the region query, False when there are no regions.
+        """
+        query = self.regionQuery
+        return query is not None and query.regions is not None and not query.overlaps(chromosome, start, end)
+
+    def setColumnarWriter(self, columnarWriter):
+        """
+        Also write the selected records to a columnarOutput.ColumnarWriter, in the same pass as the JSON output.
+        """
+        self.columnarWriter = columnarWriter
+
+    def setIncrementalState(self, state):
+        """
+        Convert incrementally, reusing the records of positions that are unchanged since the conversion that
+        wrote the state, a jsonIncremental.IncrementalState.
+        """
+        self.incremental = state
+        self.addSimpleMapping(('positions.item._fingerprint', 'string'), 'fingerprint')
+        self.addComplexMapping(('positions.item._reuse', 'string'), self.handleReusedPosition)
+        # The extent is kept with each record, so the regions of a later conversion can be applied to reused positions
+        self.mapPositionExtent()
+
+    def handleReusedPosition(self, fingerprint):
+        """
+        Emit the record an unchanged position had in the previous conversion, in its place in the input,
+        unless the position is outside the regions.
+        """
+        self.countMetric( 'positionsReused' )
+        extent, record = self.incremental.reuse( fingerprint )
+        if record is None:
+            return
+        if extent is not None and self.outsideRegions( *extent ):
+            self.rejectionCounts['outsideRegions'] += 1
+            return
+        self.emitRecord( record )
+
+    def dispatchEvents(self, parser):
+        """
+        Run every (prefix, event, value) from the parser through the compiled dispatcher.
+        This is the hot loop, so lookups are bound locally and unmapped prefixes cost a single dict miss.
+        """
+        lookup = self.eventDispatch.get
+        parser = iter(parser)
+        if self.metrics is not None:
+            parser = self.metrics.meterEvents(parser)
+        self.parser = parser # Handlers may skip ahead on the same iterator, metered like the rest
+        try:
+            for prefix, event, value in parser:
+                handlers = lookup(prefix)
+                if handlers is not None:
+                    handler = handlers.get(event)
+                    if handler is not None:
+                        handler(value)
+        except StopParsing:
+            pass
+        finally:
+            if self.metrics is not None:
+                parser.close()
+
+    def stopParsing(self, value):
+        raise StopParsing()
+
+    def passesFilters(self, position):
+        """
+        Check if any of the position's filters is one of the pass filters.
+        """
+        return any(value in self.passFilters for value in position.filters)
+
+    def handleEndOfFilters(self, value):
+        """
+        Once a position's filters are known, skip the rest of a position that won't be converted
+        instead of building its samples, variants and transcripts.
+        """
+        position = self.context['positions'][0]
+        if self.passesFilters(position):
+            return
+        self.skipPosition()
+        self.rejectionCounts['positions'] += 1
+
+    def skipPosition(self):
+        """
+        Skip the parser past the end of the current position and start a new one.
+        """
+        for prefix, event, value in self.parser:
+            if event == 'end_map' and prefix == 'positions.item':
+                break
+        self.resetPosition()
+
+    def rejectsEarly(self):
+        """
+        Check if positions can be rejected on their filters before they are complete, ie the filters are mapped.
+        """
+        return ('positions.item.filters.item', 'string') in self.simpleMapping
+
+    def printRejectionSummary(self):
+        counts = self.rejectionCounts
+        if counts['outsideRegions']:
+            print(f"Skipped {counts['outsideRegions']} positions outside the regions", file=sys.stderr)
+        if not counts['positions']:
+            return
+        message = f"Skipped {counts['positions']} positions without a pass filter"
+        if counts['bytes']:
+            message += f", {counts['bytes'] / 1e6:.1f} MB of them never parsed"
+        print(message, file=sys.stderr)
+
+    def stopAfterPositions(self):
+        """
+        When only the positions array is mapped, stop parsing at its end instead of reading the genes section.
+        """
+        key = ('positions', 'end_array')
+        if key in self.complex_handlers or key in self.simpleMapping:
+            return
+        if all(prefix == 'positions' or prefix.startswith('positions.') for prefix in self.eventDispatch):
+            self.addComplexMapping(key, self.stopParsing)
+
+    def compileDispatch(self, key):
+        """
+        Rebuild the dispatcher entry for a (prefix, event) key.
+        Simple mappings take precedence over complex handlers for the same key.
+        The container path is computed here once instead of on every event.
+        """
+        prefix, event = key
         if key in self.simpleMapping:
-            self.handleMapping(path, value)
-        elif key in self.complex_handlers:
-            self.complex_handlers[key](value)
+            path = [x for x in prefix.split('.') if x != 'item'] # Remove all 'item' from the path to make parsing easier
+            path[-1] = self.simpleMapping[key] # The record field is named by the mapping
+            handler = partial(self.handleMapping, path)
+        else:
+            handler = self.complex_handlers[key]
+        self.eventDispatch.setdefault(prefix, {})[event] = handler
             
 
     def handleMapping(self, path, value):
-        pathEnd = path[-1]
-        container = self.ensureContainerExists( path[:-1] )
+        """
+        Store a value on the record the path points to.
+        path is the container path followed by the record field, eg ['positions', 'variants', 'transcripts', 'gene'].
+        List fields collect every value, other fields are set.
+        """
+        container = self.context[path[0]][-1]
+        for part in path[1:-1]:
+            container = getattr(container, part)[-1]
         if isinstance(value, Decimal):
             value = str(value)
-        if pathEnd in container: # Check if the key already exists in the container.
-            # This is possibly an array item if the item already exists.  Convert it if not already an array.
-            if not isinstance(container.get(pathEnd), list):
-                oldItem = container.pop(pathEnd)
-                container[pathEnd] = [ oldItem ]
-            container[pathEnd].append( value )
+        current = getattr(container, path[-1])
+        if isinstance(current, list):
+            current.append( value )
         else:
-            container[pathEnd] = value
+            setattr(container, path[-1], value)
             
     def addSimpleMapping(self, key, value):
         """
@@ -85,11 +344,12 @@ class NirvanaJsonAdapter:
         This is used for key-value pairs that do not require complex handling.
         
         :param key: The JSON event to look for paired with the type. eg ('positions.item.chromosome', 'string')
-        :param value: The name that will be associated with the key.  For simple mappings this 
-        will generally be the name you want to use in the output JSON.
+        :param value: The name that will be associated with the key.  This is the field of the record
+        (see nirvanaRecords) the value is stored in.
         """
         # Can't Serialize Decimal types in JSON, so convert them to string.
         self.simpleMapping[key] = value
+        self.compileDispatch(key)
         
     def addComplexMapping(self, key, handler):
         """
@@ -101,57 +361,114 @@ class NirvanaJsonAdapter:
         :param handler: The function that will handle the complex event.
         """
         self.complex_handlers[key] = handler
+        self.compileDispatch(key)
 
-    def ensureContainerExists(self, path) -> dict:
+    def getContainer(self, path):
         """
-        Ensure that the container for the given path exists in the context.
-        If it does not exist, create it as an empty dictionary.
-        """           
-        container = self.context
-        for part in path:
-            if part not in container:
-                container[part] = [{}]
-            container = container[part][-1]
+        Get the record at the end of the given path, following the last item of every list on the way.
+        eg ['positions', 'variants'] is the current variant of the current position.
+        """
+        container = self.context[path[0]][-1]
+        for part in path[1:]:
+            container = getattr(container, part)[-1]
         return container
 
-    def handleSimpleMapping(self, key, value):
-        collection = key[0].split('.')[-3]
-        if collection not in self.context:
-            self.context[collection] = {}
-        collectionMap = self.context[collection]
-        collectionMap.update( {key[0].split('.')[-1]:  value})
-        self.context[collection] = collectionMap
+    def resetPosition(self):
+        """
+        Start a new, empty position record.
+        """
+        if self.incremental is not None and self.context.get('positions'):
+            fingerprint = self.context['positions'][0].fingerprint
+            if fingerprint is not None and fingerprint not in self.incremental.current:
+                self.incremental.record( fingerprint, None ) # Finished without a record
+        self.context['positions'] = [Position()]
 
-    def printComma( self ):
+    def emitRecord( self, record ):
         """
-        Print a comma if the iterator is greater than 0.
-        This is used to separate JSON objects in an array.
+        Hand a finished output record to the per gene selection of the current section.
         """
-        iterator = self.context.get('iterator', 0)
-        if iterator > 0:
-            print(",", end=' ', file=self.output_handle)
-        self.context['iterator'] = iterator + 1
-    
-    def addArrayToContext(self, path):
-        jsonStructure.addArrayToContext(self.context, path)
+        self.countMetric( 'positionsEmitted' )
+        if self.incremental is not None:
+            position = self.context['positions'][0]
+            if position.fingerprint is not None:
+                extent = (position.chromosome, position.start, position.extentEnd) if position.extentEnd is not None else None
+                self.incremental.record( position.fingerprint, record, extent )
+        if self.geneFilter is not None and record['gene'] not in self.geneFilter:
+            return
+        self.selector.offer( record )
 
-    def getBestConsequence(self, consequences, consequencePriorityList):
+    def setMetrics(self, metrics):
         """
-        Get the best consequence from the list of transcript events.
+        Collect stage timings and counters for this adapter's section in metrics, a nirvanaMetrics.SectionMetrics.
+        The per position work is timed by wrapping it, so nothing is added to the calls when metrics are off.
         """
-        bestRank = len(consequencePriorityList)
-        indexOfBestRank = -1
-        index = 0
-        for event in consequences:
-            #print( "Event: " + str(event), file=sys.stderr )
-            
-            if event in consequencePriorityList:
-                rank = consequencePriorityList.index( event )
-                if rank < bestRank:
-                    bestRank = rank
-                    indexOfBestRank = index
-            index+=1
-        return indexOfBestRank
+        self.metrics = metrics
+        self.massagePosition = metrics.timed( 'massage', self.massagePosition )
+        self.emitRecord = metrics.timed( 'select', self.emitRecord )
+
+    def countMetric(self, name, amount=1):
+        if self.metrics is not None:
+            self.metrics.count( name, amount )
+
+    def stage(self, name):
+        """
+        Context manager timing a stage of the conversion when metrics are collected.
+        """
+        return self.metrics.stage( name ) if self.metrics is not None else nullcontext()
+
+    def recordSectionMetrics(self):
+        """
+        Copy the counts kept outside the metrics into them once the section is done.
+        """
+        if self.metrics is not None:
+            self.metrics.count( 'positionsRejected', self.rejectionCounts['positions'] )
+            self.metrics.count( 'bytesSkipped', self.rejectionCounts['bytes'] )
+            self.metrics.count( 'positionsOutsideRegions', self.rejectionCounts['outsideRegions'] )
+
+    def addRecordToContext(self, path, recordType):
+        """
+        Append a new record to the list field at the end of path, eg a new Variant to the current position's variants.
+        """
+        getattr(self.getContainer(path[:-1]), path[-1]).append(recordType())
+
+    def handleTranscriptConsequence(self, value):
+        """
+        Add a consequence to the current transcript and rank it straight away,
+        so picking the best transcript later only compares integers.
+        """
+        transcript = self.getContainer(['positions', 'variants', 'transcripts'])
+        transcript.consequence.append(value)
+        rank = self.consequenceRanks.get(value, unrankedConsequence)
+        if rank < transcript.consequenceRank:
+            transcript.consequenceRank = rank
+
+    def getBestTranscript(self, transcripts):
+        """
+        Get the best transcript from the list of transcripts.
+        The best transcript is the one that is canonical and has the lowest consequence rank
+        TODO: Check if the best transcript should also be a completeOverlap transcript.
+        """
+        if not transcripts:
+            return Transcript()
+        
+        best = None
+        bestRank = unrankedConsequence
+        for transcript in transcripts:
+            rank = transcript.consequenceRank
+            bestCanonical = best.isCanonical if best is not None else False
+            # Check for the canonical transcript first.  This should be one of the best transcripts to use.
+            # If this transcript is canonical and the best one is not, then we should use this one.
+            if transcript.isCanonical and not bestCanonical: 
+                bestRank = rank
+                best = transcript
+            elif rank < bestRank: # standard checking for best ranking
+                bestRank = rank
+                best = transcript
+            elif rank == bestRank and transcript.source == 'RefSeq': # This can be an elif. Check if the source is our preferred source
+                bestRank = rank
+                best = transcript
+        
+        return best if best is not None else transcripts[-1]
     
     def getOutputHandle(self):
         return self.output_handle if hasattr(self, 'output_handle') else sys.stdout
@@ -160,28 +477,89 @@ class NirvanaJsonAdapter:
         pass
     
     def readJsonFile(self, jsonFile ):
+        # Read the JSON file
+        self.printHeader()
+        self.selectRecords( jsonFile )
+
+        with self.stage( 'write' ):
+            self.printSelectedEntries()
+        self.printRejectionSummary()
+        self.recordSectionMetrics()
+
+    def iterSelectedRecords(self, jsonFile):
+        """
+        Parse a file and yield the selected record of every gene as a dictionary, without writing anything.
+        The selection needs the whole file, so it is parsed when the first record is asked for.  The records are
+        yielded one at a time after that, read back from the spill file if the memory budget was exceeded.
+        """
+        try:
+            self.selectRecords( jsonFile )
+            self.printRejectionSummary()
+            self.recordSectionMetrics()
+            yield from self.selector.selectedEntries()
+        finally:
+            if self.selector is not None:
+                self.selector.close()
+
+    def selectRecords(self, jsonFile):
+        """
+        1st pass over a file, see parseJsonStream.
+        """
+        self.countMetric( 'inputBytes', os.path.getsize( jsonFile ) )
+        if self.regionQuery is not None and isIndexable( jsonFile ):
+            opened = self.regionQuery.open( jsonFile )
+        else:
+            opened = openJsonInput( jsonFile, self.decompressionThreads )
+        with self.stage( 'parse' ), opened as f:
+            self.parseJsonStream( f )
+
+    def parseJsonStream(self, f):
+        """
+        1st pass: parse an open binary stream, records go straight from the parser into the per gene selection.
+        """
         self.iterator= 0
-        self.context['positions'] = [{}]
+        self.resetPosition()
         
-        originalOutputHandle = self.getOutputHandle()
-        # Read the JSON file
-        with open( jsonFile, 'r') as f:
-            parser = ijson.parse( f )
-            #position = None
-            self.printHeader()
-            
-            with NamedTemporaryFile( mode='w+', delete=True) as tempfile:
-                self.setOutputHandle( tempfile )
-                print( "[", file=tempfile )
-                for prefix, event, value in parser:
-                    self.processEvents( prefix, event, value )
-                print( "]", file=tempfile )
-                
-                
-                # Go back to the start of the temporary file and read it for the 2nd pass.
-                tempfile.seek(0)
-                self.setOutputHandle( originalOutputHandle ) # Not sure if this is needed
-                jsonStructure.perform2ndPass( tempfile, originalOutputHandle )
-                
-                tempfile.close()
-                
\ No newline at end of file
+        if self.ijsonBackend is None:
+            self.setIjsonBackend()
+        self.stopAfterPositions()
+        rejectsEarly = self.rejectsEarly()
+        if rejectsEarly:
+            self.addComplexMapping( ('positions.item.filters', 'end_array'), self.handleEndOfFilters )
+        if self.metrics is not None:
+            f = CountingReader( f, self.metrics, 'bytesDecompressed' )
+        if self.pruneSubtrees:
+            f = PrunedJsonStream( f, mappedKeys( self.eventDispatch ), self.passFilters if rejectsEarly else None, self.rejectionCounts )
+        if self.incremental is not None:
+            f = ChunkStream( self.incremental.fingerprintedChunks( f ) )
+        if self.metrics is not None:
+            f = CountingReader( f, self.metrics, 'bytesParsed' )
+        parser = self.ijsonBackend.parse( f )
+        self.selector = jsonStructure.GeneSelector( self.memoryBudget )
+        self.dispatchEvents( parser )
+
+    def printSelectedEntries(self):
+        """
+        2nd pass: print the selected entry for every gene.
+        """
+        self.countMetric( 'genesSelected', len(self.selector) )
+        records = self.selector.selectedEntries()
+        if self.columnarWriter is not None:
+            records = self.columnarWriter.tee( records )
+        try:
+            self.writeRecords( records )
+        finally:
+            self.selector.close()
+            self.selector = None
+
+    def writeRecords(self, records):
+        """
+        Write records as the items of the section's array, which printHeader opened, and close the array.
+        """
+        writer = self.getWriter()
+        written = writer.tell()
+        for entry in records:
+            writer.writeValue( entry )
+        writer.endArray()
+        writer.flush()
+        self.countMetric( 'outputCharacters', writer.tell() - written )
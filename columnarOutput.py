@@ -0,0 +1,189 @@
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError: # pyarrow is only needed for columnar output, see ColumnarWriter
+    pa = None
+
+# Columnar output of the selected records, for loading a cohort of patients into analytics tools without parsing
+# JSON.  Each section is written to its own Parquet or Feather (Arrow IPC) file, with a fixed schema per section so
+# the files of every patient can be queried together, eg with openCohort.
+# Records are turned into Arrow record batches of a fixed number of rows as they are written out, so memory only
+# holds one batch whatever the size of the section.
+
+formatExtensions = {'parquet': 'parquet', 'feather': 'feather'}
+defaultBatchSize = 65536
+
+# Columns of each section as (name, kind).  Values the JSON output writes either as one value or as a list, eg
+# filters, are always lists here.  Decimal values Nirvana reports, which the JSON output keeps as strings, are
+# floats so they can be compared and aggregated.
+sectionColumns = {
+    'copyVariants': [
+        ('patientId', 'string'), ('chromosome', 'string'), ('position', 'int'), ('svEnd', 'int'),
+        ('filters', 'strings'), ('chromosomeBand', 'string'), ('gene', 'string'), ('transcript', 'string'),
+        ('source', 'string'), ('kbCategory', 'string'), ('lohState', 'string'), ('copyChange', 'int'),
+    ],
+    'smallMutations': [
+        ('patientId', 'string'), ('chromosome', 'string'), ('filters', 'strings'), ('gene', 'string'),
+        ('source', 'string'), ('isCanonical', 'bool'), ('transcript', 'string'), ('hgvsProtein', 'string'),
+        ('hgvsCds', 'string'), ('proteinChange', 'string'), ('startPosition', 'int'), ('endPosition', 'int'),
+        ('hgvsg', 'string'), ('variantType', 'string'), ('phylopScore', 'float'), ('vid', 'string'),
+        ('refSeq', 'string'), ('altSeq', 'string'), ('zygosity', 'string'), ('variantFrequencies', 'floats'),
+        ('alleleDepths', 'ints'), ('totalDepth', 'int'), ('somaticQuality', 'float'),
+    ],
+    'expressionVariants': [
+        ('patientId', 'string'), ('gene', 'string'), ('kbCategory', 'string'), ('expressionState', 'string'),
+        ('diseasePercentile', 'float'), ('diseaseZScore', 'float'), ('diseaseKIQR', 'float'),
+        ('biopsySiteZScore', 'float'),
+    ],
+}
+
+def requirePyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for columnar output, install it with: pip install pyarrow")
+
+def arrowType(kind):
+    return {
+        'string': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(),
+        'strings': pa.list_(pa.string()), 'ints': pa.list_(pa.int64()), 'floats': pa.list_(pa.float64()),
+    }[kind]
+
+def sectionSchema(name):
+    """
+    Arrow schema of a section, eg 'smallMutations'.
+    """
+    requirePyarrow()
+    return pa.schema([(column, arrowType(kind)) for column, kind in sectionColumns[name]])
+
+def toFloat(value):
+    return float(value) if value is not None else None
+
+def toInt(value):
+    return int(value) if value is not None else None
+
+def columnValue(kind, value):
+    """
+    Convert a record value to what the column of the given kind holds.
+    """
+    if value is None:
+        return None
+    if kind == 'float':
+        return float(value)
+    if kind in ('strings', 'ints', 'floats'):
+        values = value if isinstance(value, list) else [value]
+        if kind == 'floats':
+            return [toFloat(item) for item in values]
+        if kind == 'ints':
+            return [toInt(item) for item in values]
+        return values
+    return value
+
+def sectionFileName(outputFile, name, columnarFormat):
+    """
+    File a section is written to, next to the JSON output, eg patient.json.smallMutations.parquet.
+    """
+    return f"{outputFile}.{name}.{formatExtensions[columnarFormat]}"
+
+class ColumnarWriter:
+    """
+    Writes the records of a section to a Parquet or Feather file in record batches of batchSize rows.
+    The file is written next to its final name and moved into place by close, so readers never see half a file.
+    """
+
+    def __init__(self, path, name, columnarFormat='parquet', batchSize=defaultBatchSize, constants=None):
+        """
+        :param name: Section name, one of sectionColumns, eg 'copyVariants'.
+        :param columnarFormat: 'parquet', zstd compressed, or 'feather', uncompressed so it can be memory mapped.
+        :param constants: Values of columns that are the same for every record, eg {'patientId': 'P1'}.
+        """
+        requirePyarrow()
+        if columnarFormat not in formatExtensions:
+            raise ValueError(f"Unknown columnar format {columnarFormat}, use one of: {', '.join(formatExtensions)}")
+        self.path = path
+        self.name = name
+        self.columnarFormat = columnarFormat
+        self.batchSize = batchSize
+        self.constants = constants or {}
+        self.schema = sectionSchema(name)
+        self.columns = sectionColumns[name]
+        self.known = {column for column, kind in self.columns}
+        self.pending = {column: [] for column, kind in self.columns}
+        self.rows = 0
+        self.written = 0
+        self.partialFile = path + '.partial'
+        if columnarFormat == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.partialFile, self.schema, compression='zstd')
+        else:
+            self.writer = pyarrow.ipc.new_file(self.partialFile, self.schema)
+
+    def add(self, record):
+        """
+        Add a record, writing out a batch every batchSize records.
+
+        :raises ValueError: If the record has a field the section's columns don't, so no value is silently dropped.
+        """
+        unknown = record.keys() - self.known
+        if unknown:
+            raise ValueError(f"{self.name} records have fields without a column: {', '.join(sorted(unknown))}")
+        for column, kind in self.columns:
+            value = self.constants[column] if column in self.constants else record.get(column)
+            self.pending[column].append(columnValue(kind, value))
+        self.rows += 1
+        if self.rows >= self.batchSize:
+            self.writeBatch()
+
+    def tee(self, records):
+        """
+        Yield the records while adding them, so the columnar file is written in the same pass as the JSON output.
+        """
+        for record in records:
+            self.add(record)
+            yield record
+
+    def writeBatch(self):
+        if not self.rows:
+            return
+        arrays = [pa.array(self.pending[column], type=self.schema.field(column).type) for column, kind in self.columns]
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.written += self.rows
+        self.pending = {column: [] for column, kind in self.columns}
+        self.rows = 0
+
+    def close(self):
+        """
+        Write the last batch and move the file into place.
+        """
+        self.writeBatch()
+        self.writer.close()
+        os.replace(self.partialFile, self.path)
+
+    def abort(self):
+        """
+        Drop the file after a failed conversion.
+        """
+        try:
+            self.writer.close()
+        except Exception:
+            pass # The file is removed anyway
+        if os.path.exists(self.partialFile):
+            os.remove(self.partialFile)
+
+def readColumnar(path):
+    """
+    Read a section file as an Arrow table.  Feather files are memory mapped, so the columns are not copied into memory.
+    """
+    requirePyarrow()
+    if path.endswith('.feather'):
+        return pyarrow.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return pyarrow.parquet.read_table(path, memory_map=True)
+
+def openCohort(paths, columnarFormat='parquet'):
+    """
+    Open the section files of many patients, eg every *.smallMutations.parquet, as one pyarrow.dataset.Dataset
+    for filtered and projected scans, eg openCohort(paths).to_table(filter=pyarrow.dataset.field('gene') == 'TP53').
+    """
+    requirePyarrow()
+    return pyarrow.dataset.dataset(paths, format='ipc' if columnarFormat == 'feather' else 'parquet')
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from referenceCache import fileDigest
+from jsonWriter import encoderName
+
+# Cache of converted sections, eg the copyVariants of one CNV file, so a re-run that only changes the header fields
+# splices the sections in instead of converting them again.
+# A section is keyed by the digest of its input file, the source of the modules that shape the output and the
+# settings that change the output.  The least recently used sections are evicted once the cache outgrows its size.
+
+defaultCacheSize = 4096 * 1024 * 1024
+
+# Conversion settings that change the text of a section.  Settings that only change how fast it is produced, eg
+# shards or memoryBudget, are left out so they share cache entries.
+outputSettings = ['consequenceRanks', 'passFilters', 'pretty', 'regions', 'genes']
+
+# Modules whose code decides what a section contains, including the ones that rewrite or skip input bytes before
+# the parser sees them, eg pruning, sharding, region filtering and incremental reuse.
+outputModules = ['NirvanaJsonAdapter', 'CnvAdapter', 'VcfAdapter', 'jsonStructure', 'jsonConstants',
+                 'conversionTools', 'nirvanaRecords', 'jsonWriter', 'jsonInput', 'jsonPruning', 'jsonSharding',
+                 'jsonIncremental', 'jsonRegions']
+
+adapterDigest = None
+
+def getAdapterDigest():
+    """
+    Digest of the source of outputModules, so any change to the conversion code invalidates the cache.
+    """
+    global adapterDigest
+    if adapterDigest is None:
+        digest = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for module in outputModules:
+            with open(os.path.join(directory, module + '.py'), 'rb') as f:
+                digest.update(f.read())
+        adapterDigest = digest.hexdigest()
+    return adapterDigest
+
+def inputDigest(path, cacheDirectory):
+    """
+    Digest of the content of an input file.
+    Digests are remembered by path, size and modification time, so an unchanged input is only read once.
+    """
+    stat = os.stat(path)
+    statKey = hashlib.sha1(f"{os.path.realpath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}".encode()).hexdigest()
+    digestFile = os.path.join(cacheDirectory, 'digests', statKey)
+    try:
+        with open(digestFile) as f:
+            return f.read()
+    except OSError:
+        pass
+    digest = fileDigest(path)
+    writeAtomically(digestFile, digest)
+    return digest
+
+def sectionKey(section, jsonFile, settings, cacheDirectory):
+    """
+    Cache key of a section converted from jsonFile with the given conversion settings and JSON encoder.
+    """
+    config = {name: settings.get(name) for name in outputSettings}
+    if config['passFilters'] is not None:
+        config['passFilters'] = sorted(config['passFilters'])
+    key = json.dumps([section, inputDigest(jsonFile, cacheDirectory), getAdapterDigest(), encoderName, config],
+                     sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def writeAtomically(path, text):
+    """
+    Write a file through a temporary file and a rename, so readers never see it half written.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(prefix='.writing-', dir=directory)
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def loadSection(cacheDirectory, key):
+    """
+    :return: The cached section text, or None if the section isn't cached.
+    """
+    path = os.path.join(cacheDirectory, 'sections', key)
+    try:
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        os.utime(path) # Mark it recently used
+    except OSError:
+        return None
+    return text
+
+def storeSection(cacheDirectory, key, text, maxSize=None):
+    """
+    Add a section to the cache and evict the least recently used sections over maxSize bytes.
+    """
+    writeAtomically(os.path.join(cacheDirectory, 'sections', key), text)
+    evictSections(os.path.join(cacheDirectory, 'sections'), defaultCacheSize if maxSize is None else maxSize)
+
+def evictSections(sectionDirectory, maxSize):
+    entries = []
+    for entry in os.scandir(sectionDirectory):
+        if entry.is_file() and not entry.name.startswith('.'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= maxSize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue # Evicted by another process
+        total -= size
+        print(f"Evicted {os.path.basename(path)} ({size:,} bytes) from the conversion cache", file=sys.stderr)
@@ -1,5 +1,16 @@
+import json
+import sys
+
 passFilter = 'PASS'
 
+# Bytes of selected records kept in memory per section before they spill to disk.
+defaultMemoryBudget = 512 * 1024 * 1024
+
+# A gene's expression is an outlier when its z-score against the disease cohort is at least this far from the mean
+# and its percentile in the cohort is at least this close to either end.
+expressionZscoreThreshold = 2.0
+expressionPercentileThreshold = 95.0
+
 variantConsequencePriorityList = [
     "bidirectional_gene_fusion",
     "gene_fusion",
@@ -63,6 +74,31 @@ cnvConsequencePriorityList = [
     "three_prime_duplicated_transcript"
 ]
 
+# Rank given to consequences that are not in the priority list.  Larger than any real rank.
+unrankedConsequence = 1 << 30
+
+def buildRankMap(consequencePriorityList):
+    """
+    Compile a consequence priority list into a map of interned consequence name -> rank, lower is better.
+    """
+    return {sys.intern(consequence): rank for rank, consequence in enumerate(consequencePriorityList)}
+
+variantConsequenceRank = buildRankMap(variantConsequencePriorityList)
+cnvConsequenceRank = buildRankMap(cnvConsequencePriorityList)
+
+def loadConsequencePriorities(path):
+    """
+    Load consequence priority lists from a JSON file and compile them into rank maps.
+    The file is an object with a "variantConsequencePriorityList" and/or "cnvConsequencePriorityList" array,
+    best consequence first.  A missing list keeps the built in default.
+
+    :return: (variant rank map, cnv rank map)
+    """
+    with open(path) as f:
+        priorities = json.load(f)
+    return (buildRankMap(priorities.get('variantConsequencePriorityList', variantConsequencePriorityList)),
+            buildRankMap(priorities.get('cnvConsequencePriorityList', cnvConsequencePriorityList)))
+
 """ variantTypeKBCategoryMap = dict( copy_number_loss="copy loss",
                              copy_number_gain="copy gain",
                              deletion="deep deletion",
@@ -89,4 +125,7 @@ variantTypeKBCategoryMap = dict( copy_number_loss="deep deletion",
                              inversion="amplification",
                              mobile_element_deletion="deep deletion",
                              mobile_element_insertion="amplification"
-                             )
\ No newline at end of file
+                             )
+
+# ijson backends in order of preference.  The C extension is several times faster than the pure python parser.
+ijsonBackendPreference = ['yajl2_c', 'yajl2_cffi', 'python']
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import marshal
+import os
+import sys
+from jsonInput import readBufferSize
+from jsonPruning import positionLinePattern, maxLineLength
+import conversionCache
+
+# Incremental conversion of re-annotated input.
+# Every position line is fingerprinted from its bytes as they reach the parser, ie after pruning, so annotations
+# that are never mapped don't change the fingerprint.  The fingerprint, extent and output record of every position
+# are kept in a state file after a conversion.  The next conversion replaces the lines whose fingerprint is in the state
+# with a small reuse marker, so only new or changed positions are parsed and massaged.
+
+stateFormatVersion = 2
+
+# Keys added to position lines, mapped by NirvanaJsonAdapter.setIncrementalState.
+fingerprintKey = b'_fingerprint'
+reuseKey = b'_reuse'
+
+def incrementalConfigKey(settings):
+    """
+    Key of everything besides a position's own bytes that decides its output record.
+    State kept under another key, eg by older conversion code, is not used.
+    """
+    passFilters = settings.get('passFilters')
+    config = [conversionCache.getAdapterDigest(), settings.get('consequenceRanks'),
+              sorted(passFilters) if passFilters else None, bool(settings.get('noPruning'))]
+    # Regions and genes don't change the record of a position, they only decide which positions are output, and are
+    # applied to reused positions as well, see NirvanaJsonAdapter.handleReusedPosition
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def fingerprintLine(line):
+    return hashlib.blake2b(line, digest_size=12).hexdigest()
+
+class IncrementalState:
+    """
+    The fingerprints and output records of the positions of one section, from the previous conversion
+    and from the current one.  A record is None for a position that didn't produce one.
+    Each record is kept with the position's extent, (chromosome, start, end), or None if it isn't known.
+    """
+
+    def __init__(self, path, configKey):
+        """
+        :param path: State file, read if it exists and rewritten by save.
+        :param configKey: See incrementalConfigKey.
+        """
+        self.path = path
+        self.configKey = configKey
+        self.previous = {} # fingerprint -> (extent, record)
+        self.current = {}
+        self.reused = 0
+        self.fingerprinted = 0
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = marshal.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, ValueError, TypeError) as error:
+            print(f"Ignoring unreadable incremental state {self.path}: {error}", file=sys.stderr)
+            return
+        if state.get('version') != stateFormatVersion or state.get('config') != self.configKey:
+            print(f"Ignoring incremental state {self.path}, it was written with other settings or code", file=sys.stderr)
+            return
+        self.previous = state['positions']
+
+    def save(self):
+        """
+        Replace the state file with the positions of the current conversion.
+        """
+        temporary = self.path + '.partial'
+        with open(temporary, 'wb') as f:
+            marshal.dump({'version': stateFormatVersion, 'config': self.configKey, 'positions': self.current}, f)
+        os.replace(temporary, self.path)
+
+    def reuse(self, fingerprint):
+        """
+        Carry the record of an unchanged position over to the current conversion and return it.
+
+        :return: (extent, record)
+        """
+        kept = self.current[fingerprint] = self.previous[fingerprint]
+        return kept
+
+    def record(self, fingerprint, record, extent=None):
+        self.current[fingerprint] = (extent, record)
+
+    def printSummary(self):
+        print(f"Reused {self.reused} of {self.fingerprinted} positions from the previous conversion", file=sys.stderr)
+
+    def fingerprintedChunks(self, raw, chunkSize=readBufferSize):
+        """
+        Yield the bytes of raw with a fingerprint added to every position line, or the line replaced by a reuse
+        marker if the previous conversion had the same line.
+        """
+        previous = self.previous
+        carry = b''
+        while True:
+            chunk = raw.read(chunkSize)
+            if not chunk:
+                yield carry
+                return
+            buffer = carry + chunk
+            complete = buffer.rfind(b'\n') # Only whole lines are fingerprinted, the rest waits for the next read
+            if complete <= 0:
+                if len(buffer) < maxLineLength:
+                    carry = buffer
+                    continue
+                complete = len(buffer) # Too long for a position line, pass it through unchanged
+            pieces = []
+            emitted = 0
+            for match in positionLinePattern.finditer(buffer, 0, complete + 1):
+                start = match.start() + 1
+                end = buffer.find(b'\n', start)
+                if end < 0:
+                    break
+                line = buffer[start:end]
+                trailing = b',' if line.endswith(b'},') else b''
+                if trailing:
+                    line = line[:-1]
+                elif not line.endswith(b'}'):
+                    continue
+                fingerprint = fingerprintLine(line)
+                self.fingerprinted += 1
+                pieces.append(buffer[emitted:start])
+                if fingerprint in previous:
+                    self.reused += 1
+                    pieces.append(b'{"' + reuseKey + b'":"' + fingerprint.encode() + b'"}' + trailing)
+                else:
+                    pieces.append(b'{"' + fingerprintKey + b'":"' + fingerprint.encode() + b'",' + line[1:] + trailing)
+                emitted = end
+            pieces.append(buffer[emitted:complete])
+            carry = buffer[complete:]
+            yield b''.join(pieces)
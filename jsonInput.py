@@ -0,0 +1,170 @@
+import gzip
+import io
+import os
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import ijson
+from jsonConstants import ijsonBackendPreference
+
+try:
+    import zstandard
+except ImportError: # zstd input is optional
+    zstandard = None
+
+gzipMagic = b'\x1f\x8b'
+zstdMagic = b'\x28\xb5\x2f\xfd'
+readBufferSize = 1 << 20
+
+@lru_cache(maxsize=None)
+def selectIjsonBackend(name=None):
+    """
+    Return the ijson backend module to parse with, and report the choice on stderr.
+    When no name is given the fastest available backend from ijsonBackendPreference is used.
+
+    :param name: Name of a specific backend to force, eg 'yajl2_c' or 'python'.
+    :raises ImportError: If the forced backend is not available.
+    """
+    candidates = [name] if name else ijsonBackendPreference
+    for candidate in candidates:
+        try:
+            backend = ijson.get_backend(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+        print(f"Using ijson backend: {backend.backend_name}", file=sys.stderr)
+        return backend
+    raise ImportError("No ijson backend available from: " + ", ".join(candidates))
+
+def isBgzip(header):
+    """
+    Check if a gzip member header carries the BGZF 'BC' extra subfield, which holds the compressed block size.
+    """
+    if len(header) < 18 or not header.startswith(gzipMagic) or not header[3] & 4:
+        return False
+    return header[12:14] == b'BC' and header[14:16] == b'\x02\x00'
+
+def openJsonInput(jsonFile, threads=None):
+    """
+    Open a JSON input file for parsing.
+    Files are opened in binary mode so ijson can hand the bytes straight to the parser without a decode step.
+    gzip, bgzip and zstd compressed files are detected by their magic bytes and decompressed while streaming.
+
+    :param jsonFile: Path to the JSON file, compressed or not.
+    :param threads: Number of threads used to inflate bgzip blocks.  Defaults to the number of CPUs.
+    """
+    raw = open(jsonFile, 'rb', buffering=readBufferSize)
+    header = raw.peek(18)[:18]
+    if isBgzip(header):
+        return io.BufferedReader(BgzipReader(raw, threads), buffer_size=readBufferSize)
+    if header.startswith(gzipMagic):
+        raw.close()
+        return gzip.open(jsonFile, 'rb')
+    if header.startswith(zstdMagic):
+        if zstandard is None:
+            raw.close()
+            raise ImportError(f"{jsonFile} is zstd compressed, install the 'zstandard' package to read it")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True),
+                                 buffer_size=readBufferSize)
+    return raw
+
+def inflateBgzipBlock(block):
+    """
+    Inflate one BGZF block and check it against the CRC32 and size stored in its trailer.
+    """
+    extraLength = struct.unpack_from('<H', block, 10)[0]
+    crc, size = struct.unpack_from('<II', block, len(block) - 8)
+    data = zlib.decompress(block[12 + extraLength:-8], -15)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise IOError("Corrupt bgzip block")
+    return data
+
+class BgzipReader(io.RawIOBase):
+    """
+    Streaming reader for bgzip (BGZF) files.
+    Every BGZF block is an independent deflate stream that records its own size, so blocks are read
+    sequentially and inflated in parallel on a thread pool (zlib releases the GIL while it works).
+    At most readAhead blocks are in flight, which bounds the memory used by the read-ahead buffer.
+    """
+
+    def __init__(self, raw, threads=None, readAhead=None):
+        super().__init__()
+        self.raw = raw
+        threads = threads or os.cpu_count() or 1
+        self.readAhead = readAhead or threads * 4
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = memoryview(b'')
+        self.exhausted = False
+
+    def readable(self):
+        return True
+
+    def readBlock(self):
+        """
+        Read the next raw BGZF block from the underlying file, or None at end of file.
+        """
+        header = self.raw.read(18)
+        if not header:
+            return None
+        if not isBgzip(header):
+            raise IOError("Invalid bgzip block header")
+        blockSize = struct.unpack_from('<H', header, 16)[0] + 1
+        block = header + self.raw.read(blockSize - 18)
+        if len(block) != blockSize:
+            raise IOError("Truncated bgzip block")
+        return block
+
+    def fillReadAhead(self):
+        while not self.exhausted and len(self.pending) < self.readAhead:
+            block = self.readBlock()
+            if block is None:
+                self.exhausted = True
+                break
+            self.pending.append(self.executor.submit(inflateBgzipBlock, block))
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.fillReadAhead()
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.pending.clear()
+            self.raw.close()
+        super().close()
+
+class ChunkStream(io.RawIOBase):
+    """
+    Binary stream over an iterable of byte chunks, used to hand rewritten input to the parser.
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
@@ -0,0 +1,191 @@
+import re
+from jsonInput import readBufferSize, ChunkStream
+
+# Byte-level pruning of JSON subtrees the adapters never map, eg the top level genes section or the
+# clinvar, gnomad and cosmic annotations of every variant.
+# The value of every object key that is not part of a mapped prefix and holds an object or array is
+# replaced by null before the bytes reach the parser, so the parser never builds events for it.
+# Scalar values are left alone, skipping them costs more than parsing them.
+# Only keys written as "key":[ or "key":{ are found, anything else is passed through untouched.
+
+# Where a key is followed by an object or array.  Only compact JSON, as Nirvana writes it, is pruned.
+containerValuePattern = re.compile(rb'":[\[{]')
+
+# Characters a prunable key is made of.  Between two JSON strings there is always one of , : [ {
+# so a quote followed by :[ only starts a prunable key if the bytes back to the previous quote match this.
+keyPattern = re.compile(rb'[^"\\,:\[\]{}]+')
+maxKeyLength = 256
+
+# Bytes up to the next bracket outside a string, with strings consumed whole.
+# The possessive quantifiers keep a failed match on an unterminated string at the end of the buffer linear.
+bracketFree = rb'[^"\[\]{}]*+(?:"[^"\\]*+(?:\\.[^"\\]*+)*+"[^"\[\]{}]*+)*+'
+bracketFreePattern = re.compile(bracketFree)
+
+def buildSkipPattern(depth):
+    """
+    Compile a pattern matching a whole object or array nested at most depth levels deep.
+    Deeper or incomplete values don't match and are skipped bracket by bracket instead.
+    """
+    value = rb'[\[{]' + bracketFree + rb'[\]}]'
+    for level in range(depth - 1):
+        value = rb'[\[{]' + bracketFree + rb'(?:' + value + bracketFree + rb')*+[\]}]'
+    return re.compile(value)
+
+skipPattern = buildSkipPattern(8)
+
+# Bytes kept back at the end of a buffer so a key split over two reads is still found.
+keyCarrySize = 4096
+
+def mappedKeys(prefixes):
+    """
+    Get the object keys named by a set of ijson prefixes, eg 'positions.item.filters.item' -> positions, filters.
+    """
+    keys = set()
+    for prefix in prefixes:
+        keys.update(part for part in prefix.split('.') if part and part != 'item')
+    return keys
+
+def isPrunableKey(buffer, quote, keepKeys):
+    """
+    Check if the quote at buffer[quote] closes an object key that is not in keepKeys.
+    """
+    keyStart = buffer.rfind(b'"', max(0, quote - maxKeyLength), quote)
+    if keyStart < 1 or buffer[keyStart - 1] not in b'{,':
+        return False
+    return keyPattern.fullmatch(buffer, keyStart + 1, quote) is not None and buffer[keyStart + 1:quote] not in keepKeys
+
+def prunedChunks(raw, keepKeys, chunkSize=readBufferSize):
+    """
+    Yield the bytes of raw with the object and array values of keys not in keepKeys replaced by null.
+
+    :param raw: Binary stream with the JSON input.
+    :param keepKeys: Object keys that must reach the parser, see mappedKeys.
+    """
+    keepKeys = {key.encode() for key in keepKeys}
+    search = containerValuePattern.search
+    skip = skipPattern.match
+    buffer = b''
+    emitted = 0 # buffer[:emitted] has been copied to pieces or skipped
+    searchFrom = 0
+    pieces = [] # Output is yielded once per read, so the parser isn't fed a stream of small chunks
+    eof = False
+    while True:
+        match = search(buffer, searchFrom)
+        if match is None:
+            if eof:
+                pieces.append(buffer[emitted:])
+                yield b''.join(pieces)
+                return
+            cut = max(emitted, len(buffer) - keyCarrySize)
+            pieces.append(buffer[emitted:cut])
+            yield b''.join(pieces)
+            pieces = []
+            chunk = raw.read(chunkSize)
+            eof = not chunk
+            buffer = buffer[cut:] + chunk
+            emitted = searchFrom = 0
+            continue
+
+        index = match.end() - 1
+        if not isPrunableKey(buffer, match.start(), keepKeys):
+            searchFrom = index
+            continue
+
+        pieces.append(buffer[emitted:index])
+        pieces.append(b'null')
+        skipped = skip(buffer, index)
+        if skipped is not None:
+            emitted = searchFrom = skipped.end()
+            continue
+
+        # Too deep, or not all in the buffer yet.  Skip bracket by bracket, reading on as needed.
+        # Skipped bytes are dropped straight away, so only an unterminated string is carried over.
+        yield b''.join(pieces)
+        pieces = []
+        depth = 0
+        while True:
+            end = bracketFreePattern.match(buffer, index).end()
+            if end < len(buffer) and buffer[end] in b'[]{}':
+                depth += 1 if buffer[end] in b'[{' else -1
+                index = end + 1
+                if depth == 0:
+                    break
+                continue
+            if eof:
+                # Malformed input, let the parser report it
+                yield buffer[end:]
+                return
+            chunk = raw.read(chunkSize)
+            eof = not chunk
+            buffer = buffer[end:] + chunk
+            index = 0
+        emitted = searchFrom = index
+
+# Nirvana writes one position per line, starting with its chromosome and with its filters before any nested object.
+positionLinePattern = re.compile(rb'\n\{"chromosome":')
+positionFiltersPattern = re.compile(rb'"filters":\[((?:"[^"\\]*"(?:,"[^"\\]*")*)?)\]')
+filterValuePattern = re.compile(rb'"([^"]*)"')
+maxLineLength = 16 * 1024 * 1024
+
+def isRejectedPosition(line, passFilters):
+    """
+    Check if a position line has a filters array at the top level of the position without any of passFilters.
+    Lines that can't be checked safely from their bytes, eg filters after a nested object, are never rejected.
+    """
+    match = positionFiltersPattern.search(line)
+    if match is None or b'{' in line[1:match.start()]:
+        return False
+    return not any(value in passFilters for value in filterValuePattern.findall(match.group(1)))
+
+def rejectedPositionChunks(raw, passFilters, counts, chunkSize=readBufferSize):
+    """
+    Yield the bytes of raw with every position line that fails the filters replaced by an empty object,
+    so the parser never sees the rest of the position.
+
+    :param passFilters: Filter values that let a position through, see NirvanaJsonAdapter.setPassFilters.
+    :param counts: Dictionary with 'positions' and 'bytes' counters of rejected positions, updated in place.
+    """
+    passFilters = {value.encode() for value in passFilters}
+    carry = b''
+    while True:
+        chunk = raw.read(chunkSize)
+        if not chunk:
+            yield carry
+            return
+        buffer = carry + chunk
+        complete = buffer.rfind(b'\n') # Only whole lines are checked, the rest waits for the next read
+        if complete <= 0:
+            if len(buffer) < maxLineLength:
+                carry = buffer
+                continue
+            complete = len(buffer) # Too long for a position line, pass it through unchecked
+        pieces = []
+        emitted = 0
+        for match in positionLinePattern.finditer(buffer, 0, complete + 1):
+            start = match.start() + 1
+            end = buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            trailing = b',' if line.endswith(b'},') else b''
+            if not (trailing or line.endswith(b'}')) or not isRejectedPosition(line, passFilters):
+                continue
+            pieces.append(buffer[emitted:start])
+            pieces.append(b'{}' + trailing)
+            emitted = end
+            counts['positions'] += 1
+            counts['bytes'] += len(line) - 2
+        pieces.append(buffer[emitted:complete])
+        carry = buffer[complete:]
+        yield b''.join(pieces)
+
+class PrunedJsonStream(ChunkStream):
+    """
+    Binary stream over JSON input with the subtrees of unmapped keys replaced by null, see prunedChunks.
+    With passFilters, position lines failing the filters are emptied first, see rejectedPositionChunks.
+    """
+
+    def __init__(self, raw, keepKeys, passFilters=None, rejectionCounts=None):
+        if passFilters is not None:
+            raw = ChunkStream(rejectedPositionChunks(raw, passFilters, rejectionCounts))
+        super().__init__(prunedChunks(raw, keepKeys))
@@ -0,0 +1,333 @@
+import io
+import marshal
+import os
+import re
+import struct
+import sys
+from bisect import bisect_right
+from jsonInput import gzipMagic, zstdMagic, readBufferSize, isBgzip, inflateBgzipBlock, ChunkStream
+
+# Region and gene panel queries over Nirvana JSON.
+# A byte offset index of the position lines is built on the first query of a file and kept next to it.  The index
+# splits the positions into chunks, the lines of one chromosome that start in the same block, with the range they
+# cover and the genes they mention.  A query only reads the blocks of the chunks it needs, for bgzip input these
+# are the only blocks that get inflated.  The position lines found are handed to the parser as a document of
+# their own, so everything downstream works as it does for a whole file.
+# gzip input that isn't bgzip, and zstd input, can't be read at an offset.  It is parsed in full and the adapter
+# skips the positions outside the regions while streaming, see NirvanaJsonAdapter.handlePositionExtent.
+
+indexFormatVersion = 1
+indexSuffix = '.pidx'
+plainBlockSize = 1 << 16
+
+positionStartPattern = re.compile(rb'\{"chromosome":"([^"]+)","position":(\d+)')
+svEndPattern = re.compile(rb'"svEnd":(\d+)')
+refAllelePattern = re.compile(rb'"refAllele":"([^"]*)"')
+genePattern = re.compile(rb'"hgnc":"([^"]+)"')
+
+def normalizeChromosome(chromosome):
+    """
+    Compare chromosomes without their chr prefix, BED files and Nirvana don't always agree on it.
+    """
+    return chromosome[3:] if chromosome.startswith('chr') else chromosome
+
+def readBedFile(path, withNames=False):
+    """
+    Read the intervals of a BED file.
+
+    :param withNames: Add the name column to the intervals, it has to be there.
+    :return: List of (chromosome, start, end) with 1 based inclusive coordinates, as Nirvana positions are,
+    or (chromosome, start, end, name) with names.
+    :raises ValueError: If a line doesn't have a chromosome, start and end, or a name when names are read.
+    """
+    regions = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\r\n').split('\t') if '\t' in line else line.split()
+            try:
+                region = (fields[0], int(fields[1]) + 1, int(fields[2]))
+                if withNames:
+                    region += (fields[3].strip(),)
+            except (IndexError, ValueError):
+                raise ValueError(f"{path} line {number} is not a BED interval{' with a name' if withNames else ''}: {line.strip()}") from None
+            regions.append(region)
+    return regions
+
+def readGenePanel(path):
+    """
+    Read a gene panel BED file, the intervals of the panel genes named in the name column.
+
+    :return: (regions, genes) for a RegionQuery, so positions are matched against the gene intervals, eg a CNV
+    overlapping a gene without a breakpoint in it, and only records for the panel genes are output.
+    """
+    regions = readBedFile(path, withNames=True)
+    return [region[:3] for region in regions], sorted({region[3] for region in regions})
+
+def readGeneList(genes):
+    """
+    Read a gene list given as a file with one gene per line, or as comma separated names.
+    """
+    if os.path.exists(genes):
+        with open(genes, 'r') as f:
+            return sorted({line.split()[0] for line in f if line.strip() and not line.startswith('#')})
+    return sorted({gene.strip() for gene in genes.split(',') if gene.strip()})
+
+def positionRange(line):
+    """
+    Get the chromosome and the first and last base a position line covers, or None for other lines.
+    """
+    match = positionStartPattern.match(line)
+    if match is None:
+        return None
+    start = int(match.group(2))
+    end = start
+    svEnd = svEndPattern.search(line)
+    if svEnd is not None:
+        end = max(end, int(svEnd.group(1)))
+    else:
+        refAllele = refAllelePattern.search(line)
+        if refAllele is not None:
+            end = max(end, start + len(refAllele.group(1)) - 1)
+    return match.group(1).decode(), start, end
+
+class BlockFile:
+    """
+    Random access to the blocks of an input file: bgzip blocks, or fixed size pieces of an uncompressed file.
+    Blocks are addressed by their offset in the file.
+    """
+
+    def __init__(self, jsonFile):
+        self.file = open(jsonFile, 'rb')
+        self.bgzip = isBgzip(self.file.read(18))
+        self.cached = (None, None, None) # The last block read, chunks next to each other often share one
+
+    def readBlock(self, offset):
+        """
+        :return: (uncompressed bytes of the block at offset, offset of the next block).  The bytes are empty at the end.
+        """
+        if self.cached[0] == offset:
+            return self.cached[1], self.cached[2]
+        self.file.seek(offset)
+        if self.bgzip:
+            header = self.file.read(18)
+            if not header:
+                data, following = b'', offset
+            else:
+                if not isBgzip(header):
+                    raise IOError("Invalid bgzip block header")
+                blockSize = struct.unpack_from('<H', header, 16)[0] + 1
+                data = inflateBgzipBlock(header + self.file.read(blockSize - 18))
+                following = offset + blockSize
+        else:
+            data = self.file.read(plainBlockSize)
+            following = offset + len(data)
+        self.cached = (offset, data, following)
+        return data, following
+
+    def close(self):
+        self.file.close()
+
+def isIndexable(jsonFile):
+    """
+    Check if a file can be read at block offsets, ie it is bgzip compressed or not compressed.
+    """
+    with open(jsonFile, 'rb') as f:
+        header = f.read(18)
+    return isBgzip(header) or not header.startswith((gzipMagic, zstdMagic))
+
+def buildIndex(jsonFile):
+    """
+    Scan a file once and index its position lines.
+
+    :return: Dictionary with the list of chunks [chromosome, first base, last base, block offset, offset in the block,
+    number of lines, gene ids] and the list of gene names the gene ids point to.
+    """
+    chunks = []
+    geneIds = {}
+    blocks = BlockFile(jsonFile)
+    try:
+        offset = 0
+        carry = [] # Pieces of a line that started in an earlier block
+        carryLocation = None
+        chunk = None
+        while True:
+            data, following = blocks.readBlock(offset)
+            if not data:
+                break
+            position = 0
+            while True:
+                newline = data.find(b'\n', position)
+                if newline < 0:
+                    break
+                if carry:
+                    carry.append(data[:newline])
+                    line, location = b''.join(carry), carryLocation
+                    carry = []
+                else:
+                    line, location = data[position:newline], (offset, position)
+                position = newline + 1
+
+                covered = positionRange(line)
+                if covered is None:
+                    continue
+                chromosome, start, end = covered
+                if chunk is None or chunk[0] != chromosome or chunk[3] != location[0]:
+                    chunk = [chromosome, start, end, location[0], location[1], 0, set()]
+                    chunks.append(chunk)
+                chunk[1] = min(chunk[1], start)
+                chunk[2] = max(chunk[2], end)
+                chunk[5] += 1
+                for gene in genePattern.findall(line):
+                    chunk[6].add(geneIds.setdefault(gene.decode(), len(geneIds)))
+            if position < len(data):
+                if not carry:
+                    carryLocation = (offset, position)
+                carry.append(data[position:])
+            offset = following
+    finally:
+        blocks.close()
+    for chunk in chunks:
+        chunk[6] = sorted(chunk[6])
+    return {'chunks': chunks, 'genes': list(geneIds)}
+
+def loadIndex(jsonFile):
+    """
+    Load the index of a file from next to it, building it first if it is missing or out of date.
+    If the index can't be written next to the file it is built for this run only.
+    """
+    stat = os.stat(jsonFile)
+    source = [indexFormatVersion, stat.st_size, stat.st_mtime_ns]
+    indexFile = jsonFile + indexSuffix
+    try:
+        with open(indexFile, 'rb') as f:
+            index = marshal.load(f)
+        if index.get('source') == source:
+            return index
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    print(f"Indexing the positions of {jsonFile}", file=sys.stderr)
+    index = buildIndex(jsonFile)
+    index['source'] = source
+    try:
+        with open(indexFile + '.partial', 'wb') as f:
+            marshal.dump(index, f)
+        os.replace(indexFile + '.partial', indexFile)
+    except OSError as error:
+        print(f"Could not save the index {indexFile}, it is only used for this run: {error}", file=sys.stderr)
+    return index
+
+class RegionQuery:
+    """
+    Positions overlapping any of a set of regions and/or mentioning any of a set of genes.
+    With both, a position has to match both.
+    """
+
+    def __init__(self, regions=None, genes=None):
+        """
+        :param regions: List of (chromosome, start, end), 1 based inclusive, see readBedFile.
+        :param genes: Gene names matched against the hgnc names of the transcripts, see readGeneList.
+        """
+        self.regions = None
+        if regions is not None:
+            self.regions = {} # normalized chromosome -> (starts, ends) of merged intervals sorted by start
+            intervals = {}
+            for chromosome, start, end in regions:
+                intervals.setdefault(normalizeChromosome(chromosome), []).append((start, end))
+            for chromosome, spans in intervals.items():
+                merged = []
+                for start, end in sorted(spans):
+                    if merged and start <= merged[-1][1] + 1:
+                        merged[-1][1] = max(merged[-1][1], end)
+                    else:
+                        merged.append([start, end])
+                self.regions[chromosome] = ([start for start, end in merged], [end for start, end in merged])
+        self.genes = set(genes) if genes is not None else None
+        self.geneBytes = {gene.encode() for gene in genes} if genes is not None else None
+
+    def overlaps(self, chromosome, start, end):
+        """
+        Check if start..end overlaps a region, with a binary search over the merged regions of the chromosome.
+        """
+        intervals = self.regions.get(normalizeChromosome(chromosome))
+        if intervals is None:
+            return False
+        starts, ends = intervals
+        index = bisect_right(starts, end) - 1 # Last region starting at or before end
+        return index >= 0 and ends[index] >= start
+
+    def matchesLine(self, line):
+        covered = positionRange(line)
+        if covered is None:
+            return False
+        if self.regions is not None and not self.overlaps(*covered):
+            return False
+        return self.geneBytes is None or any(gene in self.geneBytes for gene in genePattern.findall(line))
+
+    def matchesChunk(self, chunk, geneNames):
+        chromosome, start, end, blockOffset, lineOffset, lines, geneIds = chunk
+        if self.regions is not None and not self.overlaps(chromosome, start, end):
+            return False
+        return self.genes is None or any(geneNames[geneId] in self.genes for geneId in geneIds)
+
+    def indexedLines(self, jsonFile):
+        """
+        Yield the matching position lines of a file that can be read at block offsets, using its index.
+        """
+        index = loadIndex(jsonFile)
+        geneNames = index['genes']
+        selected = [chunk for chunk in index['chunks'] if self.matchesChunk(chunk, geneNames)]
+        print(f"Reading {len(selected)} of {len(index['chunks'])} position chunks of {jsonFile}", file=sys.stderr)
+        blocks = BlockFile(jsonFile)
+        try:
+            for chromosome, start, end, blockOffset, lineOffset, lines, geneIds in selected:
+                data, following = blocks.readBlock(blockOffset)
+                pieces, position = [], lineOffset
+                while lines:
+                    newline = data.find(b'\n', position)
+                    if newline < 0:
+                        pieces.append(data[position:])
+                        data, following = blocks.readBlock(following)
+                        position = 0
+                        if not data:
+                            raise IOError(f"{jsonFile} changed since it was indexed, remove {jsonFile + indexSuffix}")
+                        continue
+                    pieces.append(data[position:newline])
+                    line = b''.join(pieces)
+                    pieces, position = [], newline + 1
+                    if positionRange(line) is None:
+                        continue
+                    lines -= 1
+                    if self.matchesLine(line):
+                        yield line
+        finally:
+            blocks.close()
+
+    def documentChunks(self, jsonFile):
+        """
+        Yield a Nirvana JSON document holding only the matching positions, one per line.
+        """
+        lines = self.indexedLines(jsonFile)
+        yield b'{"positions":[\n'
+        separator = b''
+        pieces, size = [], 0
+        for line in lines:
+            if line.endswith(b','):
+                line = line[:-1]
+            pieces.append(separator + line)
+            separator = b',\n'
+            size += len(line)
+            if size >= readBufferSize:
+                yield b''.join(pieces)
+                pieces, size = [], 0
+        pieces.append(b'\n]}\n')
+        yield b''.join(pieces)
+
+    def open(self, jsonFile):
+        """
+        Open the matching positions of a file as a binary stream, in place of jsonInput.openJsonInput.
+        The file has to be indexable, see isIndexable.
+        """
+        return io.BufferedReader(ChunkStream(self.documentChunks(jsonFile)), buffer_size=readBufferSize)
@@ -0,0 +1,161 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from jsonInput import gzipMagic, zstdMagic, readBufferSize, ChunkStream
+import jsonStructure
+
+# Nirvana writes the positions array one position per line, and every position object starts with its chromosome.
+# The pre-scan relies on this layout to find position boundaries without parsing the file.
+positionsArrayStart = b'"positions":['
+positionLineStart = b'{"chromosome":'
+positionsArrayEnd = b'\n]'
+headerScanSize = 16 * 1024 * 1024
+
+def findPositionsStart(f):
+    """
+    Find the offset of the first position line, or None if the file does not have the expected layout.
+    """
+    head = f.read(headerScanSize)
+    index = head.find(positionsArrayStart)
+    if index < 0:
+        return None
+    f.seek(index + len(positionsArrayStart))
+    f.readline() # The rest of the line the array starts on
+    start = f.tell()
+    if not f.readline().startswith(positionLineStart):
+        return None
+    return start
+
+def findNextPositionLine(f, offset):
+    """
+    Find the offset of the first position line starting after offset, or None if there is none.
+    """
+    f.seek(offset)
+    f.readline() # Skip the partial line offset falls in
+    while True:
+        lineStart = f.tell()
+        line = f.readline()
+        if not line or line.startswith(b']'):
+            return None
+        if line.startswith(positionLineStart):
+            return lineStart
+
+def findShardRanges(jsonFile, shards):
+    """
+    Byte-level pre-scan that splits the positions array of a Nirvana JSON file into at most shards byte ranges,
+    each starting at a position line.  The last range runs to the end of the file, the shard reader stops at the
+    end of the positions array.
+
+    :return: List of (start, end) offsets, or None if the file is compressed or not laid out one position per line.
+    """
+    size = os.path.getsize(jsonFile)
+    with open(jsonFile, 'rb') as f:
+        magic = f.read(4)
+        if magic.startswith(gzipMagic) or magic.startswith(zstdMagic):
+            return None
+        f.seek(0)
+        start = findPositionsStart(f)
+        if start is None:
+            return None
+        boundaries = [start]
+        for shard in range(1, shards):
+            offset = max(start, size * shard // shards)
+            if offset <= boundaries[-1]:
+                continue
+            boundary = findNextPositionLine(f, offset)
+            if boundary is None:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    return list(zip(boundaries, boundaries[1:] + [size]))
+
+def shardChunks(f, start, end):
+    """
+    Yield the bytes of a shard as a small JSON document, {"positions":[ ... ]}, holding only the positions in the range.
+    The trailing comma of the last position is dropped and reading stops at the end of the positions array.
+    """
+    yield b'{"positions":['
+    f.seek(start)
+    remaining = end - start
+    carry = b''
+    while remaining > 0:
+        chunk = carry + f.read(min(readBufferSize, remaining))
+        if len(chunk) == len(carry):
+            break
+        remaining -= len(chunk) - len(carry)
+        arrayEnd = chunk.find(positionsArrayEnd)
+        if arrayEnd >= 0:
+            carry = chunk[:arrayEnd]
+            break
+        # Hold back the tail so the array end marker and the trailing comma can be seen across chunk boundaries
+        carry = chunk[-16:]
+        yield chunk[:-16]
+    carry = carry.rstrip()
+    if carry.endswith(b','):
+        carry = carry[:-1]
+    yield carry
+    yield b']}'
+
+class ShardStream(ChunkStream):
+    """
+    Binary stream over one shard of a Nirvana JSON file, see shardChunks.
+    """
+
+    def __init__(self, jsonFile, start, end):
+        self.file = open(jsonFile, 'rb')
+        super().__init__(shardChunks(self.file, start, end))
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+def parseShard(adapterFactory, jsonFile, start, end):
+    """
+    Parse one shard with a fresh adapter from adapterFactory.
+    Runs in a worker process.
+
+    :return: The entries the shard selected, in gene order, the adapter's rejection counts and its metrics report,
+    or None if metrics are off.
+    """
+    adapter = adapterFactory()
+    with adapter.stage('parseShard'), io.BufferedReader(ShardStream(jsonFile, start, end), buffer_size=readBufferSize) as f:
+        adapter.parseJsonStream(f)
+    entries = list(adapter.selector.selectedEntries())
+    adapter.selector.close()
+    return entries, adapter.rejectionCounts, adapter.metrics.asDict() if adapter.metrics is not None else None
+
+def readJsonFileSharded(adapter, adapterFactory, jsonFile, shards):
+    """
+    Convert a Nirvana JSON file by parsing byte ranges of its positions array in a process pool.
+    Each worker keeps the best entry per gene of its shard.  The shard selections are offered to the adapter's
+    selector in file order, which picks the same entries as a single pass over the whole file.
+    Falls back to adapter.readJsonFile if the file can't be sharded.
+
+    :param adapter: The adapter that prints the section.
+    :param adapterFactory: Picklable callable returning an adapter configured like adapter, used in the workers.
+    """
+    ranges = findShardRanges(jsonFile, shards) if shards > 1 else None
+    if ranges is None or len(ranges) < 2:
+        adapter.readJsonFile(jsonFile)
+        return
+
+    adapter.printHeader()
+    adapter.selector = jsonStructure.GeneSelector(adapter.memoryBudget)
+    adapter.countMetric('inputBytes', os.path.getsize(jsonFile))
+    starts = [start for start, end in ranges]
+    ends = [end for start, end in ranges]
+    with adapter.stage('parse'), ProcessPoolExecutor(max_workers=min(shards, len(ranges))) as executor:
+        shardResults = executor.map(parseShard, repeat(adapterFactory), repeat(jsonFile), starts, ends)
+        for entries, rejectionCounts, metricsReport in shardResults:
+            for entry in entries:
+                adapter.selector.offer(entry)
+            for key, count in rejectionCounts.items():
+                adapter.rejectionCounts[key] += count
+            if metricsReport is not None:
+                adapter.metrics.merge(metricsReport)
+    with adapter.stage('write'):
+        adapter.printSelectedEntries()
+    adapter.printRejectionSummary()
+    adapter.recordSectionMetrics()
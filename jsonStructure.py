@@ -1,85 +1,145 @@
 import json
-from collections import defaultdict
-
-def addArrayToContext(context, path):
-    container = context
-    pathEnd = path[-1]
-    for part in path[:-1]:
-        container = container[part][-1]
-    
-    if pathEnd in container:
-        container[pathEnd].append({})
-    else:
-        container[pathEnd] = [{}]
-        
-def perform2ndPass(input_handle, output_handle):
-    # Load your JSON data (replace this with loading from a file if needed)
-    #with open(output_file, 'r') as input:
-    data = json.load(input_handle)
-
-    # Group entries by gene
-    gene_entries = defaultdict(list)
-    for entry in data:
-        gene_entries[entry['gene']].append(entry)
-        
-    # Select the best entry for each gene
-    selected_entries = []
-    for gene, entries in gene_entries.items():
-        # Priority 1: kbCategory is 'deep deletion'
-        deep_deletion = [e for e in entries if e.get('kbCategory') == 'deep deletion']
-        if deep_deletion:
-            selected_entries.append(deep_deletion[0])
-            continue
-        
-        # Priority 2: source is 'RefSeq' and isCanonical is True
-        refseq_canonical = [e for e in entries if e.get('source') == 'RefSeq' and e.get('isCanonical') is True]
-        if refseq_canonical:
-            selected_entries.append(refseq_canonical[0])
-            continue
-        
-        # Priority 3: source is 'RefSeq'
-        refseq = [e for e in entries if e.get('source') == 'RefSeq']
-        if refseq:
-            selected_entries.append(refseq[0])
-            continue
-        
-        # Fallback: first available entry
-        selected_entries.append(entries[0])
+import marshal
+import sys
+from tempfile import TemporaryFile
+from jsonInput import selectIjsonBackend
+
+def perform2ndPass(input_handle, output_handle, memoryBudget=None):
+    """
+    Select the best entry per gene from a JSON array of entries and print the selection.
+    Entries are streamed from the input and reduced as they arrive, so memory grows with the number of genes,
+    not with the number of entries.
+    """
+    selector = GeneSelector(memoryBudget)
+    for entry in selectIjsonBackend().items(input_handle, 'item', use_float=True):
+        selector.offer(entry)
 
     # Output the selected entries
     #print( "\t\"smallMutations\": ", end = "" )
-    print( json.dumps(selected_entries, indent=4), end = "", file=output_handle )
+    printEntries( selector.selectedEntries(), output_handle )
     #print( "," )
+    selector.close()
+
+def printEntries(entries, output_handle):
+    """
+    Print the entries as a JSON array, formatted exactly like json.dumps(list(entries), indent=4).
+    Entries are encoded one at a time so the whole array never has to be held in memory.
+    """
+    first = True
+    for entry in entries:
+        print( "[\n    " if first else ",\n    ", end = "", file=output_handle )
+        print( json.dumps(entry, indent=4).replace("\n", "\n    "), end = "", file=output_handle )
+        first = False
+    print( "[]" if first else "\n]", end = "", file=output_handle )
+
+# Priority of an entry that is not a deep deletion, keyed by (source, isCanonical is True).  Lower is better.
+sourcePriority = {('RefSeq', True): 1, ('RefSeq', False): 2}
+deepDeletionPriority = 0
+fallbackPriority = 3
+
+def entryPriority(entry):
+    """
+    Rank an entry for the per gene selection, lower is better.
+    deep deletion > RefSeq canonical > RefSeq > anything else.
+    """
+    if entry.get('kbCategory') == 'deep deletion':
+        return deepDeletionPriority
+    return sourcePriority.get((entry.get('source'), entry.get('isCanonical') is True), fallbackPriority)
+
+def estimateSize(entry):
+    """
+    Rough estimate of the memory held by a flat entry dictionary.
+    """
+    size = sys.getsizeof(entry)
+    for key, value in entry.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+class GeneCandidate:
+    """
+    The current best entry for one gene.  entry is None once it has been spilled to disk.
+    """
+    __slots__ = ('priority', 'entry', 'offset', 'size')
 
+    def __init__(self, priority, entry, size):
+        self.priority = priority
+        self.entry = entry
+        self.offset = -1
+        self.size = size
 
-def ensureContainerExists(context, path):
+class GeneSelector:
     """
-    Ensure that the container for the given path exists in the context.
-    If it does not exist, create it as an empty dictionary.
+    Incremental reducer that keeps one candidate entry per gene.
+    Entries are offered one at a time, as soon as they are built, and each one is ranked once with entryPriority.
+    A candidate is only replaced by an entry with a strictly better priority, so within a priority the first
+    entry wins, and genes keep the order they were first seen in.  This gives the same selection and output
+    order as grouping every entry by gene and picking the best, while memory only grows with the number of genes.
+
+    If the kept entries grow beyond memoryBudget bytes they are moved to a temporary spill file in marshal format,
+    and only their priority and file offset stay in memory.
     """
-    container = context
-    for part in path:
-        if part not in container:
-            container[part] = [{}]
-        container = container[part][-1]
-    return container
-
-def handleMapping(context, path, value):
-    pathEnd = path[-1]
-    container = ensureContainerExists( context, path[:-1] )
-    if pathEnd in container: # Check if the key already exists in the container.
-        # This is possibly an array item if the item already exists.  Convert it if not already an array.
-        if not isinstance(container.get(pathEnd), list):
-            oldItem = container.pop(pathEnd)
-            container[pathEnd] = [ oldItem ]
-        container.get( pathEnd ).append( value )
-    else:
-        container[pathEnd] = value
-
-def handleSimpleMapping(context, key, value):
-    collection = key[0].split('.')[-3]
-    if collection not in context:
-        context[collection] = {}
-    collectionMap = context[collection]
-    collectionMap.update( {key[0].split('.')[-1]:  value})
-    context[collection] = collectionMap
\ No newline at end of file
+
+    def __init__(self, memoryBudget=None):
+        self.memoryBudget = memoryBudget
+        self.memoryUsed = 0
+        self.candidates = {} # gene -> GeneCandidate
+        self.spillFile = None
+
+    def offer(self, entry):
+        """
+        Offer an entry to the selector.  It is kept if it is the first entry for its gene or it beats the current one.
+
+        :return: True if the entry is now the candidate for its gene.
+        """
+        candidate = self.candidates.get(entry['gene'])
+        if candidate is not None:
+            if candidate.priority == deepDeletionPriority: # Nothing can beat it, don't bother ranking
+                return False
+            priority = entryPriority(entry)
+            if priority >= candidate.priority:
+                return False
+            self.memoryUsed -= candidate.size
+            candidate.priority = priority
+            candidate.entry = entry
+            candidate.offset = -1
+            candidate.size = estimateSize(entry)
+        else:
+            candidate = self.candidates[entry['gene']] = GeneCandidate(entryPriority(entry), entry, estimateSize(entry))
+        self.memoryUsed += candidate.size
+        if self.memoryBudget is not None and self.memoryUsed > self.memoryBudget:
+            self.spill()
+        return True
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def spill(self):
+        """
+        Move every entry still held in memory to the spill file.
+        """
+        if self.spillFile is None:
+            self.spillFile = TemporaryFile()
+        self.spillFile.seek(0, 2)
+        for candidate in self.candidates.values():
+            if candidate.entry is not None:
+                candidate.offset = self.spillFile.tell()
+                marshal.dump(candidate.entry, self.spillFile)
+                candidate.entry = None
+                candidate.size = 0
+        self.memoryUsed = 0
+
+    def selectedEntries(self):
+        """
+        Yield the selected entry for every gene, in the order the genes were first seen.
+        """
+        for candidate in self.candidates.values():
+            entry = candidate.entry
+            if entry is None:
+                self.spillFile.seek(candidate.offset)
+                entry = marshal.load(self.spillFile)
+            yield entry
+
+    def close(self):
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.spillFile = None
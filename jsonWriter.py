@@ -0,0 +1,131 @@
+import json
+
+try:
+    import orjson
+except ImportError: # orjson is optional, the json module is used without it
+    orjson = None
+
+# The encoders differ in a few corners, eg orjson writes 1e16 where json writes 1e+16, so the name of the one in use
+# is part of the conversion cache key, see conversionCache.sectionKey.
+encoderName = 'orjson' if orjson is not None else 'json'
+
+writeBufferSize = 1 << 20
+indentWidth = 4
+
+def encodeCompact(value):
+    """
+    Encode a value as compact JSON text, with orjson when it is installed.
+    Both encoders write strings unescaped, but their number formatting is not identical, see encoderName.
+    """
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def encodePretty(value, depth):
+    """
+    Encode a value the way json.dumps(indent=4) lays it out, indented to sit at depth in the enclosing document.
+    """
+    text = json.dumps(value, indent=indentWidth)
+    if depth and isinstance(value, (dict, list)):
+        text = text.replace('\n', '\n' + ' ' * (indentWidth * depth))
+    return text
+
+class JsonWriter:
+    """
+    Buffered streaming JSON writer.
+    Tracks the open objects and arrays and writes the separators between their members, so callers only say what
+    to write.  Output is compact unless pretty is set, in which case it is laid out like json.dumps(indent=4).
+
+    A writer created with depth 1 writes members of an object that is opened somewhere else, eg a section
+    rendered in a worker process.  The text it produces is added to the enclosing document with writeFragment.
+    """
+
+    def __init__(self, handle, pretty=False, depth=0, bufferSize=writeBufferSize):
+        """
+        :param handle: Text handle the JSON is written to.
+        :param pretty: Indent the output instead of writing it compactly.
+        :param depth: Number of enclosing objects that are already open.
+        """
+        self.handle = handle
+        self.pretty = pretty
+        self.bufferSize = bufferSize
+        self.pieces = []
+        self.buffered = 0
+        self.written = 0
+        self.empty = [True] * depth # One entry per open object or array, True until its first member is written
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self.pieces:
+            self.handle.write(''.join(self.pieces))
+            self.pieces = []
+            self.written += self.buffered
+            self.buffered = 0
+
+    def tell(self):
+        """
+        Number of characters written so far, including those still buffered.
+        """
+        return self.written + self.buffered
+
+    def startMember(self, key):
+        """
+        Write the separator and, inside an object, the key that come before a new member of the open container.
+        """
+        if self.empty:
+            if not self.empty[-1]:
+                self.write(',')
+            self.empty[-1] = False
+            if self.pretty:
+                self.write('\n' + ' ' * (indentWidth * len(self.empty)))
+        if key is not None:
+            self.write(encodeCompact(key) + (': ' if self.pretty else ':'))
+
+    def beginObject(self, key=None):
+        self.startMember(key)
+        self.write('{')
+        self.empty.append(True)
+
+    def beginArray(self, key=None):
+        self.startMember(key)
+        self.write('[')
+        self.empty.append(True)
+
+    def endContainer(self, closing):
+        empty = self.empty.pop()
+        if self.pretty and not empty:
+            self.write('\n' + ' ' * (indentWidth * len(self.empty)))
+        self.write(closing)
+        if not self.empty:
+            self.write('\n') # End of the document
+
+    def endObject(self):
+        self.endContainer('}')
+
+    def endArray(self):
+        self.endContainer(']')
+
+    def writeValue(self, value, key=None):
+        """
+        Write a value, which may be a whole dictionary or list, as the next member of the open container.
+
+        :param key: Member name, required inside an object.
+        """
+        self.startMember(key)
+        self.write(encodePretty(value, len(self.empty)) if self.pretty else encodeCompact(value))
+
+    def writeFragment(self, text):
+        """
+        Write members produced by a writer created with the current depth, see the class description.
+        """
+        if not text:
+            return
+        if not self.empty[-1]:
+            self.write(',')
+        self.empty[-1] = False
+        self.write(text)
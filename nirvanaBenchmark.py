@@ -0,0 +1,497 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from CnvAdapter import CnvAdapter
+from VcfAdapter import VcfAdapter
+from jsonConstants import variantConsequencePriorityList, cnvConsequencePriorityList, ijsonBackendPreference
+from jsonInput import selectIjsonBackend, openJsonInput
+from jsonStructure import GeneSelector, perform2ndPass
+from nirvanaMetrics import peakRssMB
+from nirvanaPoriAdapter import convertPatient
+
+# Synthetic Nirvana JSON generator and throughput benchmarks.
+# The generated files follow the layout Nirvana writes: a header object, one position per line
+# inside the positions array, and a trailing genes section.
+
+chromosomes = [f"chr{c}" for c in list(range(1, 23)) + ['X', 'Y']]
+cnvVariantTypes = ['copy_number_loss', 'copy_number_gain', 'deletion', 'duplication', 'tandem_duplication']
+filterValues = ['LowQ', 'LowDP', 'weak_evidence', 'multiallelic']
+
+
+def parseConsequenceMix(text):
+    """
+    Parse a consequence mix like missense_variant=5,synonymous_variant=2 into (consequences, weights).
+    """
+    consequences, weights = [], []
+    for item in text.split(','):
+        consequence, _, weight = item.partition('=')
+        consequences.append(consequence.strip())
+        weights.append(float(weight) if weight else 1.0)
+    return consequences, weights
+
+
+def pickConsequences(rng, consequencePool, mix):
+    if mix is None:
+        return rng.sample(consequencePool, rng.randint(1, 3))
+    consequences, weights = mix
+    return list(dict.fromkeys(rng.choices(consequences, weights, k=rng.randint(1, 3))))
+
+
+def generateTranscript(rng, gene, consequencePool, index, mix=None):
+    transcript = {
+        "transcript": f"NM_{rng.randint(1000, 999999)}.{rng.randint(1, 9)}",
+        "source": rng.choice(['RefSeq', 'Ensembl']),
+        "bioType": "protein_coding",
+        "codons": "gCc/gTc",
+        "aminoAcids": "A/V",
+        "cdnaPos": str(rng.randint(1, 5000)),
+        "cdsPos": str(rng.randint(1, 4000)),
+        "exons": f"{rng.randint(1, 20)}/20",
+        "proteinPos": str(rng.randint(1, 1300)),
+        "geneId": str(rng.randint(1, 100000)),
+        "hgnc": gene,
+        "consequence": pickConsequences(rng, consequencePool, mix),
+        "hgvsc": f"NM_{index}.1:c.{rng.randint(1, 4000)}C>T",
+        "hgvsp": f"NP_{index}.1:p.(Ala{rng.randint(1, 1300)}Val)",
+        "proteinId": f"NP_{index}.1",
+    }
+    if rng.random() < 0.3:
+        transcript["isCanonical"] = True
+    return transcript
+
+
+def generateAnnotation(rng, bulk):
+    """
+    Annotation sources the adapters never map.  bulk scales how many entries each source carries.
+    """
+    annotation = {}
+    if bulk <= 0:
+        return annotation
+    annotation["dbsnp"] = [f"rs{rng.randint(1, 10**9)}" for _ in range(bulk)]
+    annotation["clinvar"] = [{
+        "id": f"RCV{rng.randint(1, 10**8):09d}",
+        "reviewStatus": "criteria provided, single submitter",
+        "alleleOrigins": ["germline"],
+        "phenotypes": ["not specified", "Hereditary cancer-predisposing syndrome"],
+        "significance": ["likely benign"],
+        "lastUpdatedDate": "2020-01-01",
+        "pubMedIds": [str(rng.randint(1, 10**8)) for _ in range(3)],
+    } for _ in range(bulk)]
+    annotation["gnomad"] = {
+        "coverage": rng.randint(1, 60), "allAf": rng.random(), "allAn": rng.randint(1, 200000),
+        "allAc": rng.randint(1, 1000), "allHc": rng.randint(1, 100), "afrAf": rng.random(),
+        "amrAf": rng.random(), "easAf": rng.random(), "finAf": rng.random(), "nfeAf": rng.random(),
+        "asjAf": rng.random(), "sasAf": rng.random(), "othAf": rng.random(),
+    }
+    annotation["cosmic"] = [{
+        "id": f"COSV{rng.randint(1, 10**8)}", "numSamples": rng.randint(1, 50),
+        "cancerTypesAndCounts": [{"cancerType": "carcinoma", "count": rng.randint(1, 10)}],
+        "cancerSitesAndCounts": [{"cancerSite": "lung", "count": rng.randint(1, 10)}],
+    } for _ in range(bulk)]
+    return annotation
+
+
+def generatePosition(rng, index, options):
+    chromosome = chromosomes[min(index * len(chromosomes) // max(options.positions, 1), len(chromosomes) - 1)]
+    start = 10000 + index * 137
+    gene = f"GENE{rng.randint(1, options.genes)}"
+    passing = rng.random() < options.passRate
+    position = {
+        "chromosome": chromosome,
+        "position": start,
+    }
+    if options.cnv:
+        position["svEnd"] = start + rng.randint(1000, 500000)
+    position["refAllele"] = "N" if options.cnv else rng.choice("ACGT")
+    position["altAlleles"] = ["<DEL>"] if options.cnv else [rng.choice("ACGT")]
+    position["quality"] = round(rng.uniform(1, 100), 2)
+    position["filters"] = ["PASS"] if passing else [rng.choice(filterValues)]
+    position["cytogeneticBand"] = f"{chromosome[3:]}p{rng.randint(11, 36)}.{rng.randint(1, 3)}"
+    if options.cnv:
+        copyNumber = rng.randint(0, 6)
+        position["samples"] = [{"genotype": "0/1", "copyNumber": copyNumber, "minorHaplotypeCopyNumber": 0}]
+    else:
+        depth = rng.randint(10, 300)
+        alt = rng.randint(1, depth)
+        position["samples"] = [{
+            "genotype": rng.choice(["0/1", "1/1", "0/0"]),
+            "variantFrequencies": [round(alt / depth, 3)],
+            "totalDepth": depth,
+            "alleleDepths": [depth - alt, alt],
+            "somaticQuality": round(rng.uniform(1, 100), 2),
+        }]
+
+    variant = {
+        "vid": f"{chromosome[3:]}-{start}-A-G",
+        "chromosome": chromosome,
+        "begin": start,
+        "end": position.get("svEnd", start),
+        "refAllele": position["refAllele"],
+        "altAllele": position["altAlleles"][0],
+    }
+    if options.cnv:
+        variant["variantType"] = rng.choice(cnvVariantTypes)
+        consequencePool = cnvConsequencePriorityList
+    else:
+        variant["variantType"] = "SNV"
+        variant["hgvsg"] = f"NC_0000{index % 24:02d}.11:g.{start}A>G"
+        variant["phylopScore"] = round(rng.uniform(-5, 5), 1)
+        consequencePool = variantConsequencePriorityList
+    variant.update(generateAnnotation(rng, options.annotationBulk))
+    mix = parseConsequenceMix(options.consequenceMix) if options.consequenceMix else None
+    variant["transcripts"] = [generateTranscript(rng, gene, consequencePool, index, mix)
+                              for _ in range(options.transcripts)]
+    position["variants"] = [variant]
+    return position
+
+
+def generateNirvanaJson(path, options):
+    """
+    Write a synthetic Nirvana JSON file to path.  Returns the number of bytes written.
+    """
+    rng = random.Random(options.seed)
+    header = {
+        "annotator": "Nirvana 3.18.1",
+        "creationTime": "2024-01-01 00:00:00",
+        "genomeAssembly": "GRCh38",
+        "schemaVersion": 6,
+        "dataSources": [{"name": "VEP", "version": "104", "releaseDate": "2021-05-03"}],
+        "samples": ["TUMOR"],
+    }
+    with open(path, 'w') as f:
+        f.write('{"header":' + json.dumps(header, separators=(',', ':')) + ',"positions":[\n')
+        for index in range(options.positions):
+            if index:
+                f.write(',\n')
+            f.write(json.dumps(generatePosition(rng, index, options), separators=(',', ':')))
+        f.write('\n],"genes":[\n')
+        for index in range(1, options.genes + 1):
+            if index > 1:
+                f.write(',\n')
+            f.write(json.dumps({"name": f"GENE{index}", "hgncId": index,
+                                "summary": "Synthetic gene record " * options.annotationBulk},
+                               separators=(',', ':')))
+        f.write('\n]}\n')
+        return f.tell()
+
+
+def generatedInput(options, cnv):
+    """
+    Path of the generated file for the generator options, written first if it doesn't exist yet.
+    The name carries a digest of the options, so a file is only reused for the same options.
+    """
+    settings = {name: getattr(options, name) for name in generatorOptions}
+    settings['cnv'] = cnv
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:8]
+    path = f"nirvana_bench_{'cnv' if cnv else 'vcf'}_{options.positions}_{options.annotationBulk}_{digest}.json"
+    if not os.path.exists(path):
+        generatorSettings = argparse.Namespace(**settings)
+        size = generateNirvanaJson(path, generatorSettings)
+        print(f"Generated {path} ({size:,} bytes)", file=sys.stderr)
+    return path
+
+
+def generateEntryArray(path, options):
+    """
+    Write a JSON array of flat entries, the input of jsonStructure.perform2ndPass, with options.transcripts
+    entries per position spread over options.genes genes.
+    """
+    rng = random.Random(options.seed)
+    with open(path, 'w') as f:
+        f.write('[')
+        for index in range(options.positions * options.transcripts):
+            entry = {
+                "gene": f"GENE{rng.randint(1, options.genes)}",
+                "chromosome": rng.choice(chromosomes),
+                "startPosition": rng.randint(1, 10**8),
+                "transcript": f"NM_{rng.randint(1000, 999999)}.{rng.randint(1, 9)}",
+                "source": rng.choice(['RefSeq', 'Ensembl']),
+                "isCanonical": rng.random() < 0.3,
+                "consequence": rng.choice(variantConsequencePriorityList),
+                "kbCategory": 'deep deletion' if rng.random() < 0.01 else 'mutation',
+                "variantFrequency": round(rng.random(), 3),
+            }
+            f.write((',' if index else '') + json.dumps(entry, separators=(',', ':')))
+        f.write(']')
+
+
+class LegacyDispatchMixin:
+    """
+    The per-event dispatch used before the compiled dispatcher, kept here as the benchmark baseline.
+    """
+    def dispatchEvents(self, parser):
+        for prefix, event, value in parser:
+            key = (prefix, event)
+            path = [x for x in prefix.split('.') if x != 'item']
+            if key in self.simpleMapping:
+                path[-1] = self.simpleMapping[key]
+                self.handleMapping(path, value)
+            elif key in self.complex_handlers:
+                self.complex_handlers[key](value)
+
+
+def buildAdapter(cnv, legacy=False):
+    adapterClass = CnvAdapter if cnv else VcfAdapter
+    if legacy:
+        adapterClass = type('Legacy' + adapterClass.__name__, (LegacyDispatchMixin, adapterClass), {})
+    adapter = adapterClass(None)
+    adapter.setOutputHandle(open(os.devnull, 'w'))
+    adapter.selector = GeneSelector()
+    return adapter
+
+
+def benchmarkDispatch(path, cnv, backendName=None):
+    """
+    Measure events/sec for a bare ijson parse, the legacy dispatch loop and the compiled dispatcher.
+    """
+    backend = selectIjsonBackend(backendName)
+    results = {}
+    with openJsonInput(path) as f:
+        start = time.perf_counter()
+        events = 0
+        for _ in backend.parse(f):
+            events += 1
+        results['parseOnly'] = time.perf_counter() - start
+
+    for name, legacy in (('legacy', True), ('compiled', False)):
+        adapter = buildAdapter(cnv, legacy)
+        with openJsonInput(path) as f:
+            start = time.perf_counter()
+            adapter.dispatchEvents(backend.parse(f))
+            results[name] = time.perf_counter() - start
+        adapter.output_handle.close()
+
+    print(f"events: {events}", file=sys.stderr)
+    for name, elapsed in results.items():
+        print(f"{name:>10}: {elapsed:8.2f}s  {events / elapsed:12,.0f} events/sec", file=sys.stderr)
+    dispatchLegacy = results['legacy'] - results['parseOnly']
+    dispatchCompiled = results['compiled'] - results['parseOnly']
+    if dispatchCompiled > 0:
+        print(f"dispatch overhead: {dispatchLegacy:.2f}s -> {dispatchCompiled:.2f}s "
+              f"({dispatchLegacy / dispatchCompiled:.1f}x)", file=sys.stderr)
+    return results
+
+
+def benchmarkScaling(sizes, options, maxGrowth):
+    """
+    Time VcfAdapter.readJsonFile on generated files of increasing size.
+    The cost per position should stay flat, anything that rescans earlier positions shows up as growth.
+    Returns False if the cost per position of the largest file grew more than maxGrowth times the smallest.
+    """
+    perPosition = []
+    for size in sizes:
+        options.positions = size
+        path = generatedInput(options, options.cnv)
+        adapter = buildAdapter(options.cnv)
+        adapter.setIjsonBackend(options.ijsonBackend)
+        start = time.perf_counter()
+        adapter.readJsonFile(path)
+        elapsed = time.perf_counter() - start
+        adapter.output_handle.close()
+        perPosition.append(elapsed / size)
+        print(f"{size:>10,} positions: {elapsed:8.2f}s  {perPosition[-1] * 1e6:8.2f} us/position", file=sys.stderr)
+
+    growth = perPosition[-1] / perPosition[0]
+    print(f"cost per position grew {growth:.2f}x from {sizes[0]:,} to {sizes[-1]:,} positions", file=sys.stderr)
+    return growth <= maxGrowth
+
+
+def benchmarkPruning(path, cnv, backendName=None):
+    """
+    Time readJsonFile with and without pruning of unmapped subtrees.
+    The saving grows with the share of the file taken up by annotations the adapters don't map.
+    """
+    results = {}
+    for name, prune in (('unpruned', False), ('pruned', True)):
+        adapter = buildAdapter(cnv)
+        adapter.setIjsonBackend(backendName)
+        adapter.setPruneSubtrees(prune)
+        start = time.perf_counter()
+        adapter.readJsonFile(path)
+        results[name] = time.perf_counter() - start
+        adapter.output_handle.close()
+
+    size = os.path.getsize(path)
+    for name, elapsed in results.items():
+        print(f"{name:>10}: {elapsed:8.2f}s  {size / elapsed / 1e6:8.1f} MB/sec", file=sys.stderr)
+    print(f"pruning speedup: {results['unpruned'] / results['pruned']:.2f}x", file=sys.stderr)
+    return results
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of a list of values.
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def runSuiteCase(case, inputs, backendName=None):
+    """
+    Run one benchmark case once, in a fresh worker process so its peak memory is its own.
+    Returns the elapsed seconds and the peak resident memory of the worker.
+    """
+    start = time.perf_counter()
+    if case in ('cnvReadJsonFile', 'vcfReadJsonFile'):
+        adapter = buildAdapter(case == 'cnvReadJsonFile')
+        adapter.setIjsonBackend(backendName)
+        adapter.readJsonFile(inputs[case])
+        adapter.output_handle.close()
+    elif case == 'perform2ndPass':
+        with open(inputs[case], 'rb') as input_handle, open(os.devnull, 'w') as output_handle:
+            perform2ndPass(input_handle, output_handle)
+    elif case == 'pipeline':
+        with tempfile.TemporaryDirectory() as directory:
+            patient = {'cnv': inputs['cnvReadJsonFile'], 'vcf': inputs['vcfReadJsonFile'],
+                       'outputFile': os.path.join(directory, 'pori.json'), 'patientID': 'BENCH',
+                       'diseaseName': 'sarcoma', 'projectName': 'PORI', 'template': 'genomic'}
+            convertPatient(patient, {'ijsonBackend': backendName}, jobs=1)
+    else:
+        raise ValueError(f"Unknown benchmark case {case}")
+    return time.perf_counter() - start, peakRssMB()
+
+
+suiteCases = ['cnvReadJsonFile', 'vcfReadJsonFile', 'perform2ndPass', 'pipeline']
+
+
+def benchmarkSuite(options, cases, repeat):
+    """
+    Run the benchmark cases repeat times each on generated input and summarise them.
+    Every run gets its own worker process, so runs don't share caches or memory.
+
+    :return: Dictionary with the environment, the generator options and per case latency percentiles,
+    throughput and peak memory, as saved by --save.
+    """
+    inputs = {'cnvReadJsonFile': generatedInput(options, True), 'vcfReadJsonFile': generatedInput(options, False)}
+    if 'perform2ndPass' in cases:
+        inputs['perform2ndPass'] = inputs['vcfReadJsonFile'].replace('_vcf_', '_entries_')
+        if not os.path.exists(inputs['perform2ndPass']):
+            generateEntryArray(inputs['perform2ndPass'], options)
+
+    results = {}
+    for case in cases:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                runs.append(executor.submit(runSuiteCase, case, inputs, options.ijsonBackend).result())
+        seconds = [elapsed for elapsed, peak in runs]
+        inputBytes = (os.path.getsize(inputs['cnvReadJsonFile']) + os.path.getsize(inputs['vcfReadJsonFile'])
+                      if case == 'pipeline' else os.path.getsize(inputs[case]))
+        positions = options.positions * (2 if case == 'pipeline' else 1)
+        median = percentile(seconds, 0.5)
+        results[case] = {
+            'runs': seconds,
+            'p50Seconds': median,
+            'p90Seconds': percentile(seconds, 0.9),
+            'p99Seconds': percentile(seconds, 0.99),
+            'minSeconds': min(seconds),
+            'megabytesPerSecond': inputBytes / median / 1e6,
+            'positionsPerSecond': positions / median,
+            'peakRssMB': max(peak for elapsed, peak in runs if peak is not None) if runs[0][1] is not None else None,
+        }
+        result = results[case]
+        print(f"{case:>16}: p50 {result['p50Seconds']:7.2f}s  p90 {result['p90Seconds']:7.2f}s  "
+              f"{result['megabytesPerSecond']:7.1f} MB/sec  {result['positionsPerSecond']:10,.0f} positions/sec  "
+              f"peak {result['peakRssMB'] or 0:7.1f} MB", file=sys.stderr)
+
+    return {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'ijsonBackend': selectIjsonBackend(options.ijsonBackend).backend_name},
+        'generator': {name: getattr(options, name) for name in generatorOptions},
+        'repeat': repeat,
+        'cases': results,
+    }
+
+
+def compareToBaseline(results, baseline, maxRegression):
+    """
+    Compare the median time of every case with a saved baseline.
+    Returns False if any case got slower than maxRegression times its baseline.
+    """
+    if baseline.get('generator') != results['generator']:
+        print("warning: the baseline was generated with different generator options", file=sys.stderr)
+    passed = True
+    for case, result in results['cases'].items():
+        if case not in baseline['cases']:
+            continue
+        ratio = result['p50Seconds'] / baseline['cases'][case]['p50Seconds']
+        regressed = ratio > maxRegression
+        passed = passed and not regressed
+        print(f"{case:>16}: {ratio:5.2f}x baseline time{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    return passed
+
+
+generatorOptions = ['positions', 'transcripts', 'genes', 'passRate', 'annotationBulk', 'consequenceMix', 'seed']
+
+
+def addGeneratorArguments(parser):
+    parser.add_argument('--positions', type=int, default=100000, help='Number of positions to generate')
+    parser.add_argument('--transcripts', type=int, default=4, help='Transcripts per variant')
+    parser.add_argument('--genes', type=int, default=2000, help='Number of distinct genes')
+    parser.add_argument('--passRate', type=float, default=0.3, help='Fraction of positions with a PASS filter')
+    parser.add_argument('--annotationBulk', type=int, default=2, help='Entries per unmapped annotation source')
+    parser.add_argument('--consequenceMix', type=str, default=None, help='Weighted consequences to draw from, eg missense_variant=5,synonymous_variant=2. Default is every consequence equally')
+    parser.add_argument('--cnv', action='store_true', help='Generate CNV positions instead of small variants')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--ijsonBackend', type=str, default=None, choices=ijsonBackendPreference, help='ijson backend to benchmark with')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic Nirvana JSON generator and benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='Write a synthetic Nirvana JSON file')
+    generate.add_argument('output', help='Path of the JSON file to write')
+    addGeneratorArguments(generate)
+
+    dispatch = subparsers.add_parser('dispatch', help='Events/sec of the legacy and compiled event dispatch')
+    dispatch.add_argument('--input', help='Existing Nirvana JSON to benchmark instead of a generated one')
+    addGeneratorArguments(dispatch)
+
+    pruning = subparsers.add_parser('pruning', help='Conversion time with and without pruning of unmapped subtrees')
+    pruning.add_argument('--input', help='Existing Nirvana JSON to benchmark instead of a generated one')
+    addGeneratorArguments(pruning)
+
+    scaling = subparsers.add_parser('scaling', help='Check that conversion time grows linearly with the number of positions')
+    scaling.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000, 5000000], help='Position counts to time')
+    scaling.add_argument('--maxGrowth', type=float, default=1.5, help='Largest allowed growth of the cost per position')
+    addGeneratorArguments(scaling)
+
+    suite = subparsers.add_parser('suite', help='Latency, throughput and peak memory of the adapters, perform2ndPass and the full pipeline')
+    suite.add_argument('--cases', nargs='+', default=suiteCases, choices=suiteCases, help='Cases to run')
+    suite.add_argument('--repeat', type=int, default=5, help='Runs per case')
+    suite.add_argument('--save', help='Write the results as JSON to this file')
+    suite.add_argument('--baseline', help='Results saved by an earlier run to compare against')
+    suite.add_argument('--maxRegression', type=float, default=1.1, help='Largest allowed ratio of median time to the baseline')
+    addGeneratorArguments(suite)
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        size = generateNirvanaJson(args.output, args)
+        print(f"Wrote {size:,} bytes to {args.output}", file=sys.stderr)
+    elif args.command in ('dispatch', 'pruning'):
+        path = args.input or generatedInput(args, args.cnv)
+        if args.command == 'dispatch':
+            benchmarkDispatch(path, args.cnv, args.ijsonBackend)
+        else:
+            benchmarkPruning(path, args.cnv, args.ijsonBackend)
+    elif args.command == 'scaling':
+        if not benchmarkScaling(sorted(args.sizes), args, args.maxGrowth):
+            sys.exit(1)
+    elif args.command == 'suite':
+        results = benchmarkSuite(args, args.cases, args.repeat)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=4)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if not compareToBaseline(results, baseline, args.maxRegression):
+                sys.exit(1)
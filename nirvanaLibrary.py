@@ -0,0 +1,74 @@
+from ExpressionAdapter import ExpressionAdapter
+from jsonWriter import JsonWriter
+from nirvanaPoriAdapter import buildSectionAdapter, settingsForSection
+
+# Library interface for programs that use the converted records themselves instead of reading an output file back.
+# The records are the dictionaries the adapters build, the same ones nirvanaPoriAdapter.py writes, eg
+#
+#   for record in iterSmallMutations('patient.vcf.json.gz', {'passFilters': ['PASS', 'weak_evidence']}):
+#       load(record['gene'], record['proteinChange'])
+#
+# Writing is a stage of its own, see writeSection.
+
+def iterSectionRecords(section, jsonFile, settings=None):
+    """
+    Yield the selected record of every gene of a section.
+    The input is parsed when the first record is asked for, see NirvanaJsonAdapter.iterSelectedRecords.
+
+    :param section: 'cnv' or 'vcf'.
+    :param settings: Conversion settings like nirvanaPoriAdapter.buildSettings returns, every key is optional,
+    eg passFilters, regions, genes, memoryBudget, and the rank maps cnvConsequenceRank and variantConsequenceRank.
+    """
+    adapter = buildSectionAdapter(section, settingsForSection(section, settings or {}))
+    yield from adapter.iterSelectedRecords(jsonFile)
+
+def iterCopyVariants(jsonFile, settings=None):
+    """
+    Yield the copyVariants records of a Nirvana CNV JSON file, one per gene.
+    """
+    return iterSectionRecords('cnv', jsonFile, settings)
+
+def iterSmallMutations(jsonFile, settings=None):
+    """
+    Yield the smallMutations records of a Nirvana small variant JSON file, one per gene.
+    """
+    return iterSectionRecords('vcf', jsonFile, settings)
+
+def iterExpressionVariants(diseaseZscores, biopsyZscores, referenceCache=None):
+    """
+    Yield the expressionVariants records of the outlier genes of a biopsy, see ExpressionAdapter.
+
+    :param referenceCache: Directory of compiled disease references, see referenceCache.
+    """
+    adapter = ExpressionAdapter(diseaseZscores, biopsyZscores)
+    if referenceCache is not None:
+        adapter.setReferenceCache(referenceCache)
+    return adapter.expressionVariants()
+
+def writeSection(writer, name, records):
+    """
+    Write records as a section of an output document, eg writeSection(writer, 'smallMutations', records).
+    The records can come from the iterators above, filtered or changed on the way.
+
+    :param writer: JsonWriter of the document, with the top level object open, see jsonWriter.
+    """
+    writer.beginArray(name)
+    for record in records:
+        writer.writeValue(record)
+    writer.endArray()
+
+def writeDocument(output_handle, header, sections, pretty=False):
+    """
+    Write a whole Pori import document.
+
+    :param header: Top level fields, eg {'patientId': ..., 'kbDiseaseMatch': ..., 'project': ..., 'template': ...}.
+    :param sections: (name, records) pairs written in order, eg [('copyVariants', iterCopyVariants(path))].
+    """
+    writer = JsonWriter(output_handle, pretty)
+    writer.beginObject()
+    for key, value in header.items():
+        writer.writeValue(value, key)
+    for name, records in sections:
+        writeSection(writer, name, records)
+    writer.endObject()
+    writer.flush()
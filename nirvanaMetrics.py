@@ -0,0 +1,145 @@
+import io
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows, peak memory is then left out of the report
+    resource = None
+
+def peakRssMB(children=False):
+    """
+    Peak resident memory in MB of this process, or of its finished worker processes when children is set.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def cpuSeconds(children=False):
+    """
+    CPU time used by this process, or by its finished worker processes when children is set.
+    """
+    if resource is None:
+        return time.process_time() if not children else None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class SectionMetrics:
+    """
+    Timings and counters for the conversion of one section, eg copyVariants.
+    Stages record wall and CPU time, counters record events, positions and bytes.
+    With sampleEvents set a throughput sample is taken every sampleEvents parser events.
+    """
+
+    def __init__(self, section, sampleEvents=None):
+        self.section = section
+        self.sampleEvents = sampleEvents
+        self.stages = {} # name -> {'wallSeconds', 'cpuSeconds', 'calls'}, cpuSeconds is None for wall time only stages
+        self.counters = {}
+        self.samples = []
+        self.started = time.perf_counter()
+
+    def addStage(self, name, wall, cpu=None, calls=1):
+        stage = self.stages.setdefault(name, {'wallSeconds': 0.0, 'cpuSeconds': None, 'calls': 0})
+        stage['wallSeconds'] += wall
+        if cpu is not None:
+            stage['cpuSeconds'] = (stage['cpuSeconds'] or 0.0) + cpu
+        stage['calls'] += calls
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of work as a stage.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.addStage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def timed(self, name, function):
+        """
+        Wrap a function that is called for every position so its calls add up to a stage.
+        Only wall time is taken, reading the CPU clock on every call costs more than the calls being timed,
+        so the stage reports cpuSeconds as None.
+        """
+        def timedFunction(*args):
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.addStage(name, time.perf_counter() - start)
+        return timedFunction
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def meterEvents(self, parser):
+        """
+        Pass the parser events through, counting events and positions and taking the throughput samples.
+        """
+        events = positions = 0
+        every = self.sampleEvents or 0
+        try:
+            for item in parser:
+                events += 1
+                if item[1] == 'start_map' and item[0] == 'positions.item':
+                    positions += 1
+                if every and events % every == 0:
+                    self.samples.append({'events': events, 'positions': positions,
+                                         'seconds': round(time.perf_counter() - self.started, 3),
+                                         'peakRssMB': peakRssMB()})
+                yield item
+        finally:
+            self.count('eventsDispatched', events)
+            self.count('positionsSeen', positions)
+
+    def merge(self, report):
+        """
+        Add the stages and counters of a report from another process, eg a shard worker.
+        """
+        for name, stage in report['stages'].items():
+            self.addStage(name, stage['wallSeconds'], stage['cpuSeconds'], stage['calls'])
+        for name, amount in report['counters'].items():
+            self.count(name, amount)
+
+    def asDict(self):
+        counters = dict(self.counters)
+        for name, stage in self.stages.items():
+            if name == 'parse' and stage['wallSeconds'] > 0 and 'eventsDispatched' in counters:
+                counters['eventsPerSecond'] = round(counters['eventsDispatched'] / stage['wallSeconds'])
+        return {
+            'section': self.section,
+            'wallSeconds': time.perf_counter() - self.started,
+            'stages': self.stages,
+            'counters': counters,
+            'peakRssMB': peakRssMB(),
+            'samples': self.samples,
+        }
+
+class CountingReader(io.RawIOBase):
+    """
+    Binary stream wrapper that adds the number of bytes read through it to a metrics counter.
+    """
+
+    def __init__(self, raw, metrics, counter):
+        super().__init__()
+        self.raw = raw
+        self.metrics = metrics
+        self.counter = counter
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.metrics.count(self.counter, len(data))
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
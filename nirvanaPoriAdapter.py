@@ -1,16 +1,333 @@
 import argparse
+import cProfile
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import conversionCache
+from columnarOutput import ColumnarWriter, defaultBatchSize, formatExtensions, sectionFileName
+from jsonIncremental import IncrementalState, incrementalConfigKey
+from jsonRegions import RegionQuery, readBedFile, readGeneList, readGenePanel
 from NirvanaJsonAdapter import NirvanaJsonAdapter
 from CnvAdapter import CnvAdapter
 from VcfAdapter import VcfAdapter
-#from ExpressionAdapter import ExpressionAdapter
+from jsonConstants import ijsonBackendPreference, loadConsequencePriorities
+from jsonSharding import readJsonFileSharded
+from jsonWriter import JsonWriter, writeBufferSize
+from nirvanaMetrics import SectionMetrics, cpuSeconds, peakRssMB
+from ExpressionAdapter import ExpressionAdapter
 
-def printComma( iterator, output_handle ):
+# Section adapters in the order their sections are written to the output.
+sectionAdapters = { 'cnv': CnvAdapter, 'vcf': VcfAdapter }
+sectionRankSettings = { 'cnv': 'cnvConsequenceRank', 'vcf': 'variantConsequenceRank' } # Rank map of each section
+sectionArrays = { 'cnv': 'copyVariants', 'vcf': 'smallMutations' } # Output array of each section
+
+def configureAdapter( adapter, settings ):
+    """
+    Apply the command line settings to a section adapter.
+
+    :param settings: Dictionary with the optional keys ijsonBackend, decompressionThreads, memoryBudget (bytes),
+    noPruning, passFilters, pretty, regions, genes and consequenceRanks (rank map for this section).
+    The metrics and sampleEvents keys are applied by buildSectionAdapter, which knows the section.
     """
-    Print a comma if the iterator is greater than 0.
-    This is used to separate JSON objects in an array.
+    if settings.get('consequenceRanks') is not None:
+        adapter.setConsequenceRanks( settings['consequenceRanks'] )
+    adapter.setIjsonBackend( settings.get('ijsonBackend') )
+    adapter.setDecompressionThreads( settings.get('decompressionThreads') )
+    if settings.get('memoryBudget') is not None:
+        adapter.setMemoryBudget( settings['memoryBudget'] )
+    if settings.get('passFilters'):
+        adapter.setPassFilters( settings['passFilters'] )
+    if settings.get('noPruning'):
+        adapter.setPruneSubtrees( False )
+    adapter.setPrettyOutput( bool(settings.get('pretty')) )
+    if settings.get('regions') is not None or settings.get('genes') is not None:
+        adapter.setRegionQuery( RegionQuery( settings.get('regions'), settings.get('genes') ) )
+
+def settingsForSection( section, settings ):
+    """
+    Copy the settings with the consequence rank map of a section as its consequenceRanks.
+    """
+    return dict( settings, consequenceRanks=settings.get( sectionRankSettings[section] ) )
+
+def buildSectionAdapter( section, settings, output_handle=None ):
     """
-    if iterator > 0:
-        print(",", end=' ', file=output_handle)
+    Create the adapter for a section and apply the settings to it.
+    Module level so it can be handed to worker processes.
+    """
+    adapter = sectionAdapters[section]( output_handle )
+    configureAdapter( adapter, settings )
+    if settings.get('metrics'):
+        adapter.setMetrics( SectionMetrics( section, settings.get('sampleEvents') ) )
+    return adapter
+
+def convertSection( section, jsonFile, settings, writer=None ):
+    """
+    Convert one section of the output, eg 'cnv' for copyVariants.
+    When no writer is given the section is written to a buffer and returned as a string,
+    which is how sections are returned from worker processes.
+    With settings['conversionCache'] the section is taken from the conversion cache if it was converted before,
+    otherwise it is converted and added to the cache, see conversionCache.
+
+    :return: The section text, or None when written with the writer, and the metrics report, or None if metrics are
+    off or the section came from the cache.
+    """
+    cacheDirectory = settings.get('conversionCache')
+    if not cacheDirectory or settings.get('columnarFile'): # A cached section has no columnar records to write
+        return renderSection( section, jsonFile, settings, writer )
+    
+    key = conversionCache.sectionKey( section, jsonFile, settings, cacheDirectory )
+    text, report = conversionCache.loadSection( cacheDirectory, key ), None
+    if text is not None:
+        print( f"Using the cached {section} section of {jsonFile}", file=sys.stderr )
+    else:
+        text, report = renderSection( section, jsonFile, settings )
+        conversionCache.storeSection( cacheDirectory, key, text, settings.get('conversionCacheSize') )
+    if writer is None:
+        return text, report
+    writer.writeFragment( text )
+    return None, report
+
+def renderSection( section, jsonFile, settings, writer=None ):
+    """
+    Convert one section from its input file, see convertSection.
+    With settings['shards'] above 1 the input file itself is split over worker processes, see jsonSharding.
+    With settings['profileFile'] the conversion runs under cProfile and the stats are dumped to that file.
+    With settings['incrementalState'] only positions that changed since the conversion that wrote that state file
+    are converted, see jsonIncremental.
+    With settings['columnarFile'] the selected records are also written to that file, see columnarOutput.
+
+    :return: The section text, or None when written with the writer, and the metrics report, or None if metrics are off.
+    """
+    buffer = io.StringIO() if writer is None else None
+    adapter = buildSectionAdapter( section, settings, buffer )
+    if writer is not None:
+        adapter.setWriter( writer )
+    columnarWriter = None
+    if settings.get('columnarFile'):
+        columnarWriter = buildColumnarWriter( settings['columnarFile'], sectionArrays[section], settings )
+        adapter.setColumnarWriter( columnarWriter )
+    shards = settings.get('shards') or 1
+    if adapter.regionQuery is not None:
+        shards = 1 # Only the matching positions are read, or the input is compressed and can't be sharded anyway
+    state = None
+    if settings.get('incrementalState'):
+        state = IncrementalState( settings['incrementalState'], incrementalConfigKey( settings ) )
+        state.load()
+        adapter.setIncrementalState( state )
+        shards = 1 # The state is built in input order by one adapter
+    profiler = cProfile.Profile() if settings.get('profileFile') else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if shards > 1:
+            readJsonFileSharded( adapter, partial(buildSectionAdapter, section, settings), jsonFile, shards )
+        else:
+            adapter.readJsonFile( jsonFile )
+    except BaseException:
+        if columnarWriter is not None:
+            columnarWriter.abort()
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats( settings['profileFile'] )
+    if columnarWriter is not None:
+        columnarWriter.close()
+    if state is not None:
+        state.save()
+        state.printSummary()
+    report = adapter.metrics.asDict() if adapter.metrics is not None else None
+    return buffer.getvalue() if buffer is not None else None, report
+
+def buildColumnarWriter( path, name, settings ):
+    """
+    Create the columnar writer of an output section, eg 'smallMutations', with settings['columnar'] as the format.
+    """
+    return ColumnarWriter( path, name, settings['columnar'], settings.get('columnarBatchSize') or defaultBatchSize,
+                           {'patientId': settings.get('patientID')} )
+
+def convertSections( sections, writer, jobs=None ):
+    """
+    Convert every (section, jsonFile, sectionSettings) and write the sections with the writer in the given order.
+    With more than one job each section runs in its own worker process and writes to an isolated buffer,
+    the buffers are then written out in order so the output is the same as a sequential run.
+
+    :return: The metrics reports of the sections that have metrics on, in section order.
+    """
+    if jobs is None:
+        jobs = min( len(sections), os.cpu_count() or 1 )
+    if any( (sectionSettings.get('shards') or 1) > 1 for section, jsonFile, sectionSettings in sections ):
+        jobs = 1 # Sharded sections run their own process pool, don't nest pools
+    reports = []
+    if jobs <= 1 or len(sections) <= 1:
+        for section, jsonFile, sectionSettings in sections:
+            text, report = convertSection( section, jsonFile, sectionSettings, writer )
+            reports.append( report )
+    else:
+        with ProcessPoolExecutor( max_workers=jobs ) as executor:
+            futures = [ executor.submit( convertSection, section, jsonFile, sectionSettings )
+                        for section, jsonFile, sectionSettings in sections ]
+            for future in futures:
+                text, report = future.result()
+                writer.writeFragment( text )
+                reports.append( report )
+    return [ report for report in reports if report is not None ]
+
+def writeMetricsReport( patient, sectionReports, wallSeconds, metricsFile ):
+    """
+    Write the metrics of a patient's conversion as JSON, see --metrics.
+    CPU time and peak memory of worker processes only count once the workers have finished.
+    """
+    for report in sectionReports:
+        counters = report['counters']
+        if 'positionsEmitted' in counters and 'genesSelected' in counters:
+            counters['genesDeduplicated'] = counters['positionsEmitted'] - counters['genesSelected']
+    report = {
+        'patientID': patient['patientID'],
+        'outputFile': patient['outputFile'],
+        'outputBytes': os.path.getsize( patient['outputFile'] ),
+        'wallSeconds': wallSeconds,
+        'cpuSeconds': cpuSeconds(),
+        'childCpuSeconds': cpuSeconds( children=True ),
+        'peakRssMB': peakRssMB(),
+        'childPeakRssMB': peakRssMB( children=True ),
+        'sections': sectionReports,
+    }
+    with open( metricsFile, 'w' ) as f:
+        json.dump( report, f, indent=4 )
+
+def convertPatient( patient, settings, jobs=None ):
+    """
+    Convert one patient's Nirvana output to a Pori import file.
+    The output is written next to the output file and moved into place once complete,
+    so a failed conversion never leaves a partial file behind.
+
+    :param patient: Dictionary with outputFile, patientID, diseaseName, projectName and template, and the optional
+    input paths cnv, vcf, diseaseZscores and biopsyZscores.
+    :param settings: Conversion settings, see configureAdapter, with the consequence rank maps for the sections
+    in variantConsequenceRank and cnvConsequenceRank.
+    :param jobs: Number of sections to convert in parallel, see convertSections.
+    """
+    start = time.perf_counter()
+    diseaseZscores, biopsyZscores = patient.get('diseaseZscores'), patient.get('biopsyZscores')
+    if bool(diseaseZscores) != bool(biopsyZscores):
+        raise ValueError("Both diseaseZscores and biopsyZscores must be provided to perform expression analysis.")
+    
+    outputFile = patient['outputFile']
+    sections = []
+    if patient.get('cnv'):
+        sections.append( ('cnv', patient['cnv'], settingsForSection( 'cnv', settings )) )
+    if patient.get('vcf'):
+        sections.append( ('vcf', patient['vcf'], settingsForSection( 'vcf', settings )) )
+    for section, jsonFile, sectionSettings in sections:
+        if settings.get('profile'):
+            sectionSettings['profileFile'] = f"{outputFile}.{section}.prof"
+        if settings.get('incremental'):
+            sectionSettings['incrementalState'] = f"{outputFile}.{section}.state"
+        if settings.get('columnar'):
+            sectionSettings['columnarFile'] = sectionFileName( outputFile, sectionArrays[section], settings['columnar'] )
+            sectionSettings['patientID'] = patient['patientID']
+    
+    partialFile = outputFile + '.partial'
+    try:
+        # The sections are converted independently, possibly in parallel, and written here in a fixed order.
+        with open(partialFile, 'w', buffering=writeBufferSize) as output_handle:
+            writer = JsonWriter( output_handle, settings.get('pretty') )
+            mainAdapter = NirvanaJsonAdapter( output_handle )
+            mainAdapter.setWriter( writer )
+            mainAdapter.printOutputHeader(patient['patientID'], patient['diseaseName'], patient['projectName'], patient['template'])
+            
+            sectionReports = convertSections( sections, writer, jobs )
+            
+            if diseaseZscores and biopsyZscores:
+                adapter = ExpressionAdapter(diseaseZscores, biopsyZscores)
+                if settings.get('referenceCache'):
+                    adapter.setReferenceCache( settings['referenceCache'] )
+                columnarWriter = None
+                if settings.get('columnar'):
+                    columnarWriter = buildColumnarWriter( sectionFileName( outputFile, 'expressionVariants', settings['columnar'] ),
+                                                          'expressionVariants', dict( settings, patientID=patient['patientID'] ) )
+                try:
+                    adapter.readZscoreFiles(writer, columnarWriter)
+                except BaseException:
+                    if columnarWriter is not None:
+                        columnarWriter.abort()
+                    raise
+                if columnarWriter is not None:
+                    columnarWriter.close()
+            
+            mainAdapter.printOutputFooter()
+        os.replace( partialFile, outputFile )
+    finally:
+        if os.path.exists( partialFile ):
+            os.remove( partialFile )
+    if settings.get('metrics'):
+        writeMetricsReport( patient, sectionReports, time.perf_counter() - start, outputFile + '.metrics.json' )
+
+def addConversionArguments( parser ):
+    """
+    Add the command line options that tune a conversion, shared with the batch runner.
+    """
+    parser.add_argument('--ijsonBackend', type=str, required=False, default=None, choices=ijsonBackendPreference, help='Force a specific ijson backend. Default is the fastest one available.')
+    parser.add_argument('--decompressionThreads', type=int, required=False, default=None, help='Threads used to decompress bgzipped input. Default is one per CPU.')
+    parser.add_argument('--memoryBudget', type=int, required=False, default=None, help='Megabytes of selected records to hold in memory per section before spilling to disk. Default is 512.')
+    parser.add_argument('--consequencePriorities', type=str, required=False, default=None, help='JSON file with variantConsequencePriorityList and/or cnvConsequencePriorityList arrays, best consequence first, to replace the built in priorities.')
+    parser.add_argument('--passFilters', type=str, required=False, default=None, help='Comma separated filter values that let a position through, eg PASS,lowDP. Default is PASS. Other positions are skipped as soon as their filters are read.')
+    parser.add_argument('--pretty', action='store_true', help='Indent the output JSON. Default is compact output.')
+    parser.add_argument('--noPruning', action='store_true', help='Parse every subtree of the input, including annotations and sections that are never mapped. Only useful to rule out the pruning when debugging.')
+    parser.add_argument('--conversionCache', type=str, required=False, default=None, help='Directory to keep converted sections in. A section whose input file, conversion code and output settings are unchanged is taken from the cache, so a re-run with other header fields only writes the header. Default is no cache.')
+    parser.add_argument('--conversionCacheSize', type=int, required=False, default=None, help='Megabytes the conversion cache may use before the least recently used sections are evicted. Default is 4096.')
+    parser.add_argument('--regions', type=str, required=False, default=None, help='BED file of regions. Only positions overlapping a region are converted. bgzipped and uncompressed input is indexed on first use, <input>.pidx, so only the blocks holding those positions are read.')
+    parser.add_argument('--genes', type=str, required=False, default=None, help='Gene panel, a file with one gene per line or comma separated names. Only positions with a transcript of a listed gene are read, and only records for listed genes are output. Uses the same index as --regions.')
+    parser.add_argument('--genePanel', type=str, required=False, default=None, help='Gene panel BED file with the gene names in the name column. Positions overlapping a panel gene are converted, CNVs spanning a gene included, and only records for panel genes are output. Unlike --genes, compressed input can skip positions outside the panel before their transcripts are parsed. Can\'t be combined with --regions or --genes.')
+    parser.add_argument('--columnar', type=str, required=False, default=None, choices=list(formatExtensions), help='Also write each section as a columnar file for analytics, <outputFile>.<section>.parquet (zstd compressed) or .feather (uncompressed Arrow, memory mapped when read back). Needs pyarrow. Sections are then always converted, not taken from the conversion cache.')
+    parser.add_argument('--columnarBatchSize', type=int, required=False, default=None, help=f'Rows per record batch of the columnar files. Default is {defaultBatchSize}.')
+    parser.add_argument('--incremental', action='store_true', help='Keep a fingerprint and the output record of every position in <outputFile>.<section>.state, and only convert positions that changed since the last incremental conversion to the same output file, eg after Nirvana is re-run with new annotation sources. Input files are not sharded.')
+    parser.add_argument('--referenceCache', type=str, required=False, default=None, help='Directory to keep disease z-score references in, compiled for memory mapping. The first conversion with a reference compiles it, later ones load it in milliseconds. Default is no cache.')
+    parser.add_argument('--metrics', action='store_true', help='Write stage timings, throughput counters and peak memory to <outputFile>.metrics.json.')
+    parser.add_argument('--profile', action='store_true', help='Run each section under cProfile and dump the stats to <outputFile>.<section>.prof, for pstats or snakeviz.')
+    parser.add_argument('--sampleEvents', type=int, required=False, default=None, help='Add a throughput and memory sample to the metrics every N parser events. Implies --metrics.')
+
+def buildSettings( args ):
+    """
+    Build the conversion settings from the options added by addConversionArguments.
+    """
+    regions = readBedFile( args.regions ) if args.regions else None
+    genes = readGeneList( args.genes ) if args.genes else None
+    if args.genePanel:
+        if regions is not None or genes is not None:
+            raise ValueError( "--genePanel can't be combined with --regions or --genes" )
+        regions, genes = readGenePanel( args.genePanel )
+
+    variantConsequenceRank, cnvConsequenceRank = None, None
+    if args.consequencePriorities:
+        variantConsequenceRank, cnvConsequenceRank = loadConsequencePriorities(args.consequencePriorities)
+    
+    return {
+        'ijsonBackend': args.ijsonBackend,
+        'decompressionThreads': args.decompressionThreads,
+        'memoryBudget': args.memoryBudget * 1024 * 1024 if args.memoryBudget is not None else None,
+        'noPruning': args.noPruning,
+        'passFilters': args.passFilters.split(',') if args.passFilters else None,
+        'pretty': args.pretty,
+        'conversionCache': args.conversionCache,
+        'conversionCacheSize': args.conversionCacheSize * 1024 * 1024 if args.conversionCacheSize is not None else None,
+        'referenceCache': args.referenceCache,
+        'incremental': args.incremental,
+        'columnar': args.columnar,
+        'columnarBatchSize': args.columnarBatchSize,
+        'regions': regions,
+        'genes': genes,
+        'metrics': args.metrics or bool(args.sampleEvents),
+        'profile': args.profile,
+        'sampleEvents': args.sampleEvents,
+        'variantConsequenceRank': variantConsequenceRank,
+        'cnvConsequenceRank': cnvConsequenceRank,
+    }
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Nirvana Pori Import Adapter")
@@ -23,39 +340,13 @@ if __name__ == "__main__":
     parser.add_argument('--diseaseName', metavar='d', type=str, required=True, help='Disease name for kbDiseaseMatch and is used to populate the matchedCancer flag. eg: sarcoma, colorectal cancer')
     parser.add_argument('--projectName', metavar='j', type=str, required=False, default="PORI", help='Project name for Pori')
     parser.add_argument('--template', metavar='t', type=str, required=False, default="genomic", help='Template for the Pori import. Default is "genomic".')
+    parser.add_argument('--jobs', type=int, required=False, default=None, help='Number of sections to convert in parallel worker processes. Default is one per section, up to the number of CPUs. Use 1 to convert sequentially.')
+    parser.add_argument('--shards', type=int, required=False, default=None, help='Split each uncompressed input JSON file into this many byte ranges parsed in parallel worker processes. Sections are then converted one after the other. Default is no sharding.')
+    addConversionArguments( parser )
     args = parser.parse_args()
     
-    # Because many objects will be writing to the output file, I'm opening it here.
-    # Could refactor this so that each object opens the file and writes when needed with a lock
-    # That would allow multithreaded processing until printing is needed.
-    with open(args.outputFile, 'w') as output_handle:
-        mainAdapter = NirvanaJsonAdapter( output_handle )
-        mainAdapter.printOutputHeader(args.patientID, args.diseaseName, args.projectName, args.template)
-        iterator = 0 # JSON requires a comma between objects, so this is used to track if we need to print a comma.
-        
-        if args.cnv:
-            adapter = CnvAdapter( output_handle )
-            adapter.readJsonFile( args.cnv )
-            iterator += 1
-        
-        if args.vcf:
-            printComma(iterator, output_handle)
-            adapter = VcfAdapter( output_handle )
-            adapter.readJsonFile(args.vcf)
-            iterator += 1
-
-        if (args.diseaseZscores and not args.biopsyZscores) or (args.biopsyZscores and not args.diseaseZscores):
-            raise ValueError("Both diseaseZscores and biopsyZscores must be provided to perform expression analysis.")
-            
-        
-        if args.diseaseZscores and args.biopsyZscores:
-            adapter = ExpressionAdapter(args.diseaseZscores, args.biopsyZscores)
-            adapter.readZscoreFiles(output_handle)
-            iterator += 1
-            
-        
-        mainAdapter.printOutputFooter()
-    
-    
-    
-    
\ No newline at end of file
+    settings = buildSettings( args )
+    settings['shards'] = args.shards
+    patient = { key: getattr(args, key) for key in ('cnv', 'vcf', 'diseaseZscores', 'biopsyZscores', 'outputFile',
+                                                     'patientID', 'diseaseName', 'projectName', 'template') }
+    convertPatient( patient, settings, args.jobs )
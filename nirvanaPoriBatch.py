@@ -0,0 +1,164 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from nirvanaPoriAdapter import convertPatient, addConversionArguments, buildSettings
+
+# Manifest columns, named like the nirvanaPoriAdapter.py options.
+requiredColumns = ['patientID', 'diseaseName', 'outputFile']
+inputColumns = ['cnv', 'vcf', 'diseaseZscores', 'biopsyZscores']
+optionalColumns = ['projectName', 'template']
+
+def readManifest(manifestFile):
+    """
+    Read the batch manifest, either a JSON array of objects or a tab separated file with a header line.
+    Empty values are treated as missing.
+
+    :return: List of dictionaries, one per patient, in manifest order.
+    :raises ValueError: If a required column is missing or a patient has no input files.
+    """
+    with open(manifestFile, 'r') as f:
+        if manifestFile.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f, delimiter='\t'))
+
+    return [checkPatient(row, f"Manifest entry {line}") for line, row in enumerate(rows, start=1)]
+
+def checkPatient(row, label):
+    """
+    Check a patient has the required columns and an input file, dropping empty values.
+
+    :param label: Names the patient in errors, eg "Manifest entry 3".
+    :raises ValueError: If a required column is missing or the patient has no input files.
+    """
+    patient = {key: value for key, value in row.items() if value not in (None, '')}
+    missing = [column for column in requiredColumns if column not in patient]
+    if missing:
+        raise ValueError(f"{label} is missing: {', '.join(missing)}")
+    if not any(column in patient for column in inputColumns):
+        raise ValueError(f"{label} ({patient['patientID']}) has no input files")
+    return patient
+
+def convertManifestEntry(patient, settings):
+    """
+    Convert one manifest entry in a worker process and return how long it took.
+    """
+    start = time.perf_counter()
+    convertPatient(patient, settings, jobs=1) # The batch already uses every worker, don't nest pools
+    return time.perf_counter() - start
+
+def runBatch(patients, settings, workers=None, retries=0, status_handle=None, convert=convertManifestEntry):
+    """
+    Convert every patient on a pool of worker processes.
+    The workers are reused across patients, so interpreter startup and imports are only paid once per worker.
+    At most one patient per worker is handed to the pool at a time.
+    A failed conversion is retried up to retries times and then reported, the rest of the batch carries on.
+    If a worker dies, eg killed for running out of memory, every patient in the pool fails with it.  The pool is
+    replaced and those patients are run again one at a time without counting the attempt, so only the patient
+    that kills a worker on its own is charged for it.
+
+    :param patients: Manifest entries, see readManifest, with projectName and template filled in.
+    :param status_handle: Optional handle for a tab separated status line per patient.
+    :param convert: Function the workers run for each patient, see convertManifestEntry.
+    :return: Number of patients that failed.
+    """
+    workers = workers or os.cpu_count() or 1
+    if status_handle is not None:
+        print("patientID\tstatus\tattempts\tseconds\toutputFile\terror", file=status_handle)
+
+    failed = 0
+    attempts = {}
+    pending = {}
+    waiting = deque(range(len(patients)))
+    isolated = deque() # Patients that were in the pool when a worker died, run alone to find the one that killed it
+    executor = ProcessPoolExecutor(max_workers=workers)
+    def submit(index):
+        nonlocal executor
+        attempts[index] = attempts.get(index, 0) + 1
+        try:
+            future = executor.submit(convert, patients[index], settings)
+        except BrokenProcessPool:
+            executor.shutdown(wait=False)
+            executor = ProcessPoolExecutor(max_workers=workers)
+            future = executor.submit(convert, patients[index], settings)
+        pending[future] = index
+
+    try:
+        while waiting or isolated or pending:
+            if isolated:
+                if not pending:
+                    submit(isolated.popleft())
+            else:
+                while waiting and len(pending) < workers:
+                    submit(waiting.popleft())
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            caughtInCrash = False
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                done, _ = wait(pending) # The other patients in the pool fail with it
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers)
+                caughtInCrash = sum(isinstance(future.exception(), BrokenProcessPool) for future in done) > 1
+
+            for future in done:
+                index = pending.pop(future)
+                patient = patients[index]
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool) and caughtInCrash:
+                    print(f"[isolate] {patient['patientID']} was in the pool when a worker died, running it on its own", file=sys.stderr)
+                    attempts[index] -= 1
+                    isolated.append(index)
+                    continue
+                if error is None:
+                    seconds = future.result()
+                    print(f"[ok] {patient['patientID']} in {seconds:.1f}s -> {patient['outputFile']}", file=sys.stderr)
+                    status = ('ok', f"{seconds:.2f}", '')
+                else:
+                    message = f"{type(error).__name__}: {error}"
+                    if attempts[index] <= retries:
+                        print(f"[retry] {patient['patientID']} attempt {attempts[index]} failed, {message}", file=sys.stderr)
+                        waiting.appendleft(index)
+                        continue
+                    print(f"[failed] {patient['patientID']} after {attempts[index]} attempts, {message}", file=sys.stderr)
+                    status = ('failed', '', message.replace('\t', ' ').replace('\n', ' '))
+                    failed += 1
+                if status_handle is not None:
+                    print(f"{patient['patientID']}\t{status[0]}\t{attempts[index]}\t{status[1]}\t{patient['outputFile']}\t{status[2]}",
+                          file=status_handle, flush=True)
+    finally:
+        executor.shutdown(wait=True)
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a batch of patients listed in a manifest to Pori import files")
+    parser.add_argument('manifest', type=str, help='TSV file with a header line, or JSON array of objects, with the columns '
+                        + ', '.join(requiredColumns + inputColumns + optionalColumns) + ' named like the nirvanaPoriAdapter.py options.')
+    parser.add_argument('--workers', type=int, required=False, default=None, help='Number of patients to convert in parallel. Default is one per CPU.')
+    parser.add_argument('--retries', type=int, required=False, default=0, help='Times to retry a failed conversion before giving up on it. Default is 0.')
+    parser.add_argument('--statusFile', type=str, required=False, default=None, help='Write a tab separated status line per patient to this file.')
+    parser.add_argument('--projectName', type=str, required=False, default="PORI", help='Project name for patients without one in the manifest.')
+    parser.add_argument('--template', type=str, required=False, default="genomic", help='Template for patients without one in the manifest.')
+    addConversionArguments(parser)
+    args = parser.parse_args()
+
+    patients = readManifest(args.manifest)
+    for patient in patients:
+        patient.setdefault('projectName', args.projectName)
+        patient.setdefault('template', args.template)
+    settings = buildSettings(args)
+
+    start = time.perf_counter()
+    if args.statusFile:
+        with open(args.statusFile, 'w') as status_handle:
+            failed = runBatch(patients, settings, args.workers, args.retries, status_handle)
+    else:
+        failed = runBatch(patients, settings, args.workers, args.retries)
+    print(f"Converted {len(patients) - failed} of {len(patients)} patients in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    if failed:
+        sys.exit(1)
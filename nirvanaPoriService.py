@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
+import referenceCache
+from nirvanaPoriAdapter import addConversionArguments, buildSettings
+from nirvanaPoriBatch import convertManifestEntry, checkPatient
+
+# Long running conversion service for callers that would otherwise start nirvanaPoriAdapter.py once per sample.
+# Jobs are posted as JSON over a local HTTP socket, TCP on localhost or a Unix socket, and run on a bounded pool of
+# worker processes that stay up between jobs, so imports, the consequence priority tables and the disease references
+# are only loaded once.
+#
+#   POST /jobs                 Body is a patient like a batch manifest entry, answers 202 with the job
+#   GET  /jobs                 Every job the service remembers
+#   GET  /jobs/<id>            The job, with its status: queued, running, done or failed
+#   GET  /jobs/<id>/events     The job's events as JSON lines, streamed until the job is finished
+#   GET  /jobs/<id>/result     The converted output file, once the job is done
+#   GET  /health               Worker and queue counts
+#
+# eg curl --unix-socket /tmp/pori.sock -d '{"patientID": "P1", "diseaseName": "sarcoma", "vcf": "/data/P1.json.gz",
+#    "outputFile": "/data/P1.pori.json"}' http://localhost/jobs
+
+maxRequestBytes = 1024 * 1024
+resultChunkSize = 1 << 20
+statusText = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+              409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class HttpError(Exception):
+    """
+    Raised by a request handler to answer with an error status.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def initializeWorker():
+    """
+    Run once in every worker process, before its first job.
+    """
+    referenceCache.keepReferencesResident()
+
+class ConversionJob:
+    """
+    A conversion and the events it went through, which clients can wait on.
+    """
+
+    def __init__(self, jobID, patient):
+        self.id = jobID
+        self.patient = patient
+        self.status = 'queued'
+        self.error = None
+        self.seconds = None
+        self.attempts = 0
+        self.events = []
+        self.changed = asyncio.Condition()
+
+    async def addEvent(self, status, **details):
+        self.status = status
+        event = dict(status=status, time=time.time(), **details)
+        async with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def isFinished(self):
+        return self.status in ('done', 'failed')
+
+    def asDict(self):
+        job = {'id': self.id, 'status': self.status, 'attempts': self.attempts, 'patientID': self.patient['patientID'],
+               'outputFile': self.patient['outputFile']}
+        if self.seconds is not None:
+            job['seconds'] = self.seconds
+        if self.error is not None:
+            job['error'] = self.error
+        return job
+
+class ConversionService:
+    """
+    Accepts conversion jobs over HTTP and runs them on a pool of worker processes.
+    """
+
+    def __init__(self, settings, workers=None, retries=0, maxQueued=100, keepJobs=1000, defaults=None,
+                 convert=convertManifestEntry):
+        """
+        :param settings: Conversion settings for every job, see nirvanaPoriAdapter.buildSettings.
+        :param workers: Number of jobs converted at the same time.  Default is one per CPU.
+        :param retries: Times a failed job is run again before it is reported as failed.
+        :param maxQueued: Jobs waiting for a worker before new jobs are turned away with 503.
+        :param keepJobs: Finished jobs remembered for status requests, the oldest are forgotten first.
+        :param defaults: Values for patients without them, eg projectName and template.
+        :param convert: Function the workers run for each job, see nirvanaPoriBatch.convertManifestEntry.
+        """
+        self.settings = settings
+        self.workers = workers or os.cpu_count() or 1
+        self.retries = retries
+        self.maxQueued = maxQueued
+        self.keepJobs = keepJobs
+        self.defaults = defaults or {}
+        self.convert = convert
+        self.jobs = {} # id -> ConversionJob, in submission order
+        self.jobIDs = itertools.count(1)
+        self.slots = None
+        self.executor = None
+        self.tasks = set()
+
+    def startPool(self):
+        self.slots = asyncio.Semaphore(self.workers)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=initializeWorker)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def queuedCount(self):
+        return sum(1 for job in self.jobs.values() if job.status == 'queued')
+
+    def runningCount(self):
+        return sum(1 for job in self.jobs.values() if job.status == 'running')
+
+    def submitJob(self, patient):
+        """
+        Queue a conversion and return its job straight away.
+
+        :raises HttpError: 400 for an invalid patient, 503 if the queue is full.
+        """
+        if not isinstance(patient, dict):
+            raise HttpError(400, "The job must be a JSON object")
+        try:
+            patient = checkPatient(dict(self.defaults, **patient), "The job")
+        except ValueError as error:
+            raise HttpError(400, str(error)) from None
+        if self.queuedCount() >= self.maxQueued:
+            raise HttpError(503, f"{self.maxQueued} jobs are already waiting, try again later")
+        self.forgetFinishedJobs()
+        job = ConversionJob(str(next(self.jobIDs)), patient)
+        self.jobs[job.id] = job
+        job.events.append({'status': 'queued', 'time': time.time()})
+        task = asyncio.get_running_loop().create_task(self.runJob(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    def forgetFinishedJobs(self):
+        finished = [jobID for jobID, job in self.jobs.items() if job.isFinished()]
+        for jobID in finished[:max(0, len(finished) - self.keepJobs + 1)]:
+            del self.jobs[jobID]
+
+    async def runJob(self, job):
+        """
+        Wait for a free worker and convert the job, retrying it up to self.retries times.
+        """
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            while True:
+                job.attempts += 1
+                await job.addEvent('running', attempt=job.attempts)
+                executor = self.executor
+                try:
+                    try:
+                        seconds = await loop.run_in_executor(executor, self.convert, job.patient, self.settings)
+                    except BrokenProcessPool:
+                        # A worker died, eg killed for running out of memory, the pool is replaced for the next jobs.
+                        # Every job on the broken pool ends up here, only the first one replaces it.
+                        if self.executor is executor:
+                            executor.shutdown(wait=False)
+                            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=initializeWorker)
+                        raise
+                except Exception as error:
+                    message = f"{type(error).__name__}: {error}"
+                    if job.attempts <= self.retries:
+                        print(f"[retry] job {job.id} {job.patient['patientID']} attempt {job.attempts} failed, {message}", file=sys.stderr)
+                        await job.addEvent('retrying', error=message)
+                        continue
+                    print(f"[failed] job {job.id} {job.patient['patientID']} after {job.attempts} attempts, {message}", file=sys.stderr)
+                    job.error = message
+                    await job.addEvent('failed', error=message)
+                    return
+                job.seconds = round(seconds, 3)
+                print(f"[ok] job {job.id} {job.patient['patientID']} in {seconds:.1f}s -> {job.patient['outputFile']}", file=sys.stderr)
+                await job.addEvent('done', seconds=job.seconds, outputBytes=os.path.getsize(job.patient['outputFile']))
+                return
+
+    def getJob(self, jobID):
+        job = self.jobs.get(jobID)
+        if job is None:
+            raise HttpError(404, f"No job {jobID}")
+        return job
+
+    async def handleConnection(self, reader, writer):
+        try:
+            try:
+                request = await readRequest(reader)
+                if request is not None:
+                    await self.route(*request, writer)
+            except HttpError as error:
+                await sendJson(writer, error.status, {'error': str(error)})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except Exception as error:
+                print(f"Request failed, {type(error).__name__}: {error}", file=sys.stderr)
+                await sendJson(writer, 500, {'error': f"{type(error).__name__}: {error}"})
+        except ConnectionError:
+            pass # The client went away before the answer
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body, writer):
+        parts = [part for part in urlsplit(path).path.split('/') if part]
+        if parts == ['health']:
+            requireMethod(method, 'GET')
+            await sendJson(writer, 200, {'workers': self.workers, 'running': self.runningCount(),
+                                         'queued': self.queuedCount(), 'jobs': len(self.jobs)})
+        elif parts == ['jobs']:
+            if method == 'POST':
+                try:
+                    patient = json.loads(body or b'null')
+                except ValueError as error:
+                    raise HttpError(400, f"The job isn't valid JSON: {error}") from None
+                await sendJson(writer, 202, self.submitJob(patient).asDict())
+            else:
+                requireMethod(method, 'GET')
+                await sendJson(writer, 200, [job.asDict() for job in self.jobs.values()])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            requireMethod(method, 'GET')
+            await sendJson(writer, 200, self.getJob(parts[1]).asDict())
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            requireMethod(method, 'GET')
+            await self.streamEvents(self.getJob(parts[1]), writer)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+            requireMethod(method, 'GET')
+            await self.sendResult(self.getJob(parts[1]), writer)
+        else:
+            raise HttpError(404, f"Nothing at {path}")
+
+    async def streamEvents(self, job, writer):
+        """
+        Send the job's events as JSON lines as they happen, ending with the event that finishes the job.
+        """
+        await sendHead(writer, 200, 'application/x-ndjson')
+        sent = 0
+        while True:
+            async with job.changed:
+                await job.changed.wait_for(lambda: len(job.events) > sent)
+                events = job.events[sent:]
+            sent += len(events)
+            for event in events:
+                await sendChunk(writer, json.dumps(event).encode() + b'\n')
+            if job.isFinished():
+                break
+        await sendChunk(writer, b'')
+
+    async def sendResult(self, job, writer):
+        if job.status != 'done':
+            raise HttpError(409, f"Job {job.id} is {job.status}, the result is only there once it is done")
+        try:
+            f = open(job.patient['outputFile'], 'rb')
+        except OSError as error:
+            raise HttpError(404, f"The output of job {job.id} is gone: {error}") from None
+        with f:
+            await sendHead(writer, 200, 'application/json')
+            while True:
+                chunk = f.read(resultChunkSize)
+                await sendChunk(writer, chunk)
+                if not chunk:
+                    break
+
+def requireMethod(method, allowed):
+    if method != allowed:
+        raise HttpError(405, f"Use {allowed}")
+
+async def readRequest(reader):
+    """
+    Read an HTTP/1.1 request.
+
+    :return: (method, path, body), or None if the client closed the connection without sending one.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as error:
+        if not error.partial.strip():
+            return None
+        raise HttpError(400, "Incomplete request") from None
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "Request headers too large") from None
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, version = lines[0].split(' ')
+    except ValueError:
+        raise HttpError(400, f"Invalid request line {lines[0]!r}") from None
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(':')
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > maxRequestBytes:
+        raise HttpError(413, f"Requests are limited to {maxRequestBytes} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path, body
+
+async def sendHead(writer, status, contentType):
+    """
+    Start a chunked response, the body follows with sendChunk.
+    """
+    writer.write(f"HTTP/1.1 {status} {statusText.get(status, '')}\r\nContent-Type: {contentType}\r\n"
+                 f"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+
+async def sendChunk(writer, data):
+    """
+    Send a piece of a chunked response, an empty piece ends the response.
+    """
+    writer.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+    await writer.drain()
+
+async def sendJson(writer, status, value):
+    body = json.dumps(value, indent=4).encode() + b'\n'
+    writer.write(f"HTTP/1.1 {status} {statusText.get(status, '')}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+
+async def serve(service, host='127.0.0.1', port=8080, socketPath=None):
+    """
+    Run the service until SIGINT or SIGTERM, on a Unix socket if socketPath is given, otherwise on host:port.
+    Jobs still running when the service stops are finished before the workers exit, queued jobs are dropped.
+    """
+    service.startPool()
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            os.remove(socketPath) # Left behind by a service that didn't stop cleanly
+        server = await asyncio.start_unix_server(service.handleConnection, path=socketPath)
+        print(f"Listening on {socketPath} with {service.workers} workers", file=sys.stderr)
+    else:
+        server = await asyncio.start_server(service.handleConnection, host=host, port=port)
+        print(f"Listening on http://{host}:{port} with {service.workers} workers", file=sys.stderr)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signalNumber in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signalNumber, stopping.set)
+    try:
+        async with server:
+            await stopping.wait()
+    finally:
+        print("Stopping", file=sys.stderr)
+        await loop.run_in_executor(None, service.shutdown)
+        if socketPath is not None and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local service converting Nirvana output to Pori import files on request")
+    parser.add_argument('--socket', type=str, required=False, default=None, help='Listen on this Unix socket instead of TCP.')
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1', help='Address to listen on. Default is 127.0.0.1, only local callers.')
+    parser.add_argument('--port', type=int, required=False, default=8080, help='TCP port to listen on. Default is 8080.')
+    parser.add_argument('--workers', type=int, required=False, default=None, help='Number of patients to convert in parallel. Default is one per CPU.')
+    parser.add_argument('--retries', type=int, required=False, default=0, help='Times to retry a failed conversion before giving up on it. Default is 0.')
+    parser.add_argument('--maxQueued', type=int, required=False, default=100, help='Jobs that may wait for a worker before new jobs are turned away. Default is 100.')
+    parser.add_argument('--keepJobs', type=int, required=False, default=1000, help='Finished jobs remembered for status requests. Default is 1000.')
+    parser.add_argument('--projectName', type=str, required=False, default="PORI", help='Project name for jobs without one.')
+    parser.add_argument('--template', type=str, required=False, default="genomic", help='Template for jobs without one.')
+    addConversionArguments(parser)
+    args = parser.parse_args()
+
+    service = ConversionService(buildSettings(args), args.workers, args.retries, args.maxQueued, args.keepJobs,
+                                {'projectName': args.projectName, 'template': args.template})
+    asyncio.run(serve(service, args.host, args.port, args.socket))
@@ -0,0 +1,79 @@
+from dataclasses import dataclass, field
+from jsonConstants import unrankedConsequence
+
+# Record types filled by the event dispatcher while a position is parsed.
+# Field names are the names given to addSimpleMapping, list fields collect repeated JSON array items.
+
+@dataclass(slots=True)
+class Transcript:
+    """
+    A transcript of a variant, with the consequences Nirvana predicted for it.
+    consequenceRank is the rank of the best consequence, kept up to date as consequences are parsed.
+    """
+    transcript: str = None
+    source: str = None
+    gene: str = None
+    bioType: str = None
+    hgvsc: str = None
+    hgvsp: str = None
+    isCanonical: bool = None
+    completeOverlap: bool = None
+    consequence: list = field(default_factory=list)
+    consequenceRank: int = unrankedConsequence
+
+@dataclass(slots=True)
+class Variant:
+    """
+    A variant at a position, with its transcripts.
+    """
+    vid: str = None
+    startPosition: int = None
+    endPosition: int = None
+    refAllele: str = None
+    altAllele: str = None
+    variantType: str = None
+    hgvsg: str = None
+    phylopScore: str = None
+    transcripts: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class Sample:
+    """
+    Sample level values for a position.
+    """
+    genotype: str = None
+    copyNumber: int = None
+    minorHaplotype: int = None
+    lossOfHeterozygosity: int = None
+    totalDepth: int = None
+    somaticQuality: str = None
+    variantFrequencies: list = field(default_factory=list)
+    alleleDepths: list = field(default_factory=list)
+
+@dataclass(slots=True)
+class Position:
+    """
+    A Nirvana position with its filters, samples and variants.
+    fingerprint identifies the position's input line in incremental conversions, see jsonIncremental.
+    extentEnd is the last base the position covers, see NirvanaJsonAdapter.handlePositionExtent.
+    """
+    chromosome: str = None
+    start: int = None
+    end: int = None
+    extentEnd: int = None
+    cytogeneticBand: str = None
+    filters: list = field(default_factory=list)
+    samples: list = field(default_factory=list)
+    variants: list = field(default_factory=list)
+    fingerprint: str = None
+
+def collapseList(values):
+    """
+    Collapse a list field the way repeated JSON values have always been written out:
+    None when empty, the value itself when there is only one, otherwise a copy of the list.
+    """
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return list(values)
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import numpy as np
+except ImportError: # Only used by ExpressionAdapter, which reports the missing numpy
+    np = None
+
+# Compiled z-score reference matrices.  A reference TSV is parsed once into a .npy file and a gene list in the cache
+# directory, later loads memory map the .npy file so no time goes into parsing and the pages are shared between
+# processes converting patients with the same disease.
+# An entry is found from the path, size and modification time of the TSV.  The content digest is stored with it and
+# checked on load, so a file rewritten with the same size and modification time is compiled again.
+
+cacheFormatVersion = 1
+matrixFileName = 'matrix.npy'
+metadataFileName = 'reference.json'
+
+# References kept in memory by a long running process, realpath -> (entry key, genes, matrix), see
+# keepReferencesResident.  None when references aren't kept.
+residentReferences = None
+
+def keepReferencesResident():
+    """
+    Keep the references this process loads in memory, so a long running process, eg a nirvanaPoriService worker,
+    only loads each one once.  A reference file that is replaced is loaded again, resident references are matched on
+    the path, size and modification time of the file only, its content isn't hashed on every use.
+    """
+    global residentReferences
+    if residentReferences is None:
+        residentReferences = {}
+
+def entryKey(path):
+    """
+    Name of the cache entry of a reference TSV, changes whenever the file is replaced or modified.
+    """
+    stat = os.stat(path)
+    source = f"{os.path.realpath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}\t{cacheFormatVersion}"
+    return hashlib.sha1(source.encode()).hexdigest()
+
+def fileDigest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def storeReference(path, cacheDirectory, genes, samples, reference):
+    """
+    Store a parsed reference TSV as a cache entry.
+    The entry is written to a temporary directory and renamed into place, so a process never sees half an entry
+    and two processes compiling the same reference don't get in each other's way.
+    """
+    entryDirectory = os.path.join(cacheDirectory, entryKey(path))
+    os.makedirs(cacheDirectory, exist_ok=True)
+    building = tempfile.mkdtemp(prefix='.building-', dir=cacheDirectory)
+    try:
+        np.save(os.path.join(building, matrixFileName), reference)
+        metadata = {'version': cacheFormatVersion, 'source': os.path.realpath(path), 'sha1': fileDigest(path),
+                    'samples': samples, 'genes': genes}
+        with open(os.path.join(building, metadataFileName), 'w') as f:
+            json.dump(metadata, f)
+        try:
+            os.rename(building, entryDirectory)
+        except OSError:
+            pass # Another process finished the same entry first
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+    removeStaleEntries(cacheDirectory, os.path.realpath(path), os.path.basename(entryDirectory))
+
+def removeStaleEntries(cacheDirectory, source, keep):
+    """
+    Remove the entries of earlier versions of a reference file.
+    """
+    for name in os.listdir(cacheDirectory):
+        if name == keep or name.startswith('.'):
+            continue
+        try:
+            with open(os.path.join(cacheDirectory, name, metadataFileName)) as f:
+                stale = json.load(f).get('source') == source
+        except (OSError, ValueError):
+            continue
+        if stale:
+            shutil.rmtree(os.path.join(cacheDirectory, name), ignore_errors=True)
+
+def loadCachedReference(path, cacheDirectory):
+    """
+    Load the compiled version of a reference TSV.
+
+    :param cacheDirectory: Directory of the compiled references.
+    :return: (genes, read only memory mapped reference matrix), or None if the reference isn't in the cache or
+    the TSV no longer has the content it was compiled from.
+    """
+    entryDirectory = os.path.join(cacheDirectory, entryKey(path))
+    try:
+        with open(os.path.join(entryDirectory, metadataFileName)) as f:
+            metadata = json.load(f)
+        if metadata.get('sha1') != fileDigest(path):
+            shutil.rmtree(entryDirectory, ignore_errors=True) # Make way for the entry of the new content
+            return None
+        reference = np.load(os.path.join(entryDirectory, matrixFileName), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return metadata['genes'], reference
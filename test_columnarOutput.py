@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from columnarOutput import readColumnar, sectionColumns, sectionFileName
+from nirvanaBenchmark import addGeneratorArguments, generateNirvanaJson
+
+# The columnar files written next to the JSON output must hold the same records, read back with readColumnar.
+
+repoDirectory = os.path.dirname(os.path.abspath(__file__))
+
+def expectedRow(record, columns, patientID):
+    """
+    What a JSON record becomes in a columnar file: list columns always hold lists and decimals are floats.
+    """
+    row = {}
+    for column, kind in columns:
+        value = patientID if column == 'patientId' else record.get(column)
+        if value is not None and kind in ('strings', 'ints', 'floats'):
+            value = value if isinstance(value, list) else [value]
+            if kind == 'floats':
+                value = [float(item) for item in value]
+        elif value is not None and kind == 'float':
+            value = float(value)
+        row[column] = value
+    return row
+
+@pytest.fixture(scope='module')
+def inputs(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('inputs')
+    parser = argparse.ArgumentParser()
+    addGeneratorArguments(parser)
+    paths = {}
+    for section, extra in (('cnv', ['--cnv']), ('vcf', [])):
+        paths[section] = str(directory / f"{section}.json")
+        generateNirvanaJson(paths[section], parser.parse_args(['--positions', '1200', '--genes', '200'] + extra))
+    return paths
+
+@pytest.mark.parametrize('columnarFormat', ['parquet', 'feather'])
+def test_columnarRoundTrip(inputs, tmp_path, columnarFormat):
+    outputFile = str(tmp_path / 'out.json')
+    # Small batches, so the files are written in several record batches
+    subprocess.run([sys.executable, os.path.join(repoDirectory, 'nirvanaPoriAdapter.py'), '--cnv', inputs['cnv'],
+                    '--vcf', inputs['vcf'], '--outputFile', outputFile, '--diseaseName', 'sarcoma', '--patientID', 'P1',
+                    '--columnar', columnarFormat, '--columnarBatchSize', '50'], check=True, cwd=repoDirectory,
+                   capture_output=True)
+    with open(outputFile) as f:
+        document = json.load(f)
+
+    for name in ('copyVariants', 'smallMutations'):
+        assert len(document[name]) > 50
+        path = sectionFileName(outputFile, name, columnarFormat)
+        rows = readColumnar(path).to_pylist()
+        assert rows == [expectedRow(record, sectionColumns[name], 'P1') for record in document[name]]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.partial')]
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import ExpressionAdapter as expressionModule
+from ExpressionAdapter import ExpressionAdapter
+
+# Outlier calls on a cohort small enough to work out by hand.  Eight samples per gene, z-scores use the population
+# standard deviation, quartiles are interpolated linearly and percentiles count ties as half.
+
+disease = """gene\ts1\ts2\ts3\ts4\ts5\ts6\ts7\ts8
+UP\t0\t1\t2\t3\t4\t5\t6\t7
+DOWN\t0\t1\t2\t3\t4\t5\t6\t7
+MIDDLE\t0\t1\t2\t3\t4\t5\t6\t7
+UNUSED\t9\t9\t9\t9\t9\t9\t9\t9
+GATED\t0\t0\t0\t0\t0\t0\t0\t100
+MISSING\t0\t1\t2\t3\t4\t5\t6\tNA
+"""
+
+# The second column must be ignored, only the first sample of the biopsy file is scored
+biopsy = """gene\tbiopsy\tother
+UP\t10\t0
+MIDDLE\t4\t100
+NOT_IN_COHORT\t50\t0
+GATED\t99\t0
+DOWN\t-3\t0
+MISSING\t20\t0
+"""
+
+expected = [
+    # 0..7: mean 3.5, sd sqrt(5.25), quartiles 1.75 and 5.25.  10 is above every sample
+    {'gene': 'UP', 'kbCategory': 'increased expression', 'expressionState': 'outlier_high',
+     'diseasePercentile': 100.0, 'diseaseZScore': 2.837, 'diseaseKIQR': 1.857, 'biopsySiteZScore': 10.0},
+    # MIDDLE is near the mean.  GATED is 2.616 sd out, mean 12.5 and sd 33.072, but below the 95th percentile
+    {'gene': 'DOWN', 'kbCategory': 'reduced expression', 'expressionState': 'outlier_low',
+     'diseasePercentile': 0.0, 'diseaseZScore': -2.837, 'diseaseKIQR': -1.857, 'biopsySiteZScore': -3.0},
+    # 0..6 once NA is left out: mean 3, sd 2, quartiles 1.5 and 4.5
+    {'gene': 'MISSING', 'kbCategory': 'increased expression', 'expressionState': 'outlier_high',
+     'diseasePercentile': 100.0, 'diseaseZScore': 8.5, 'diseaseKIQR': 5.667, 'biopsySiteZScore': 20.0},
+]
+
+@pytest.fixture
+def adapter(tmp_path):
+    (tmp_path / 'disease.tsv').write_text(disease)
+    (tmp_path / 'biopsy.tsv').write_text(biopsy)
+    return ExpressionAdapter(str(tmp_path / 'disease.tsv'), str(tmp_path / 'biopsy.tsv'))
+
+@pytest.mark.parametrize('blockRows', [2, 4096])
+def test_outlierCalls(adapter, monkeypatch, blockRows):
+    # Small blocks score some genes on slices of the reference and some on copies of the rows around UNUSED
+    monkeypatch.setattr(expressionModule, 'scoreBlockRows', blockRows)
+    assert list(adapter.expressionVariants()) == expected
+
+def test_scores(adapter):
+    reference = np.array([[0, 1, 2, 3, 4, 5, 6, 7], [0, 0, 0, 0, 0, 0, 0, 100]], dtype=np.float32)
+    scores = adapter.scoreGenes(reference, np.array([4, 99], dtype=np.float32))
+    # 4 is above 4 samples and ties one
+    assert scores['diseasePercentile'].tolist() == [56.25, 87.5]
+    assert scores['diseaseZScore'] == pytest.approx([0.5 / 5.25 ** 0.5, 86.5 / 1093.75 ** 0.5])
+    assert scores['diseaseKIQR'] == pytest.approx([0.5 / 3.5, float('inf')])
+
+def test_thresholds(adapter):
+    adapter.setOutlierThresholds(2.5, 85.0)
+    assert [record['gene'] for record in adapter.expressionVariants()] == ['UP', 'GATED', 'DOWN', 'MISSING']
+
+def test_referenceCacheNoticesRewrittenFile(adapter, tmp_path):
+    adapter.setReferenceCache(str(tmp_path / 'cache'))
+    assert adapter.loadReference()[1][0, 7] == 7
+    adapter.loadReference() # Now from the cache
+    # Same size and modification time, different content
+    path = tmp_path / 'disease.tsv'
+    stat = path.stat()
+    path.write_text(disease.replace('5\t6\t7\n', '5\t6\t8\n', 1))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert adapter.loadReference()[1][0, 7] == 8
+    assert adapter.loadReference()[1][0, 7] == 8
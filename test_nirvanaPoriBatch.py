@@ -0,0 +1,36 @@
+import argparse
+import os
+
+from nirvanaBenchmark import addGeneratorArguments, generateNirvanaJson
+from nirvanaPoriBatch import convertManifestEntry, runBatch
+
+# A patient that kills its worker process must not take the rest of the batch down with it, see runBatch.
+
+crashingPatient = 'P3'
+
+def convertOrCrash(patient, settings):
+    if patient['patientID'] == crashingPatient:
+        os._exit(1)
+    return convertManifestEntry(patient, settings)
+
+def test_workerCrashOnlyFailsItsPatient(tmp_path):
+    parser = argparse.ArgumentParser()
+    addGeneratorArguments(parser)
+    cnv = str(tmp_path / 'cnv.json')
+    generateNirvanaJson(cnv, parser.parse_args(['--cnv', '--positions', '300', '--genes', '50']))
+    patients = [{'patientID': f"P{number}", 'diseaseName': 'sarcoma', 'projectName': 'PORI', 'template': 'genomic',
+                 'cnv': cnv, 'outputFile': str(tmp_path / f"P{number}.json")} for number in range(1, 7)]
+
+    statusFile = tmp_path / 'status.tsv'
+    with open(statusFile, 'w') as status_handle:
+        failed = runBatch(patients, {}, workers=2, status_handle=status_handle, convert=convertOrCrash)
+
+    assert failed == 1
+    statuses = {}
+    for line in statusFile.read_text().splitlines()[1:]:
+        patientID, status, attempts = line.split('\t')[:3]
+        statuses[patientID] = (status, attempts)
+    assert statuses == {patient['patientID']: ('failed' if patient['patientID'] == crashingPatient else 'ok', '1')
+                        for patient in patients}
+    for patient in patients:
+        assert os.path.exists(patient['outputFile']) == (patient['patientID'] != crashingPatient)
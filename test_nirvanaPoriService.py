@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import socket
+
+import pytest
+
+from nirvanaBenchmark import addGeneratorArguments, generateNirvanaJson
+from nirvanaPoriAdapter import convertPatient
+from nirvanaPoriBatch import convertManifestEntry
+from nirvanaPoriService import ConversionService
+
+# Round trips through a ConversionService listening on a Unix socket, with the client in another thread.
+
+crashingPatient = 'CRASH'
+
+def convertOrCrash(patient, settings):
+    if patient['patientID'] == crashingPatient:
+        os._exit(1)
+    return convertManifestEntry(patient, settings)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socketPath):
+        super().__init__('localhost', timeout=60)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+def request(socketPath, method, path, body=None):
+    """
+    :return: (status, body)
+    """
+    connection = UnixHTTPConnection(socketPath)
+    try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def postJob(socketPath, patient):
+    status, body = request(socketPath, 'POST', '/jobs', json.dumps(patient))
+    assert status == 202
+    return json.loads(body)['id']
+
+def waitForJob(socketPath, jobID):
+    """
+    Follow the job's events until it is finished and return them.
+    """
+    status, body = request(socketPath, 'GET', f"/jobs/{jobID}/events")
+    assert status == 200
+    return [json.loads(line) for line in body.splitlines()]
+
+def withService(tmp_path, client, **options):
+    """
+    Run client(socketPath) in a thread while the service answers on a Unix socket, and return what it returns.
+    """
+    async def main():
+        service = ConversionService({}, **options)
+        service.startPool()
+        socketPath = str(tmp_path / 'service.sock')
+        try:
+            server = await asyncio.start_unix_server(service.handleConnection, path=socketPath)
+            async with server:
+                return await asyncio.to_thread(client, socketPath)
+        finally:
+            service.shutdown()
+    return asyncio.run(main())
+
+@pytest.fixture(scope='module')
+def cnv(tmp_path_factory):
+    parser = argparse.ArgumentParser()
+    addGeneratorArguments(parser)
+    path = str(tmp_path_factory.mktemp('input') / 'cnv.json')
+    generateNirvanaJson(path, parser.parse_args(['--cnv', '--positions', '300', '--genes', '50']))
+    return path
+
+def patient(tmp_path, cnv, patientID):
+    return {'patientID': patientID, 'diseaseName': 'sarcoma', 'cnv': cnv, 'outputFile': str(tmp_path / f"{patientID}.json")}
+
+def test_conversionRoundTrip(tmp_path, cnv):
+    def client(socketPath):
+        jobID = postJob(socketPath, patient(tmp_path, cnv, 'P1'))
+        events = waitForJob(socketPath, jobID)
+        assert [event['status'] for event in events] == ['queued', 'running', 'done']
+        status, job = request(socketPath, 'GET', f"/jobs/{jobID}")
+        assert status == 200 and json.loads(job)['status'] == 'done'
+        return request(socketPath, 'GET', f"/jobs/{jobID}/result")
+
+    status, result = withService(tmp_path, client, workers=1, defaults={'projectName': 'PORI', 'template': 'genomic'})
+    assert status == 200
+    expected = dict(patient(tmp_path, cnv, 'P1'), projectName='PORI', template='genomic', outputFile=str(tmp_path / 'cli.json'))
+    convertPatient(expected, {}, jobs=1)
+    with open(expected['outputFile'], 'rb') as f:
+        assert result == f.read()
+
+def test_badRequests(tmp_path, cnv):
+    def client(socketPath):
+        statuses = [
+            request(socketPath, 'POST', '/jobs', '{"patientID": ')[0], # Not JSON
+            request(socketPath, 'POST', '/jobs', '[]')[0], # Not an object
+            request(socketPath, 'POST', '/jobs', '{"patientID": "P1"}')[0], # Missing columns and input files
+            request(socketPath, 'DELETE', '/jobs')[0],
+            request(socketPath, 'GET', '/jobs/404')[0],
+            request(socketPath, 'GET', '/nowhere')[0],
+        ]
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as raw:
+            raw.settimeout(60)
+            raw.connect(socketPath)
+            raw.sendall(b'NOT A VALID REQUEST LINE\r\n\r\n')
+            statuses.append(int(raw.makefile('rb').readline().split()[1]))
+        status, health = request(socketPath, 'GET', '/health')
+        assert status == 200 and json.loads(health)['jobs'] == 0
+        return statuses
+
+    assert withService(tmp_path, client, workers=1) == [400, 400, 400, 405, 404, 404, 400]
+
+def test_workerCrashReplacesPool(tmp_path, cnv):
+    def client(socketPath):
+        # One worker, so the second job waits for the slot of the first and then runs on the replaced pool
+        crashing = postJob(socketPath, patient(tmp_path, cnv, crashingPatient))
+        following = postJob(socketPath, patient(tmp_path, cnv, 'P2'))
+        return waitForJob(socketPath, crashing)[-1], waitForJob(socketPath, following)[-1]
+
+    crashed, following = withService(tmp_path, client, workers=1, convert=convertOrCrash,
+                                     defaults={'projectName': 'PORI', 'template': 'genomic'})
+    assert crashed['status'] == 'failed' and crashed['error'].startswith('BrokenProcessPool')
+    assert following['status'] == 'done'
+    assert os.path.exists(tmp_path / 'P2.json')
@@ -0,0 +1,113 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from nirvanaBenchmark import addGeneratorArguments, generateNirvanaJson
+from nirvanaLibrary import iterCopyVariants, iterSmallMutations, writeDocument
+
+# The options that change how the input is read, eg pruning, sharding, incremental runs and compressed input,
+# must never change the output.  Each test converts generated Nirvana JSON with the command line and compares
+# the bytes of the output to those of a default run.  The records and documents of nirvanaLibrary must match it too.
+
+repoDirectory = os.path.dirname(os.path.abspath(__file__))
+
+# 2400 positions spread over 24 chromosomes, 100 each, starting at 10000 with 137 bases between positions
+generatorArguments = ['--positions', '2400', '--genes', '300', '--transcripts', '3', '--annotationBulk', '1']
+regions = "chr1\t12000\t15000\nchr2\t30000\t33000\nchrX\t0\t1000000\n"
+
+def generate(path, cnv):
+    parser = argparse.ArgumentParser()
+    addGeneratorArguments(parser)
+    generateNirvanaJson(path, parser.parse_args(generatorArguments + (['--cnv'] if cnv else [])))
+
+def gzipCopy(path):
+    with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    return path + '.gz'
+
+def convert(outputFile, cnv, vcf, *options):
+    """
+    Run nirvanaPoriAdapter.py and return the bytes of the output file.
+    """
+    command = [sys.executable, os.path.join(repoDirectory, 'nirvanaPoriAdapter.py'), '--cnv', cnv, '--vcf', vcf,
+               '--outputFile', str(outputFile), '--diseaseName', 'sarcoma', *options]
+    subprocess.run(command, check=True, cwd=repoDirectory, capture_output=True)
+    with open(outputFile, 'rb') as f:
+        return f.read()
+
+@pytest.fixture(scope='module')
+def inputs(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('inputs')
+    cnv, vcf = str(directory / 'cnv.json'), str(directory / 'vcf.json')
+    generate(cnv, True)
+    generate(vcf, False)
+    bed = directory / 'regions.bed'
+    bed.write_text(regions)
+    return {'cnv': cnv, 'vcf': vcf, 'cnvGz': gzipCopy(cnv), 'vcfGz': gzipCopy(vcf), 'regions': str(bed)}
+
+@pytest.fixture(scope='module')
+def defaultOutput(inputs, tmp_path_factory):
+    output = convert(tmp_path_factory.mktemp('default') / 'out.json', inputs['cnv'], inputs['vcf'])
+    assert b'"copyVariants":[{' in output and b'"smallMutations":[{' in output
+    return output
+
+def test_noPruning(inputs, defaultOutput, tmp_path):
+    assert convert(tmp_path / 'out.json', inputs['cnv'], inputs['vcf'], '--noPruning') == defaultOutput
+
+@pytest.mark.parametrize('shards', [2, 5])
+def test_shards(inputs, defaultOutput, tmp_path, shards):
+    assert convert(tmp_path / 'out.json', inputs['cnv'], inputs['vcf'], '--shards', str(shards)) == defaultOutput
+
+def test_incrementalRerun(inputs, defaultOutput, tmp_path):
+    first = convert(tmp_path / 'out.json', inputs['cnv'], inputs['vcf'], '--incremental')
+    second = convert(tmp_path / 'out.json', inputs['cnv'], inputs['vcf'], '--incremental')
+    assert first == defaultOutput
+    assert second == defaultOutput
+
+def test_gzipInput(inputs, defaultOutput, tmp_path):
+    assert convert(tmp_path / 'out.json', inputs['cnvGz'], inputs['vcfGz']) == defaultOutput
+
+def test_gzipInputWithRegions(inputs, tmp_path):
+    plain = convert(tmp_path / 'plain.json', inputs['cnv'], inputs['vcf'], '--regions', inputs['regions'])
+    compressed = convert(tmp_path / 'gz.json', inputs['cnvGz'], inputs['vcfGz'], '--regions', inputs['regions'])
+    assert b'"smallMutations":[{' in plain
+    assert compressed == plain
+
+def test_incrementalRerunWithRegionsOnGzipInput(inputs, tmp_path):
+    # Compressed input can't be indexed, so the regions are applied while streaming, and to reused positions
+    plain = convert(tmp_path / 'plain.json', inputs['cnv'], inputs['vcf'], '--regions', inputs['regions'])
+    convert(tmp_path / 'out.json', inputs['cnvGz'], inputs['vcfGz'], '--incremental')
+    for run in range(2):
+        rerun = convert(tmp_path / 'out.json', inputs['cnvGz'], inputs['vcfGz'], '--incremental', '--regions', inputs['regions'])
+        assert rerun == plain
+
+def test_libraryMatchesCommandLine(inputs, defaultOutput):
+    copyVariants = list(iterCopyVariants(inputs['cnv']))
+    smallMutations = list(iterSmallMutations(inputs['vcf']))
+    document = json.loads(defaultOutput)
+    assert copyVariants == document['copyVariants']
+    assert smallMutations == document['smallMutations']
+
+    header = {'patientId': 'ANONYMOUS', 'kbDiseaseMatch': 'sarcoma', 'project': 'PORI', 'template': 'genomic'}
+    output = io.StringIO()
+    writeDocument(output, header, [('copyVariants', copyVariants), ('smallMutations', smallMutations)])
+    assert output.getvalue().encode() == defaultOutput
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason="Open files are counted in /proc")
+def test_closingLibraryRecordsEarlyReleasesFiles(inputs):
+    def openFiles():
+        return len(os.listdir('/proc/self/fd'))
+    before = openFiles()
+    # Without a memory budget every selected record is spilled to a temporary file and read back from it
+    records = iterSmallMutations(inputs['vcf'], {'memoryBudget': 0})
+    next(records)
+    assert openFiles() > before
+    records.close()
+    assert openFiles() == before
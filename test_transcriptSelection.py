@@ -0,0 +1,43 @@
+import io
+
+from CnvAdapter import CnvAdapter
+from VcfAdapter import VcfAdapter
+from nirvanaRecords import Variant
+
+# Transcript selection by consequence rank, see NirvanaJsonAdapter.getBestTranscript.
+
+def parseTranscripts(adapter, transcripts):
+    """
+    Build the transcripts of one variant through the adapter's handlers, the way the parser does.
+
+    :param transcripts: (source, consequences) of each transcript, in input order.
+    """
+    adapter.resetPosition()
+    adapter.addRecordToContext(['positions', 'variants'], Variant)
+    for source, consequences in transcripts:
+        adapter.handleNewTranscript(None)
+        adapter.getContainer(['positions', 'variants', 'transcripts']).source = source
+        for consequence in consequences:
+            adapter.handleTranscriptConsequence(consequence)
+    return adapter.getContainer(['positions', 'variants']).transcripts
+
+def bestSource(adapter, transcripts):
+    return adapter.getBestTranscript(parseTranscripts(adapter, transcripts)).source
+
+def test_unrankedTranscriptDoesNotWin():
+    adapter = CnvAdapter(io.StringIO())
+    assert bestSource(adapter, [('A', ['transcript_ablation']), ('B', ['not_a_consequence'])]) == 'A'
+
+def test_bestRankWinsWhereverItIsListed():
+    adapter = CnvAdapter(io.StringIO())
+    transcripts = [('A', ['intron_variant', 'copy_number_decrease']), ('B', ['transcript_ablation'])]
+    assert bestSource(adapter, transcripts) == 'A'
+
+def test_smallVariantsRankedWithVariantPriorities():
+    adapter = VcfAdapter(io.StringIO())
+    transcripts = [('A', ['synonymous_variant']), ('B', ['missense_variant']), ('C', ['intron_variant'])]
+    assert bestSource(adapter, transcripts) == 'B'
+
+def test_refSeqWinsTies():
+    adapter = VcfAdapter(io.StringIO())
+    assert bestSource(adapter, [('Ensembl', ['missense_variant']), ('RefSeq', ['missense_variant'])]) == 'RefSeq'